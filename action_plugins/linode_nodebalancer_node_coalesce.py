@@ -0,0 +1,252 @@
+# -*- coding: utf-8 -*-
+"""linode_nodebalancer_node_coalesce: linode_nodebalancer_node, with the
+tasks of a play's hosts coalesced on the controller.
+
+It takes the options of linode_nodebalancer_node. The hosts of a play
+batch that register a node_name on the same nodebalancer config (with the
+same other options) meet on the controller. The first to arrive leads: it
+waits up to coalesce_window seconds (default 2) for the rest of the batch,
+then runs a single linode_nodebalancer_node task with every host's node in
+its nodes list, and hands each host back the result for its own node.
+Hosts arriving later are reconciled in another round.
+
+A host waits up to coalesce_timeout seconds (default 300) for the leader's
+result, and then registers its node itself. Tasks using node_id or nodes
+are run as they are.
+"""
+
+import errno
+import fcntl
+import hashlib
+import json
+import os
+import tempfile
+import time
+import uuid
+
+from ansible.plugins.action import ActionBase
+
+MODULE = 'linode_nodebalancer_node'
+
+# The options of a single node. Every other option must match for tasks
+# to be coalesced.
+NODE_OPTIONS = ('node_name', 'address', 'weight', 'mode', 'state')
+
+# Seconds the leader waits for the rest of the batch, and that the others
+# wait for the leader's result before running on their own
+COALESCE_WINDOW = 2.0
+COALESCE_TIMEOUT = 300.0
+
+# Seconds after which spool files left by earlier runs are removed
+SPOOL_MAX_AGE = 86400
+
+
+def spool_dir():
+    """Where the hosts meet, next to the modules' other controller state"""
+    path = os.path.join(
+        os.environ.get('LINODE_NODEBALANCER_STATE_DIR') or
+        os.path.join(os.path.expanduser('~'), '.ansible',
+                     'linode_nodebalancer'),
+        'coalesce')
+    try:
+        os.makedirs(path, 0o700)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+    return path
+
+
+def read_json(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (IOError, OSError, ValueError):
+        return None
+
+
+def write_json(path, data):
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path))
+    with os.fdopen(fd, 'w') as f:
+        json.dump(data, f)
+    os.rename(tmp, path)
+
+
+class Round(object):
+    """The spool of a group of coalescable tasks. Each round has a leader,
+    the specs of the hosts that joined it, and once the leader has run,
+    every host's result.
+    """
+
+    def __init__(self, group):
+        self.path = os.path.join(spool_dir(), group + '.json')
+
+    def locked(self, update):
+        """Call update with the current round (or None) under an exclusive
+        lock. It returns the round to write back, and a value to return.
+        """
+        with open(self.path + '.lock', 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                current, returned = update(read_json(self.path))
+                write_json(self.path, current)
+                return returned
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def join(self, host, spec):
+        """Join the open round, or start one. Returns (round id, leader)"""
+        def update(current):
+            if current is None or current['claimed']:
+                current = dict(id=uuid.uuid4().hex, leader=host,
+                               claimed=False, specs={})
+            current['specs'][host] = spec
+            return current, (current['id'], current['leader'])
+        return self.locked(update)
+
+    def claim(self, hosts, window):
+        """As the leader, wait until every host has joined, or the window
+        has passed, then close the round to newcomers. Returns the specs
+        of the hosts that joined.
+        """
+        deadline = time.time() + window
+
+        def update(current):
+            if set(hosts) - set(current['specs']) and \
+                    time.time() < deadline:
+                return current, None
+            current['claimed'] = True
+            return current, current['specs']
+
+        while True:
+            specs = self.locked(update)
+            if specs is not None:
+                return specs
+            time.sleep(0.05)
+
+    def results_path(self, round_id):
+        return '{path}.{id}.results'.format(path=self.path[:-5], id=round_id)
+
+    def publish(self, round_id, results):
+        write_json(self.results_path(round_id), results)
+
+    def wait(self, round_id, host, timeout):
+        """Wait for the leader's result for the host, or None on timeout"""
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            results = read_json(self.results_path(round_id))
+            if results is not None:
+                return results.get(host)
+            time.sleep(0.1)
+        return None
+
+
+def clean_spool(max_age=SPOOL_MAX_AGE):
+    """Remove spool files left by runs long finished"""
+    directory = spool_dir()
+    for name in os.listdir(directory):
+        path = os.path.join(directory, name)
+        try:
+            if time.time() - os.path.getmtime(path) > max_age:
+                os.remove(path)
+        except OSError:
+            pass
+
+
+def group_key(task_uuid, args):
+    """Tasks are coalesced within one task of one run, and only with hosts
+    targeting the same nodebalancer config with the same options.
+    """
+    shared = dict((k, v) for k, v in args.items() if k not in NODE_OPTIONS)
+    data = json.dumps([task_uuid, shared], sort_keys=True, default=str)
+    return hashlib.sha256(data.encode('utf-8')).hexdigest()[:16]
+
+
+def split_result(result, specs):
+    """Split the result of a coalesced run into one per host, each with
+    its own node, and the plan (and diff) entries for it.
+    """
+    nodes = dict((node['node_name'], node)
+                 for node in result.get('nodes') or [])
+    plan = result.get('plan') or []
+    diff = result.get('diff')
+
+    results = {}
+    for host, spec in specs.items():
+        node = nodes.get(spec['node_name'])
+        if node is None:
+            results[host] = dict(failed=True,
+                                 msg=result.get('msg') or
+                                 'No result for {nm}'.format(
+                                     nm=spec['node_name']))
+            continue
+
+        # Node keys are port:protocol:node_name, and a label may hold ':'
+        mine = [i for i, entry in enumerate(plan)
+                if entry['type'] == 'node' and
+                entry['key'].split(':', 2)[2] == spec['node_name']]
+        host_result = dict(changed=node['action'] != 'unchanged',
+                           instances=node['node'],
+                           plan=[plan[i] for i in mine],
+                           coalesced=sorted(specs))
+        if diff is not None:
+            host_result['diff'] = [diff[i] for i in mine]
+        if result.get('ansible_facts'):
+            host_result['ansible_facts'] = result['ansible_facts']
+        if node.get('error'):
+            host_result.update(failed=True, msg=node['error'])
+        results[host] = host_result
+    return results
+
+
+class ActionModule(ActionBase):
+
+    TRANSFERS_FILES = False
+
+    def run(self, tmp=None, task_vars=None):
+        if task_vars is None:
+            task_vars = dict()
+        result = super(ActionModule, self).run(tmp, task_vars)
+
+        args = dict(self._task.args)
+        window = float(args.pop('coalesce_window', None) or COALESCE_WINDOW)
+        timeout = float(args.pop('coalesce_timeout', None) or
+                        COALESCE_TIMEOUT)
+
+        # Only nodes named in a single task can be coalesced
+        if not args.get('node_name') or args.get('node_id') or \
+                args.get('nodes') is not None:
+            result.update(self._run_module(args, task_vars))
+            return result
+
+        host = task_vars.get('inventory_hostname')
+        hosts = task_vars.get('ansible_play_batch') or [host]
+        spec = dict((k, args[k]) for k in NODE_OPTIONS if k in args)
+
+        spool = Round(group_key(self._task._uuid, args))
+        round_id, leader = spool.join(host, spec)
+
+        if leader != host:
+            mine = spool.wait(round_id, host, timeout)
+            if mine is None:
+                mine = self._run_module(args, task_vars)
+            result.update(mine)
+            return result
+
+        clean_spool()
+        specs = spool.claim(hosts, window)
+        if len(specs) == 1:
+            results = {host: self._run_module(args, task_vars)}
+        else:
+            nodes_args = dict((k, v) for k, v in args.items()
+                              if k not in NODE_OPTIONS)
+            nodes_args.update(nodes=[specs[h] for h in sorted(specs)],
+                              purge=False)
+            results = split_result(self._run_module(nodes_args, task_vars),
+                                   specs)
+        spool.publish(round_id, results)
+        result.update(results[host])
+        return result
+
+    def _run_module(self, args, task_vars):
+        return self._execute_module(module_name=MODULE, module_args=args,
+                                    task_vars=task_vars)
@@ -0,0 +1,226 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""Count the api calls, and time, the linode_nodebalancer* modules take
+against an account of a given size, using the offline fake api.
+
+    python bench/benchmark.py
+    python bench/benchmark.py --sizes 10 100 --latency 0.05 --json
+
+Each scenario calls a module's function in process against a fresh
+FakeLinodeServer, seeded with `size` nodebalancers, or `size` nodes, and
+reports the HTTP requests made, the api actions they carried, and the wall
+time. It needs ansible and linode-python installed, as the modules do.
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+from collections import OrderedDict
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(HERE)
+sys.path[:0] = [HERE, ROOT]
+
+# Make the repo's module_utils importable, as ansible would
+import ansible.module_utils
+ansible.module_utils.__path__.append(os.path.join(ROOT, 'module_utils'))
+
+from ansible.module_utils.linode_nodebalancer_common import (
+    api_connect,
+    linode_nodebalancer_argument_spec)
+from fake_linode_api import FakeLinode, FakeLinodeServer
+import linode_nodebalancer
+import linode_nodebalancer_config
+import linode_nodebalancer_facts
+import linode_nodebalancer_node
+
+API_KEY = 'benchmark'
+
+
+class ModuleExit(Exception):
+
+    def __init__(self, failed, result):
+        Exception.__init__(self, result.get('msg'))
+        self.failed = failed
+        self.result = result
+
+
+class BenchModule(object):
+    """Enough of AnsibleModule for the module functions"""
+
+    def __init__(self, **params):
+        self.params = dict((k, v.get('default')) for k, v in
+                           linode_nodebalancer_argument_spec().items())
+        self.params.update(params)
+        self.check_mode = False
+
+    def exit_json(self, **result):
+        raise ModuleExit(False, result)
+
+    def fail_json(self, **result):
+        raise ModuleExit(True, result)
+
+
+def seed_nodebalancers(linode, size):
+    for i in range(size):
+        nb_id = linode.add_nodebalancer('nb{i}'.format(i=i))
+        linode.add_config(nb_id)
+
+
+def seed_nodes(linode, size):
+    config_id = linode.add_config(linode.add_nodebalancer('nb'))
+    for i in range(size):
+        linode.add_node(config_id, 'node{i}'.format(i=i),
+                        '192.168.0.{i}:80'.format(i=i % 250))
+
+
+def seed_configs(linode, size):
+    nb_id = linode.add_nodebalancer('nb')
+    for i in range(size):
+        linode.add_config(nb_id, PORT=1000 + i)
+
+
+def config_list(size):
+    return [dict(port=1000 + i) for i in range(size)]
+
+
+CONFIG_OPTIONS = dict(protocol='http', algorithm='roundrobin',
+                      stickiness='none', check='connection',
+                      check_interval=5, check_timeout=3, check_attempts=2,
+                      check_path='', check_body='')
+
+
+def node_list(size):
+    return [dict(node_name='node{i}'.format(i=i),
+                 address='192.168.0.{i}:80'.format(i=i % 250))
+            for i in range(size)]
+
+
+# Each scenario is (name, seed, run), where run(module, api, size) calls
+# the module function
+
+SCENARIOS = [
+    ('nodebalancer_unchanged', seed_nodebalancers,
+     lambda m, api, size: linode_nodebalancer.linodeNodeBalancers(
+         m, api, 'present', 'nb{i}'.format(i=size - 1), None, 7, 1, 0)),
+    ('nodebalancer_create', seed_nodebalancers,
+     lambda m, api, size: linode_nodebalancer.linodeNodeBalancers(
+         m, api, 'present', 'new', None, 7, 1, 0)),
+    ('config_unchanged', seed_nodebalancers,
+     lambda m, api, size: linode_nodebalancer_config.linodeNodeBalancerConfigs(
+         m, api, 'present', 'nb{i}'.format(i=size - 1), None, None, 80,
+         'http', 'roundrobin', 'none', 'connection', 5, 3, 2, '', '')),
+    ('configs_bulk_create', lambda linode, size: seed_configs(linode, 0),
+     lambda m, api, size:
+     linode_nodebalancer_config.linodeNodeBalancerConfigsBulk(
+         m, api, 'present', 'nb', None, config_list(size), False,
+         CONFIG_OPTIONS, concurrency=8)),
+    ('configs_bulk_unchanged', seed_configs,
+     lambda m, api, size:
+     linode_nodebalancer_config.linodeNodeBalancerConfigsBulk(
+         m, api, 'present', 'nb', None, config_list(size), False,
+         CONFIG_OPTIONS)),
+    ('node_unchanged', seed_nodes,
+     lambda m, api, size: linode_nodebalancer_node.linodeNodeBalancerNodes(
+         m, api, 'present', 'nb', None, None, 80, 'http', None,
+         'node{i}'.format(i=size - 1),
+         '192.168.0.{i}:80'.format(i=(size - 1) % 250), 100, 'accept')),
+    ('node_create', seed_nodes,
+     lambda m, api, size: linode_nodebalancer_node.linodeNodeBalancerNodes(
+         m, api, 'present', 'nb', None, None, 80, 'http', None, 'new',
+         '192.168.1.1:80', 100, 'accept')),
+    ('nodes_bulk_create', lambda linode, size: seed_nodes(linode, 0),
+     lambda m, api, size: linode_nodebalancer_node.linodeNodeBalancerNodesBulk(
+         m, api, 'present', 'nb', None, None, 80, 'http', node_list(size),
+         False, 100, 'accept')),
+    ('nodes_bulk_create_batched', lambda linode, size: seed_nodes(linode, 0),
+     lambda m, api, size: linode_nodebalancer_node.linodeNodeBalancerNodesBulk(
+         m, api, 'present', 'nb', None, None, 80, 'http', node_list(size),
+         False, 100, 'accept', batch=True)),
+    ('nodes_bulk_unchanged', seed_nodes,
+     lambda m, api, size: linode_nodebalancer_node.linodeNodeBalancerNodesBulk(
+         m, api, 'present', 'nb', None, None, 80, 'http', node_list(size),
+         False, 100, 'accept')),
+    ('facts', seed_nodebalancers,
+     lambda m, api, size: linode_nodebalancer_facts.linodeNodeBalancerFacts(
+         m, api, None, None, None, True, True)),
+]
+
+
+def run_scenario(name, seed, run, size, latency, jitter, params):
+    linode = FakeLinode(API_KEY)
+    seed(linode, size)
+    server = FakeLinodeServer(linode, latency=latency, jitter=jitter).start()
+    os.environ['LINODE_API_URL'] = server.url
+    if params.get('api_version') == 'v4':
+        os.environ['LINODE_API_URL'] += 'v4'
+    try:
+        module = BenchModule(**params)
+        start = time.time()
+        api = api_connect(module, API_KEY)
+        try:
+            run(module, api, size)
+            result, failed = {}, False
+        except ModuleExit as e:
+            result, failed = e.result, e.failed
+        elapsed = time.time() - start
+    finally:
+        server.stop()
+
+    return OrderedDict([
+        ('scenario', name),
+        ('size', size),
+        ('failed', failed),
+        ('changed', result.get('changed')),
+        ('requests', linode.requests),
+        ('actions', OrderedDict(sorted(linode.actions.items()))),
+        ('seconds', round(elapsed, 3)),
+    ])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--sizes', type=int, nargs='+',
+                        default=[10, 100, 1000])
+    parser.add_argument('--scenarios', nargs='+',
+                        choices=[s[0] for s in SCENARIOS],
+                        help='only run these scenarios')
+    parser.add_argument('--latency', type=float, default=0.02,
+                        help='mean seconds added to every request')
+    parser.add_argument('--jitter', type=float, default=0.0,
+                        help='standard deviation of the added latency')
+    parser.add_argument('--no-keep-alive', action='store_true',
+                        help='open a new connection for every request')
+    parser.add_argument('--api-version', choices=['v3', 'v4'], default='v3',
+                        help='the api backend the modules use')
+    parser.add_argument('--json', action='store_true',
+                        help='print one JSON object per run')
+    args = parser.parse_args()
+
+    params = dict(keep_alive=not args.no_keep_alive,
+                  api_version=args.api_version)
+    if not args.json:
+        print('{0:<28} {1:>6} {2:>8} {3:>8} {4:>9}  {5}'.format(
+            'scenario', 'size', 'changed', 'requests', 'seconds', 'actions'))
+
+    for name, seed, run in SCENARIOS:
+        if args.scenarios and name not in args.scenarios:
+            continue
+        for size in args.sizes:
+            report = run_scenario(name, seed, run, size, args.latency,
+                                  args.jitter, params)
+            if args.json:
+                print(json.dumps(report))
+                continue
+            status = 'FAILED' if report['failed'] else report['changed']
+            actions = ' '.join('{0}={1}'.format(k, v) for k, v in
+                               report['actions'].items())
+            print('{0:<28} {1:>6} {2:>8} {3:>8} {4:>9.3f}  {5}'.format(
+                name, size, str(status), report['requests'],
+                report['seconds'], actions))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,513 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""An offline stand in for the parts of the linode v3 and v4 apis used by
+the linode_nodebalancer* modules.
+
+It implements test.echo, batch, and the list / create / update / delete
+actions of nodebalancer, nodebalancer.config and nodebalancer.node, with
+an injected latency per request. The same actions are served as api v4
+REST requests under /v4, with X-Filter and paging. Every request and
+action (by its api v3 name) is counted.
+
+Run it on its own, and point the modules at it with LINODE_API_URL:
+
+    python bench/fake_linode_api.py --port 8000 --latency 0.05
+    LINODE_API_URL=http://127.0.0.1:8000/ ansible-playbook ...
+    LINODE_API_URL=http://127.0.0.1:8000/v4 ansible-playbook ...  # v4
+
+or use FakeLinodeServer from python (see bench/benchmark.py).
+"""
+
+import argparse
+import json
+import random
+import socket
+import threading
+import time
+from collections import defaultdict
+
+try:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    from urlparse import parse_qsl, urlparse
+except ImportError:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from urllib.parse import parse_qsl, urlparse
+
+
+AUTHENTICATION_FAILED = 4
+NOT_FOUND = 5
+MISSING_PROPERTY = 6
+VALIDATION = 8
+
+NODEBALANCER_DEFAULTS = dict(CLIENTCONNTHROTTLE=0, DATACENTERID=7)
+CONFIG_DEFAULTS = dict(PORT=80, PROTOCOL='http', ALGORITHM='roundrobin',
+                       STICKINESS='none', CHECK='connection',
+                       CHECK_INTERVAL=5, CHECK_TIMEOUT=3, CHECK_ATTEMPTS=2,
+                       CHECK_PATH='', CHECK_BODY='')
+NODE_DEFAULTS = dict(WEIGHT=100, MODE='accept', STATUS='Unknown')
+
+# api v3 datacenter ids of the api v4 regions
+REGIONS = {'us-central': 2, 'us-west': 3, 'us-southeast': 4, 'us-east': 6,
+           'eu-west': 7, 'ap-northeast-1a': 8, 'ap-south': 9,
+           'eu-central': 10, 'ap-northeast': 11, 'ap-west': 14,
+           'ca-central': 15, 'ap-southeast': 16}
+
+# api v4 HTTP statuses of the errors
+STATUSES = {AUTHENTICATION_FAILED: 401, NOT_FOUND: 404}
+
+INTEGER_FIELDS = ('NODEBALANCERID', 'CONFIGID', 'NODEID', 'DATACENTERID',
+                  'PAYMENTTERM', 'CLIENTCONNTHROTTLE', 'PORT', 'WEIGHT',
+                  'CHECK_INTERVAL', 'CHECK_TIMEOUT', 'CHECK_ATTEMPTS')
+
+
+class FakeError(Exception):
+
+    def __init__(self, code, message):
+        Exception.__init__(self, message)
+        self.code = code
+        self.message = message
+
+
+class FakeLinode(object):
+    """The in memory account, and the api actions run against it"""
+
+    def __init__(self, api_key=None):
+        self.api_key = api_key
+        self.nodebalancers = {}
+        self.configs = {}
+        self.nodes = {}
+        self.next_id = 1000
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.actions = defaultdict(int)
+
+    def reset_counts(self):
+        with self.lock:
+            self.requests = 0
+            self.actions = defaultdict(int)
+
+    def _id(self):
+        self.next_id += 1
+        return self.next_id
+
+    # Seeding, without going through the api
+
+    def add_nodebalancer(self, label, **fields):
+        nb_id = self._id()
+        self.nodebalancers[nb_id] = dict(
+            NODEBALANCERID=nb_id, LABEL=label,
+            HOSTNAME='nb-{id}.example.nodebalancer.linode.com'.format(id=nb_id),
+            ADDRESS4='192.0.2.{n}'.format(n=nb_id % 250),
+            ADDRESS6='2001:db8::{n:x}'.format(n=nb_id),
+            **dict(NODEBALANCER_DEFAULTS, **fields))
+        return nb_id
+
+    def add_config(self, nb_id, **fields):
+        config_id = self._id()
+        self.configs[config_id] = dict(CONFIGID=config_id,
+                                       NODEBALANCERID=nb_id,
+                                       **dict(CONFIG_DEFAULTS, **fields))
+        return config_id
+
+    def add_node(self, config_id, label, address, **fields):
+        node_id = self._id()
+        self.nodes[node_id] = dict(
+            NODEID=node_id, CONFIGID=config_id,
+            NODEBALANCERID=self.configs[config_id]['NODEBALANCERID'],
+            LABEL=label, ADDRESS=address, **dict(NODE_DEFAULTS, **fields))
+        return node_id
+
+    # The api
+
+    def handle(self, fields):
+        """Handle one HTTP request's form fields, returning the response"""
+        fields = dict((k.lower(), v) for k, v in fields.items())
+        with self.lock:
+            self.requests += 1
+
+        if self.api_key and fields.get('api_key') != self.api_key:
+            return self._response(fields.get('api_action'), None,
+                                  FakeError(AUTHENTICATION_FAILED,
+                                            'Authentication failed'))
+
+        if fields.get('api_action') == 'batch':
+            return [self._call(dict((k.lower(), v) for k, v in r.items()))
+                    for r in json.loads(fields['api_requestarray'])]
+        return self._call(fields)
+
+    def handle_v4(self, method, path, query, token, filters, body):
+        """Handle one api v4 request, returning the HTTP status and the
+        response.
+        """
+        with self.lock:
+            self.requests += 1
+        if self.api_key and token != 'Bearer ' + self.api_key:
+            return 401, dict(errors=[dict(reason='Invalid Token')])
+
+        parts = path.strip('/').split('/')[1:]
+        names, ids = parts[::2], [int(p) for p in parts[1::2] if p.isdigit()]
+        collection = len(ids) < len(names)
+        kind = {('profile',): 'test.echo',
+                ('nodebalancers',): 'nodebalancer',
+                ('nodebalancers', 'configs'): 'nodebalancer.config',
+                ('nodebalancers', 'configs', 'nodes'): 'nodebalancer.node',
+                }.get(tuple(names))
+        verb = {('GET', True): 'list', ('GET', False): 'list',
+                ('POST', True): 'create', ('PUT', False): 'update',
+                ('DELETE', False): 'delete'}.get((method, collection))
+        if kind is None or verb is None or len(parts[1::2]) != len(ids):
+            return 404, dict(errors=[dict(reason='Not found')])
+        action = kind if kind == 'test.echo' else '{k}.{v}'.format(
+            k=kind, v=verb)
+
+        params = dict((k.upper().replace('CLIENT_CONN_THROTTLE',
+                                         'CLIENTCONNTHROTTLE'), v)
+                      for k, v in (body or {}).items())
+        if 'REGION' in params:
+            params['DATACENTERID'] = REGIONS.get(params.pop('REGION'))
+        for name, object_id in zip(('NODEBALANCERID', 'CONFIGID', 'NODEID'),
+                                   ids):
+            params[name] = object_id
+        if action == 'nodebalancer.create':
+            # api v4 has no payment term
+            params['PAYMENTTERM'] = 1
+
+        with self.lock:
+            self.actions[action] += 1
+            try:
+                data = getattr(self, 'action_' + action.replace('.', '_'))(
+                    params)
+                if action == 'test.echo':
+                    return 200, dict(username='fake')
+                if action.endswith('.create'):
+                    new_id = list(data.values())[0]
+                    data = self._v4(kind, self._objects(kind)[new_id])
+                elif action.endswith('.update'):
+                    data = self._v4(kind, self._objects(kind)[ids[-1]])
+                elif action.endswith('.delete'):
+                    data = {}
+                elif not collection:
+                    data = self._v4(kind, data[0])
+                else:
+                    data = self._page([self._v4(kind, o) for o in data],
+                                      filters, query)
+                return 200, data
+            except FakeError as e:
+                return STATUSES.get(e.code, 400), dict(
+                    errors=[dict(reason=e.message)])
+
+    def _objects(self, kind):
+        return {'nodebalancer': self.nodebalancers,
+                'nodebalancer.config': self.configs,
+                'nodebalancer.node': self.nodes}[kind]
+
+    @staticmethod
+    def _v4(kind, obj):
+        renames = dict(NODEBALANCERID='nodebalancer_id', CONFIGID='config_id',
+                       NODEID='id', ADDRESS4='ipv4', ADDRESS6='ipv6',
+                       CLIENTCONNTHROTTLE='client_conn_throttle')
+        if kind == 'nodebalancer':
+            renames['NODEBALANCERID'] = 'id'
+        elif kind == 'nodebalancer.config':
+            renames['CONFIGID'] = 'id'
+        result = dict((renames.get(k, k.lower()), v) for k, v in obj.items())
+        if 'datacenterid' in result:
+            regions = dict((v, k) for k, v in REGIONS.items())
+            result['region'] = regions.get(result.pop('datacenterid'))
+        if 'status' in result and result['status'] == 'Unknown':
+            result['status'] = 'unknown'
+        return result
+
+    @staticmethod
+    def _page(objects, filters, query):
+        for field, value in (filters or {}).items():
+            objects = [o for o in objects if o.get(field) == value]
+        page = int(query.get('page', 1))
+        page_size = int(query.get('page_size', 100))
+        pages = max(1, (len(objects) + page_size - 1) // page_size)
+        return dict(data=objects[(page - 1) * page_size:page * page_size],
+                    page=page, pages=pages, results=len(objects))
+
+    def _call(self, fields):
+        action = fields.pop('api_action', None)
+        params = dict((k.upper(), v) for k, v in fields.items()
+                      if not k.startswith('api_'))
+        for k in INTEGER_FIELDS:
+            if params.get(k) not in (None, ''):
+                params[k] = int(params[k])
+
+        with self.lock:
+            self.actions[action] += 1
+            try:
+                method = getattr(self, 'action_' + action.replace('.', '_'))
+            except (AttributeError, TypeError):
+                return self._response(action, None, FakeError(
+                    3, 'The requested class does not exist'))
+            try:
+                return self._response(action, method(params), None)
+            except FakeError as e:
+                return self._response(action, None, e)
+
+    @staticmethod
+    def _response(action, data, error):
+        errors = []
+        if error:
+            errors = [dict(ERRORCODE=error.code, ERRORMESSAGE=error.message)]
+        return dict(ACTION=action, DATA=data if data is not None else {},
+                    ERRORARRAY=errors)
+
+    @staticmethod
+    def _require(params, *names):
+        for name in names:
+            if params.get(name) in (None, ''):
+                raise FakeError(MISSING_PROPERTY,
+                                '{n} is required'.format(n=name))
+
+    @staticmethod
+    def _get(objects, object_id):
+        if object_id not in objects:
+            raise FakeError(NOT_FOUND, 'Object not found')
+        return objects[object_id]
+
+    @staticmethod
+    def _update(obj, params, fields):
+        for field in fields:
+            if field in params:
+                obj[field] = params[field]
+
+    def action_test_echo(self, params):
+        return params
+
+    def action_nodebalancer_list(self, params):
+        nb_id = params.get('NODEBALANCERID')
+        if nb_id:
+            return [dict(self._get(self.nodebalancers, nb_id))]
+        return [dict(self.nodebalancers[k])
+                for k in sorted(self.nodebalancers)]
+
+    def action_nodebalancer_create(self, params):
+        self._require(params, 'DATACENTERID', 'PAYMENTTERM')
+        fields = dict((k, params[k]) for k in ('DATACENTERID',
+                                               'CLIENTCONNTHROTTLE')
+                      if k in params)
+        nb_id = self.add_nodebalancer(params.get('LABEL') or '', **fields)
+        if not params.get('LABEL'):
+            self.nodebalancers[nb_id]['LABEL'] = 'nodebalancer{id}'.format(
+                id=nb_id)
+        return dict(NodeBalancerID=nb_id)
+
+    def action_nodebalancer_update(self, params):
+        self._require(params, 'NODEBALANCERID')
+        nb = self._get(self.nodebalancers, params['NODEBALANCERID'])
+        self._update(nb, params, ('LABEL', 'CLIENTCONNTHROTTLE'))
+        return dict(NodeBalancerID=nb['NODEBALANCERID'])
+
+    def action_nodebalancer_delete(self, params):
+        self._require(params, 'NODEBALANCERID')
+        nb_id = params['NODEBALANCERID']
+        self._get(self.nodebalancers, nb_id)
+        del self.nodebalancers[nb_id]
+        for config_id in [k for k, v in self.configs.items()
+                          if v['NODEBALANCERID'] == nb_id]:
+            self.action_nodebalancer_config_delete(dict(CONFIGID=config_id))
+        return dict(NodeBalancerID=nb_id)
+
+    def action_nodebalancer_config_list(self, params):
+        self._require(params, 'NODEBALANCERID')
+        nb_id = params['NODEBALANCERID']
+        self._get(self.nodebalancers, nb_id)
+        config_id = params.get('CONFIGID')
+        if config_id:
+            config = self._get(self.configs, config_id)
+            if config['NODEBALANCERID'] != nb_id:
+                raise FakeError(NOT_FOUND, 'Object not found')
+            return [dict(config)]
+        return [dict(self.configs[k]) for k in sorted(self.configs)
+                if self.configs[k]['NODEBALANCERID'] == nb_id]
+
+    def _port_free(self, nb_id, port, config_id=None):
+        """Like linode, allow one config per port, whatever its protocol"""
+        for config in self.configs.values():
+            if config['NODEBALANCERID'] == nb_id and \
+                    config['PORT'] == port and \
+                    config['CONFIGID'] != config_id:
+                raise FakeError(VALIDATION,
+                                'Port {p} is already in use'.format(p=port))
+
+    def action_nodebalancer_config_create(self, params):
+        self._require(params, 'NODEBALANCERID')
+        self._get(self.nodebalancers, params['NODEBALANCERID'])
+        self._port_free(params['NODEBALANCERID'],
+                        params.get('PORT', CONFIG_DEFAULTS['PORT']))
+        config_id = self.add_config(params['NODEBALANCERID'])
+        self._update(self.configs[config_id], params, CONFIG_DEFAULTS)
+        return dict(ConfigID=config_id)
+
+    def action_nodebalancer_config_update(self, params):
+        self._require(params, 'CONFIGID')
+        config = self._get(self.configs, params['CONFIGID'])
+        if 'PORT' in params:
+            self._port_free(config['NODEBALANCERID'], params['PORT'],
+                            config['CONFIGID'])
+        self._update(config, params, CONFIG_DEFAULTS)
+        return dict(ConfigID=config['CONFIGID'])
+
+    def action_nodebalancer_config_delete(self, params):
+        self._require(params, 'CONFIGID')
+        config_id = params['CONFIGID']
+        self._get(self.configs, config_id)
+        del self.configs[config_id]
+        for node_id in [k for k, v in self.nodes.items()
+                        if v['CONFIGID'] == config_id]:
+            del self.nodes[node_id]
+        return dict(ConfigID=config_id)
+
+    def action_nodebalancer_node_list(self, params):
+        self._require(params, 'CONFIGID')
+        config_id = params['CONFIGID']
+        self._get(self.configs, config_id)
+        node_id = params.get('NODEID')
+        if node_id:
+            node = self._get(self.nodes, node_id)
+            if node['CONFIGID'] != config_id:
+                raise FakeError(NOT_FOUND, 'Object not found')
+            return [dict(node)]
+        return [dict(self.nodes[k]) for k in sorted(self.nodes)
+                if self.nodes[k]['CONFIGID'] == config_id]
+
+    def action_nodebalancer_node_create(self, params):
+        self._require(params, 'CONFIGID', 'LABEL', 'ADDRESS')
+        self._get(self.configs, params['CONFIGID'])
+        node_id = self.add_node(params['CONFIGID'], params['LABEL'],
+                                params['ADDRESS'])
+        self._update(self.nodes[node_id], params, ('WEIGHT', 'MODE'))
+        return dict(NodeID=node_id)
+
+    def action_nodebalancer_node_update(self, params):
+        self._require(params, 'NODEID')
+        node = self._get(self.nodes, params['NODEID'])
+        self._update(node, params, ('LABEL', 'ADDRESS', 'WEIGHT', 'MODE'))
+        return dict(NodeID=node['NODEID'])
+
+    def action_nodebalancer_node_delete(self, params):
+        self._require(params, 'NODEID')
+        self._get(self.nodes, params['NODEID'])
+        del self.nodes[params['NODEID']]
+        return dict(NodeID=params['NODEID'])
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # Send each response in one write, rather than a write per header line,
+    # which stalls keep-alive clients on delayed acks
+    wbufsize = -1
+
+    def setup(self):
+        BaseHTTPRequestHandler.setup(self)
+        with self.server.lock:
+            self.server.connections[self.connection] = \
+                threading.current_thread()
+
+    def finish(self):
+        with self.server.lock:
+            self.server.connections.pop(self.connection, None)
+        BaseHTTPRequestHandler.finish(self)
+
+    def log_message(self, *args):
+        pass
+
+    def handle_request(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length)
+        if not isinstance(body, str):
+            body = body.decode('utf-8')
+
+        latency, jitter = self.server.latency, self.server.jitter
+        if latency or jitter:
+            time.sleep(max(0, random.gauss(latency, jitter)))
+
+        url = urlparse(self.path)
+        linode = self.server.linode
+        if url.path.startswith('/v4/'):
+            filters = self.headers.get('X-Filter')
+            status, response = linode.handle_v4(
+                self.command, url.path, dict(parse_qsl(url.query)),
+                self.headers.get('Authorization'),
+                json.loads(filters) if filters else None,
+                json.loads(body) if body else None)
+        else:
+            status, response = 200, linode.handle(dict(parse_qsl(body)))
+
+        response = json.dumps(response).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(response)))
+        self.end_headers()
+        self.wfile.write(response)
+
+    do_GET = do_POST = do_PUT = do_DELETE = handle_request
+
+
+class FakeLinodeServer(ThreadingMixIn, HTTPServer):
+    """Serve a FakeLinode over HTTP, adding latency (seconds, normally
+    distributed with the given jitter) to every request.
+    """
+    daemon_threads = True
+
+    def __init__(self, linode=None, host='127.0.0.1', port=0, latency=0.0,
+                 jitter=0.0):
+        HTTPServer.__init__(self, (host, port), Handler)
+        self.linode = linode or FakeLinode()
+        self.latency = latency
+        self.jitter = jitter
+        self.connections = {}
+        self.lock = threading.Lock()
+
+    @property
+    def url(self):
+        return 'http://{host}:{port}/'.format(host=self.server_address[0],
+                                             port=self.server_address[1])
+
+    def start(self):
+        """Serve from a background thread"""
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def stop(self):
+        """Stop serving, and hang up on any kept alive connections"""
+        self.shutdown()
+        with self.lock:
+            connections = list(self.connections.items())
+        for connection, thread in connections:
+            try:
+                connection.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+            thread.join(1)
+        self.server_close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--latency', type=float, default=0.05,
+                        help='mean seconds added to every request')
+    parser.add_argument('--jitter', type=float, default=0.01,
+                        help='standard deviation of the added latency')
+    parser.add_argument('--api-key',
+                        help='only accept requests using this api key')
+    args = parser.parse_args()
+
+    server = FakeLinodeServer(FakeLinode(args.api_key), args.host,
+                              args.port, args.latency, args.jitter)
+    print('Serving a fake linode api on {url}'.format(url=server.url))
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
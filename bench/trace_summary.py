@@ -0,0 +1,58 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""Summarise the phase traces written by the linode_nodebalancer* modules.
+
+Run a play with LINODE_NODEBALANCER_TRACE set to a directory, then:
+
+    python bench/trace_summary.py /path/to/traces
+
+to see, per module and phase, how many spans there were, and their total,
+p50 and max duration, slowest total first.
+"""
+
+import argparse
+import glob
+import json
+import os
+from collections import defaultdict
+
+
+def read_spans(directory):
+    for path in glob.glob(os.path.join(directory, '*.jsonl')):
+        with open(path) as f:
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+
+
+def summarise(spans):
+    durations = defaultdict(list)
+    for span in spans:
+        name = span['name']
+        if span.get('action'):
+            name = '{n} {a}'.format(n=name, a=span['action'])
+        durations[(span['module'], name)].append(span['duration_ms'])
+
+    rows = []
+    for (module, name), ms in durations.items():
+        ms.sort()
+        rows.append((module, name, len(ms), sum(ms), ms[(len(ms) - 1) // 2],
+                     ms[-1]))
+    rows.sort(key=lambda row: -row[3])
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('directory')
+    args = parser.parse_args()
+
+    print('{0:<30} {1:<36} {2:>6} {3:>12} {4:>10} {5:>10}'.format(
+        'module', 'phase', 'spans', 'total_ms', 'p50_ms', 'max_ms'))
+    for row in summarise(read_spans(args.directory)):
+        print('{0:<30} {1:<36} {2:>6} {3:>12.1f} {4:>10.1f} {5:>10.1f}'
+              .format(*row))
+
+
+if __name__ == '__main__':
+    main()
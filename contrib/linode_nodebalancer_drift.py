@@ -0,0 +1,212 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""Watch the linode nodebalancers for drift from a desired state.
+
+    LINODE_API_KEY=... python contrib/linode_nodebalancer_drift.py desired.yml
+    python contrib/linode_nodebalancer_drift.py desired.yml --once
+
+The desired state file is YAML (or JSON): a list of nodebalancers, each
+with the options of the linode_nodebalancer_topology module (name,
+client_conn_throttle, purge, and configs with their nodes).
+
+Every poll prints a line of JSON, with the operations that
+linode_nodebalancer_topology would make to converge each drifted
+nodebalancer:
+
+    {"drifted": true, "drift": {"web": [{"action": "update", ...}]},
+     "reread": ["web"], "requests": 3, "taken": 1500000000.0}
+
+A poll lists the nodebalancers with a single call. Only the configs and
+nodes of the nodebalancers that are new, whose own fields changed, or that
+had drifted at the last poll are read again; the rest are diffed against
+what was read before. A config or node can change without changing its
+nodebalancer's fields, so every --full-every polls they are all read again.
+
+With --once a single poll is made, and the exit status is 1 if anything has
+drifted (2 if the poll failed). It needs ansible and linode-python
+installed, as the modules do.
+"""
+
+import argparse
+import json
+import os
+import socket
+import sys
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(HERE)
+sys.path[:0] = [ROOT]
+
+# Make the repo's module_utils importable, as ansible would
+import ansible.module_utils
+ansible.module_utils.__path__.append(os.path.join(ROOT, 'module_utils'))
+
+import yaml
+from linode import api as linode_api
+
+from ansible.module_utils.linode_nodebalancer_common import (
+    ApiStats,
+    api_connect,
+    error_message,
+    linode_nodebalancer_argument_spec)
+from linode_nodebalancer_facts import facts_fetch
+from linode_nodebalancer_topology import describe, topology_diff
+
+
+class DesiredStateError(Exception):
+    pass
+
+
+class DriftModule(object):
+    """Enough of AnsibleModule for api_connect and topology_diff"""
+
+    def __init__(self, **params):
+        self.params = dict((k, v.get('default')) for k, v in
+                           linode_nodebalancer_argument_spec().items())
+        self.params.update(params)
+        self.check_mode = True
+
+    def fail_json(self, msg, **result):
+        raise DesiredStateError(msg)
+
+
+def load_desired(path):
+    """Read the desired state file, returning the nodebalancers by name"""
+    with open(path) as f:
+        nodebalancers = yaml.safe_load(f) or []
+    if not isinstance(nodebalancers, list):
+        raise DesiredStateError("the desired state is a list of "
+                                "nodebalancers")
+    desired = {}
+    for spec in nodebalancers:
+        if not isinstance(spec, dict) or not spec.get('name'):
+            raise DesiredStateError("every nodebalancer needs a name")
+        if spec['name'] in desired:
+            raise DesiredStateError("{nm} is listed more than once".format(
+                nm=spec['name']))
+        desired[spec['name']] = spec
+    return desired
+
+
+class DriftWatcher(object):
+    """Diffs the account against the desired state, poll after poll,
+    keeping the configs and nodes read by earlier polls.
+    """
+
+    def __init__(self, module, api, desired, full_every=10, concurrency=4,
+                 batch=False):
+        self.module = module
+        self.api = api
+        self.desired = desired
+        self.full_every = full_every
+        self.concurrency = concurrency
+        self.batch = batch
+        self.polls = 0
+        # label -> (nodebalancer, {(port, protocol): (config, {label: node})})
+        self.trees = {}
+        self.drifted = set()
+
+    def stale(self, nodebalancers):
+        """The nodebalancers whose configs and nodes need reading again"""
+        if self.full_every and self.polls % self.full_every == 0:
+            return nodebalancers
+        return [nb for nb in nodebalancers
+                if nb['LABEL'] in self.drifted or
+                self.trees.get(nb['LABEL'], (None,))[0] != nb]
+
+    def poll(self):
+        """Read what has changed, and diff every desired nodebalancer"""
+        taken = time.time()
+        nodebalancers = [nb for nb in self.api.nodebalancer_list()
+                         if nb['LABEL'] in self.desired]
+        stale = self.stale(nodebalancers)
+        for nb, config_list in facts_fetch(self.api,
+                                           concurrency=self.concurrency,
+                                           batch=self.batch,
+                                           nodebalancers=stale):
+            self.trees[nb['LABEL']] = (nb, dict(
+                ((config['PORT'], config['PROTOCOL']),
+                 (config, dict((node['LABEL'], node) for node in nodes)))
+                for config, nodes in config_list))
+        for label in set(self.trees) - set(nb['LABEL']
+                                            for nb in nodebalancers):
+            del self.trees[label]
+        self.polls += 1
+
+        drift = {}
+        for name in sorted(self.desired):
+            spec = self.desired[name]
+            nodebalancer, tree = self.trees.get(name, (None, {}))
+            ops = topology_diff(self.module, nodebalancer, tree, name,
+                                spec.get('client_conn_throttle', 0),
+                                spec.get('configs') or [],
+                                spec.get('purge', False))
+            if ops:
+                drift[name] = [describe(op) for op in ops]
+        self.drifted = set(drift)
+
+        return dict(taken=taken, drifted=bool(drift), drift=drift,
+                    reread=sorted(nb['LABEL'] for nb in stale))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('desired',
+                        help='the desired state file, YAML or JSON')
+    parser.add_argument('--api-key', default=os.environ.get('LINODE_API_KEY'),
+                        help='defaults to $LINODE_API_KEY')
+    parser.add_argument('--api-version', default='v3', choices=['v3', 'v4'])
+    parser.add_argument('--interval', type=float, default=60,
+                        help='seconds between polls')
+    parser.add_argument('--full-every', type=int, default=10,
+                        help='read every config and node every this many '
+                             'polls, 0 for only the first')
+    parser.add_argument('--concurrency', type=int, default=4,
+                        help='config / node lists to read at once')
+    parser.add_argument('--batch', action='store_true',
+                        help='read the config / node lists in '
+                             'api_action=batch requests')
+    parser.add_argument('--rate-limit', type=float, default=0,
+                        help='requests per second, shared with the modules')
+    parser.add_argument('--once', action='store_true',
+                        help='poll once, exiting 1 if anything has drifted')
+    args = parser.parse_args()
+
+    if not args.api_key:
+        parser.error('an api key is needed, with --api-key or '
+                     'LINODE_API_KEY')
+    try:
+        desired = load_desired(args.desired)
+    except (IOError, yaml.YAMLError, DesiredStateError) as e:
+        parser.error('{path}: {err}'.format(path=args.desired, err=e))
+
+    module = DriftModule(api_version=args.api_version,
+                         rate_limit=args.rate_limit)
+    api = api_connect(module, args.api_key)
+    stats = ApiStats(api)
+    watcher = DriftWatcher(module, api, desired, args.full_every,
+                           args.concurrency, args.batch)
+
+    while True:
+        started = time.time()
+        requests = stats.report()['requests']
+        try:
+            report = watcher.poll()
+        except DesiredStateError as e:
+            parser.exit(2, '{path}: {err}\n'.format(path=args.desired,
+                                                     err=e))
+        except (linode_api.ApiError, IOError, socket.error) as e:
+            # Reported, and tried again at the next poll
+            report = dict(taken=started, error=error_message(e))
+        report['requests'] = stats.report()['requests'] - requests
+        print(json.dumps(report, sort_keys=True))
+        sys.stdout.flush()
+
+        if args.once:
+            sys.exit(2 if 'error' in report else int(report['drifted']))
+        time.sleep(max(0, args.interval - (time.time() - started)))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,6 +1,11 @@
 #!/usr/bin/python
 # -*- coding: utf-8 -*-
 
+import time
+
+# When this module started importing, for the phase trace
+STARTED = time.time()
+
 try:
     from linode import api as linode_api
     HAS_LINODE = True
@@ -8,6 +13,23 @@ except ImportError as ie:
     HAS_LINODE = False
     LINODE_IMPORT_ERROR = str(ie)
 
+from ansible.module_utils.linode_nodebalancer_common import (
+    Fingerprints,
+    IdCache,
+    NODEBALANCER_FIELDS,
+    Snapshot,
+    TRACER,
+    api_connect,
+    changed_fields,
+    exit_with_plan,
+    handle_api_error,
+    linode_nodebalancer_argument_spec,
+    merge_write,
+    nodebalancer_find,
+    plan_entry,
+    recorded,
+    write_params)
+
 
 DOCUMENTATION = '''
 ---
@@ -60,6 +82,78 @@ options:
         type: integer
         description:
             - Allowed connections per second, per client IP. 0 to disable.
+    id_cache:
+        required: false
+        type: bool
+        default: false
+        description:
+            - Cache the ids of looked up objects in a file on the controller, shared by every fork and keyed on the api key. Later lookups by name / port and protocol then read the single object by id, instead of listing and scanning every object. Stale entries are dropped automatically.
+    id_cache_ttl:
+        required: false
+        type: integer
+        default: 300
+        description:
+            - Seconds that an entry in the id_cache is trusted for.
+    fingerprint:
+        required: false
+        type: bool
+        default: false
+        description:
+            - Record a hash of the task's options, and of the fields of the nodebalancer it leaves, in a file on the controller keyed on the api key. When the task is run again with the same options, only the nodebalancer is read, by id, and if it hasn't drifted the task returns unchanged without any lookups. Records are kept for a day.
+    validate_api_key:
+        required: false
+        type: bool
+        default: false
+        description:
+            - Check the api key with an extra test.echo call before doing anything else. Otherwise the key is checked by the first real call. A key that passed is remembered on the controller for 10 minutes.
+    verify:
+        required: false
+        type: bool
+        default: false
+        description:
+            - After a write, read the object back from the api to build the returned instances. Otherwise they are built from the write response and the submitted values, saving a call per write.
+    retries:
+        required: false
+        type: integer
+        default: 3
+        description:
+            - How many times to retry a request that failed in a way worth retrying, with a jittered exponential backoff between attempts. Rate limited (HTTP 429) requests are always retried. Server errors and dropped connections are only retried for reads, as a write may already have been applied. Errors returned by the api are never retried.
+    rate_limit:
+        required: false
+        type: float
+        default: 0
+        description:
+            - Limit the requests made with this api key to this many per second, shared by every fork on the controller. 0 for no limit.
+    keep_alive:
+        required: false
+        type: bool
+        default: true
+        description:
+            - Send every request of the task over a pool of persistent HTTPS connections, rather than opening a new connection per call. It is not used when an https proxy is set in the environment.
+    api_stats:
+        required: false
+        type: bool
+        default: false
+        description:
+            - Return api_stats in the result, with the number of calls made and their total / p50 / max latency per api action, the retries made, and the bytes received. Useful for finding which tasks spend the api budget.
+    api_version:
+        required: false
+        type: string
+        default: v3
+        choices: ['v3', 'v4']
+        description:
+            - The linode api to use. With v4, api_key is a personal access token, and lookups by name, port and protocol, or node_name are filtered by the api (with X-Filter), rather than listing every object. The v4 api has no payment term, so paymentterm is ignored, and has no batch requests, so batch is ignored.
+    snapshot:
+        required: false
+        type: dict
+        description:
+            - The linode_nodebalancer_snapshot fact set by an earlier linode_nodebalancer* task. The nodebalancer, config and node are looked up in it before the api, which is only called for the objects missing from it. Every module sets linode_nodebalancer_snapshot, updated with what it found and wrote.
+    snapshot_ttl:
+        required: false
+        type: integer
+        default: 300
+        description:
+            - Seconds that a snapshot is trusted for. An older snapshot is ignored.
 '''
 
 EXAMPLES = '''
@@ -72,45 +166,11 @@ EXAMPLES = '''
 '''
 
 
-def handle_api_error(func):
-    """A decorator that catches and api errors from the linode api and
-    returns ansible module fail_json.
-
-    An ansible module instance must be the first argument to the func
-    """
-    def handle(*args, **kwargs):
-        try:
-            return func(*args, **kwargs)
-        except linode_api.ApiError as e:
-            code = e.value[0]['ERRORCODE']
-            err = e.value[0]['ERRORMESSAGE']
-            msg = "FATAL: Code [{code}] - {err}".format(code=code,
-                                                        err=err)
-            return args[0].fail_json(msg=msg)
-    return handle
-
-
-def nodebalancer_find(api, node_balancer_id, name):
-    """Lookup and return a nodebalancer from the api.
-    If node_balancer_id is present, lookup based on that.
-    If not, lookup based on the name
-    """
-
-    if node_balancer_id:
-        return api.nodebalancer_list(NodeBalancerID=node_balancer_id)
-
-    if name:
-        nodebalancers = api.nodebalancer_list()
-        for nb in nodebalancers:
-            if nb['LABEL'] == name:
-                return nb
-
-    return None
-
-
 @handle_api_error
 def linodeNodeBalancers(module, api, state, name, node_balancer_id,
-                        datacenter_id, paymentterm, client_conn_throttle):
+                        datacenter_id, paymentterm, client_conn_throttle,
+                        verify=False, cache=None, snapshot=None,
+                        fingerprints=None):
     """ Ensure the given node balancer is in the correct state.
 
     If it is present and is meant to be, then potentially update it to
@@ -122,51 +182,104 @@ def linodeNodeBalancers(module, api, state, name, node_balancer_id,
     given settings.
 
     If it is correctly absent, then ignore
+
+    The nodebalancer returned after a write is built from what was
+    submitted, rather than read back, unless verify is set.
+
+    In check mode nothing is written, and the nodebalancer returned is the
+    one that would have been.
+
+    If the task's last converge was fingerprinted, and the nodebalancer
+    hasn't drifted since, it is read once by id and nothing else is done.
     """
 
     changed = False
+    plan = []
+
+    if fingerprints:
+        converged = fingerprints.converged(api)
+        if converged:
+            live, result = converged
+            exit_with_plan(module, plan, changed=False, instances=recorded(
+                snapshot, 'nodebalancer', live[0]), **result)
+
+    # Only relabel when a name is given, rather than clearing the label of a
+    # nodebalancer found by id
+    spec = dict(client_conn_throttle=client_conn_throttle)
+    if name:
+        spec['name'] = name
 
-    nodebalancer = nodebalancer_find(api, node_balancer_id, name)
+    nodebalancer = nodebalancer_find(api, node_balancer_id, name, cache,
+                                     snapshot)
     if nodebalancer:
         if state == "present":
-            if nodebalancer['LABEL'] != name or \
-               nodebalancer['CLIENTCONNTHROTTLE'] != client_conn_throttle:
-
-                new = api.nodebalancer_update(
-                    NodeBalancerID=nodebalancer['NODEBALANCERID'],
-                    Label=name,
-                    ClientConnThrottle=client_conn_throttle)
+            params = changed_fields(nodebalancer, spec, NODEBALANCER_FIELDS)
+            if params:
+                plan.append(plan_entry('update', 'nodebalancer', name,
+                                       NODEBALANCER_FIELDS, nodebalancer,
+                                       params))
+                if not module.check_mode:
+                    new = api.nodebalancer_update(
+                        NodeBalancerID=nodebalancer['NODEBALANCERID'],
+                        **params)
                 changed = True
-                nodebalancer = nodebalancer_find(api,
-                                                 new['NodeBalancerID'],
-                                                 name)
+                if verify and not module.check_mode:
+                    nodebalancer = nodebalancer_find(api,
+                                                     new['NodeBalancerID'],
+                                                     name)
+                else:
+                    nodebalancer = merge_write(nodebalancer, params,
+                                               NODEBALANCER_FIELDS)
         elif state == "absent":
-            api.nodebalancer_delete(
-                NodeBalancerId=nodebalancer['NODEBALANCERID']
-            )
+            plan.append(plan_entry('delete', 'nodebalancer',
+                                   nodebalancer['LABEL'],
+                                   NODEBALANCER_FIELDS, nodebalancer))
+            if not module.check_mode:
+                api.nodebalancer_delete(
+                    NodeBalancerId=nodebalancer['NODEBALANCERID']
+                )
+                if snapshot is not None:
+                    snapshot.remove('nodebalancer', nodebalancer)
             nodebalancer = None
             changed = True
 
     else:
         if state == "present":
-            api.nodebalancer_create(DatacenterID=datacenter_id,
-                                    PaymentTerm=paymentterm,
-                                    Label=name)
+            spec['datacenter_id'] = datacenter_id
+            params = write_params(spec, NODEBALANCER_FIELDS)
+            params['PaymentTerm'] = paymentterm
+            plan.append(plan_entry('create', 'nodebalancer', name,
+                                   NODEBALANCER_FIELDS, params=params))
+            new = dict(NodeBalancerID=None)
+            if not module.check_mode:
+                new = api.nodebalancer_create(**params)
             changed = True
+            if verify and not module.check_mode:
+                nodebalancer = nodebalancer_find(api, new['NodeBalancerID'],
+                                                 name)
+            else:
+                nodebalancer = merge_write(
+                    None, params, NODEBALANCER_FIELDS,
+                    NODEBALANCERID=new['NodeBalancerID'])
 
         elif state == "absent":
             pass
 
-    module.exit_json(changed=changed, instances=nodebalancer)
+    if nodebalancer and snapshot is not None and not module.check_mode:
+        snapshot.add('nodebalancer', nodebalancer)
+    if nodebalancer and fingerprints and not module.check_mode:
+        fingerprints.record('nodebalancer', [], [nodebalancer])
+
+    exit_with_plan(module, plan, changed=changed, instances=nodebalancer)
 
 
 # ===========================================
 def main():
+    TRACER.begin('linode_nodebalancer', STARTED)
+    started = time.time()
     module = AnsibleModule(
         argument_spec=dict(
-            api_key=dict(required=False,
-                         aliases=['linode_api_id'],
-                         type='str'),
+            linode_nodebalancer_argument_spec(),
             name=dict(required=False,
                       type='str'),
             node_balancer_id=dict(required=False,
@@ -189,8 +302,9 @@ def main():
         required_one_of=[
             ['name', 'node_balancer_id']
         ],
-        supports_check_mode=False
+        supports_check_mode=True
     )
+    TRACER.add('arguments', started)
 
     if not HAS_LINODE:
         module.fail_json(msg=LINODE_IMPORT_ERROR + " (pip install linode-python)")
@@ -210,15 +324,24 @@ def main():
         except KeyError, e:
             module.fail_json(msg='Unable to load %s' % e.message)
 
-    # setup the auth
-    try:
-        api = linode_api.Api(api_key)
-        api.test_echo()
-    except Exception, e:
-        module.fail_json(msg='%s' % e.value[0]['ERRORMESSAGE'])
+    # setup the api. The key is checked by the first call made with it,
+    # unless validate_api_key asks for it to be checked up front.
+    with TRACER.span('connect'):
+        api = api_connect(module, api_key)
+
+    cache = None
+    if module.params.get('id_cache'):
+        cache = IdCache.for_api_key(api_key, module.params.get('id_cache_ttl'))
+    fingerprints = None
+    if module.params.get('fingerprint'):
+        fingerprints = Fingerprints.for_task(module, api_key,
+                                             'linode_nodebalancer')
+    snapshot = Snapshot.from_module(module).report_to(module)
 
     linodeNodeBalancers(module, api, state, name, node_balancer_id,
-                        datacenter_id, paymentterm, client_conn_throttle)
+                        datacenter_id, paymentterm, client_conn_throttle,
+                        module.params.get('verify'), cache, snapshot,
+                        fingerprints)
 
 
 from ansible.module_utils.basic import *
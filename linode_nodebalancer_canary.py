@@ -0,0 +1,520 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import time
+
+# When this module started importing, for the phase trace
+STARTED = time.time()
+
+try:
+    from linode import api as linode_api
+    HAS_LINODE = True
+except ImportError as ie:
+    HAS_LINODE = False
+    LINODE_IMPORT_ERROR = str(ie)
+
+from ansible.module_utils.linode_nodebalancer_common import (
+    IdCache,
+    NODE_FIELDS,
+    Snapshot,
+    TRACER,
+    api_connect,
+    changed_fields,
+    error_message,
+    exit_with_plan,
+    handle_api_error,
+    linode_nodebalancer_argument_spec,
+    merge_write,
+    nodebalancer_config_find,
+    nodebalancer_find,
+    plan_entry,
+    run_api_calls,
+    wait_for_status)
+
+
+DOCUMENTATION = '''
+---
+module: linode_nodebalancer_canary
+short_description: Shift the traffic of a linode nodebalancer config from one group of nodes to another, in timed steps
+description:
+    - Wrapper around the linode nodebalancer api https://www.linode.com/api/nodebalancer
+    - The config's nodes are read once, and the weights and modes of every node at every step are worked out from them up front. Each step then only sends the updates of the nodes whose weight or mode changes.
+    - Between steps the config's node list is polled, with a single call per poll, until the nodes taking traffic report UP. If they don't, the nodes are put back as they were found.
+    - A group at 0% of the traffic is drained, as a linode node's weight can't go below 1.
+author: Duncan Morris (@duncanmorris)
+requirements:
+    - This module runs locally, not on the remote server(s)
+    - It relies on the linode-python library https://github.com/tjfontaine/linode-python
+options:
+    api_key:
+        required: false
+        type: string
+        description:
+            - Your linode api key, (see https://www.linode.com/docs/platform/api/api-key). You could pass it in directly to the module, or set it as an environment variable (LINODE_API_KEY).
+    name:
+        required: false
+        type: string
+        description:
+            - The name of the NodeBalancer being targeted.
+    node_balancer_id:
+        required: false
+        type: integer
+        description:
+            - The id of the NodeBalancer being targeted. One of name, or node_balancer_id is required. If present, this takes precedence over the name when looking up the nodebalancer.
+    config_id:
+        required: false
+        type: integer
+        description:
+            - The id of the NodeBalancer Config being targeted. If present this takes precedence over the port / protocol when looking up the config.
+    port:
+        required: false
+        type: integer
+        default: 80
+        description:
+            - The port of the config we are targeting.
+    protocol:
+        required: false
+        type: string
+        default: http
+        choices: ['http', 'tcp']
+        description:
+            - The protocol of the config we are targeting.
+    canary:
+        required: true
+        type: list
+        description:
+            - The labels of the nodes to shift the traffic to. They must already be nodes of the config.
+    baseline:
+        required: false
+        type: list
+        description:
+            - The labels of the nodes to shift the traffic from. Defaults to every other node of the config.
+    steps:
+        required: false
+        type: list
+        default: [10, 50, 100]
+        description:
+            - The percentages of the config's traffic to give the canary nodes, in order. Each is a share of the total weight of the accepting nodes.
+    weight:
+        required: false
+        type: integer
+        default: 100
+        description:
+            - The weight of each node in the group with the larger share of a step, 1-255. The other group's weights are scaled down from it, so a higher weight gives finer steps.
+    step_time:
+        required: false
+        type: integer
+        default: 60
+        description:
+            - Seconds to hold each step before checking health and moving on to the next. The last step isn't held.
+    poll_interval:
+        required: false
+        type: float
+        default: 2
+        description:
+            - Seconds between reads of the config's node list while waiting for the nodes to come UP.
+    health_timeout:
+        required: false
+        type: integer
+        default: 300
+        description:
+            - Seconds to wait after a step for the nodes taking traffic to report UP.
+    rollback:
+        required: false
+        type: bool
+        default: true
+        description:
+            - If the nodes taking traffic don't come UP, or a write fails, put every node back to the weight and mode it had before the task, then fail.
+    concurrency:
+        required: false
+        type: integer
+        default: 1
+        description:
+            - The number of node writes of a step to send to the api at once, up to a maximum of 8.
+    batch:
+        required: false
+        type: bool
+        default: false
+        description:
+            - Combine the node writes of each step into api_action=batch requests (up to 25 calls per request), rather than sending one request per write.
+    id_cache:
+        required: false
+        type: bool
+        default: false
+        description:
+            - Cache the ids of looked up objects in a file on the controller, shared by every fork and keyed on the api key. Later lookups by name / port and protocol then read the single object by id, instead of listing and scanning every object. Stale entries are dropped automatically.
+    id_cache_ttl:
+        required: false
+        type: integer
+        default: 300
+        description:
+            - Seconds that an entry in the id_cache is trusted for.
+    validate_api_key:
+        required: false
+        type: bool
+        default: false
+        description:
+            - Check the api key with an extra test.echo call before doing anything else. Otherwise the key is checked by the first real call. A key that passed is remembered on the controller for 10 minutes.
+    retries:
+        required: false
+        type: integer
+        default: 3
+        description:
+            - How many times to retry a request that failed in a way worth retrying, with a jittered exponential backoff between attempts. Rate limited (HTTP 429) requests are always retried. Server errors and dropped connections are only retried for reads, as a write may already have been applied. Errors returned by the api are never retried.
+    rate_limit:
+        required: false
+        type: float
+        default: 0
+        description:
+            - Limit the requests made with this api key to this many per second, shared by every fork on the controller. 0 for no limit.
+    keep_alive:
+        required: false
+        type: bool
+        default: true
+        description:
+            - Send every request of the task over a pool of persistent HTTPS connections, rather than opening a new connection per call. It is not used when an https proxy is set in the environment.
+    api_stats:
+        required: false
+        type: bool
+        default: false
+        description:
+            - Return api_stats in the result, with the number of calls made and their total / p50 / max latency per api action, the retries made, and the bytes received. Useful for finding which tasks spend the api budget.
+    api_version:
+        required: false
+        type: string
+        default: v3
+        choices: ['v3', 'v4']
+        description:
+            - The linode api to use. With v4, api_key is a personal access token, and lookups by name, port and protocol, or node_name are filtered by the api (with X-Filter), rather than listing every object. The v4 api has no batch requests, so batch is ignored.
+    snapshot:
+        required: false
+        type: dict
+        description:
+            - The linode_nodebalancer_snapshot fact set by an earlier linode_nodebalancer* task. The nodebalancer, config and node are looked up in it before the api, which is only called for the objects missing from it. Every module sets linode_nodebalancer_snapshot, updated with what it found and wrote.
+    snapshot_ttl:
+        required: false
+        type: integer
+        default: 300
+        description:
+            - Seconds that a snapshot is trusted for. An older snapshot is ignored.
+'''
+
+EXAMPLES = '''
+- name: Move the traffic of the web nodebalancer onto the new release
+  local_action:
+    module: linode_nodebalancer_canary
+    api_key: "{{ linode_api_key }}"
+    name: "NodeBalancer Name"
+    port: 80
+    protocol: http
+    canary: "{{ groups['web_new'] }}"
+    baseline: "{{ groups['web_old'] }}"
+    steps: [10, 50, 100]
+    step_time: 120
+'''
+
+
+def canary_weights(baseline_count, canary_count, percent, weight):
+    """Return the (baseline, canary) node weights that give the canary
+    nodes percent of the total weight.
+
+    The group with the larger share gets weight, and the other is scaled
+    down from it, to no less than 1. A group with no share gets None, to
+    be drained.
+    """
+    if percent <= 0:
+        return weight, None
+    if percent >= 100:
+        return None, weight
+
+    # canary weight / baseline weight
+    ratio = float(percent * baseline_count) / ((100 - percent) * canary_count)
+    if ratio >= 1:
+        return max(1, int(round(weight / ratio))), weight
+    return weight, max(1, int(round(weight * ratio)))
+
+
+def canary_steps(baseline, canary, steps, weight):
+    """Work out the weight and mode of every node at every step.
+
+    Returns a list of (percent, {label: spec}), where spec is the desired
+    weight and mode of the node. A drained node keeps its weight.
+    """
+    vectors = []
+    for percent in steps:
+        baseline_weight, canary_weight = canary_weights(
+            len(baseline), len(canary), percent, weight)
+        vector = {}
+        for labels, node_weight in ((baseline, baseline_weight),
+                                    (canary, canary_weight)):
+            for label in labels:
+                if node_weight is None:
+                    vector[label] = dict(mode='drain')
+                else:
+                    vector[label] = dict(weight=node_weight, mode='accept')
+        vectors.append((percent, vector))
+    return vectors
+
+
+def reached(nodes, vector):
+    """Whether every node already has the weight and mode of a step"""
+    return not any(changed_fields(nodes[label], spec, NODE_FIELDS)
+                   for label, spec in vector.items())
+
+
+@handle_api_error
+def linodeNodeBalancerCanary(module, api, name, node_balancer_id, config_id,
+                             port, protocol, canary, baseline, steps, weight,
+                             step_time, poll_interval, health_timeout,
+                             rollback=True, concurrency=1, batch=False,
+                             cache=None, snapshot=None):
+    """Shift the config's traffic from the baseline nodes to the canary
+    nodes, one step at a time.
+
+    The node list is read once, and every step's weights are worked out
+    from it. The task picks up after the last step the nodes already
+    match, so a run that was interrupted carries on, and a finished one
+    changes nothing.
+
+    Each step sends only the writes of the nodes that change, then after
+    step_time seconds waits for the accepting nodes to report UP. If they
+    don't, or a write fails, the nodes are put back as they were (unless
+    rollback is false) and the task fails.
+
+    In check mode nothing is written and nothing is waited for, and the
+    plan is that of every remaining step.
+    """
+
+    changed = False
+    plan = []
+
+    nodebalancer = nodebalancer_find(api, node_balancer_id, name, cache,
+                                     snapshot)
+    if not nodebalancer:
+        msg = "FATAL: {nm}/{id} Nodebalancer not found" .format(
+            nm=name, id=node_balancer_id)
+        module.fail_json(msg=msg)
+
+    config = nodebalancer_config_find(api, nodebalancer, config_id,
+                                      port, protocol, cache, snapshot)
+    if not config:
+        msg = "FATAL: {prot}:{port}/{id} Config not found" .format(
+            prot=protocol, port=port, id=config_id)
+        module.fail_json(msg=msg)
+
+    nodes = dict((node['LABEL'], node) for node in
+                 api.nodebalancer_node_list(ConfigID=config['CONFIGID']))
+    original = dict(nodes)
+
+    if baseline is None:
+        baseline = sorted(set(nodes) - set(canary))
+    missing = sorted(set(canary + baseline) - set(nodes))
+    if missing:
+        msg = "FATAL: {nms} not found on the config".format(
+            nms=', '.join(missing))
+        module.fail_json(msg=msg)
+    if set(canary) & set(baseline):
+        msg = "FATAL: {nms} can't be both canary and baseline nodes".format(
+            nms=', '.join(sorted(set(canary) & set(baseline))))
+        module.fail_json(msg=msg)
+    if not canary or not baseline:
+        module.fail_json(msg="FATAL: canary and baseline both need nodes")
+
+    vectors = canary_steps(baseline, canary, [int(step) for step in steps],
+                           weight)
+    done = [i for i, (_, vector) in enumerate(vectors)
+            if reached(nodes, vector)]
+    remaining = vectors[done[-1] + 1:] if done else vectors
+
+    def node_key(label):
+        return '{port}:{prot}:{nm}'.format(port=config['PORT'],
+                                           prot=config['PROTOCOL'],
+                                           nm=label)
+
+    def apply(vector):
+        """Send the writes that bring the nodes to a vector, returning the
+        failures.
+        """
+        writes = []
+        for label in sorted(vector):
+            params = changed_fields(nodes[label], vector[label],
+                                    NODE_FIELDS)
+            if params:
+                plan.append(plan_entry('update', 'node', node_key(label),
+                                       NODE_FIELDS, nodes[label], params))
+                writes.append((label, params))
+        if module.check_mode:
+            outcomes = [(None, None)] * len(writes)
+        else:
+            outcomes = run_api_calls(
+                api, [('nodebalancer_node_update',
+                       dict(write, NodeID=nodes[nm]['NODEID']))
+                      for nm, write in writes], concurrency, batch)
+        failures = []
+        for (label, params), (_, error) in zip(writes, outcomes):
+            if error:
+                failures.append("{nm}: {err}".format(
+                    nm=label, err=error_message(error)))
+            else:
+                nodes[label] = merge_write(nodes[label], params,
+                                           NODE_FIELDS)
+        return failures, len(writes) > len(failures)
+
+    def give_up(msg):
+        rolled_back = False
+        if rollback and changed and not module.check_mode:
+            restore = dict((label, dict(weight=node['WEIGHT'],
+                                        mode=node['MODE']))
+                           for label, node in original.items())
+            failures, _ = apply(restore)
+            rolled_back = not failures
+            if failures:
+                msg += "; rolling back failed - " + '; '.join(failures)
+        module.fail_json(msg=msg, changed=changed, rolled_back=rolled_back,
+                         instances=config,
+                         nodes=[nodes[label] for label in sorted(nodes)])
+
+    for i, (percent, vector) in enumerate(remaining):
+        with TRACER.span('canary_step', percent=percent):
+            failures, wrote = apply(vector)
+        changed = changed or wrote
+        if failures:
+            give_up("FATAL: {n} node writes failed at {pc}% - {errs}".format(
+                n=len(failures), pc=percent, errs='; '.join(failures)))
+        if module.check_mode:
+            continue
+
+        if step_time and i < len(remaining) - 1:
+            with TRACER.span('canary_hold', seconds=step_time):
+                time.sleep(step_time)
+        accepting = [label for label, spec in vector.items()
+                     if spec['mode'] == 'accept']
+        polled, waiting = wait_for_status(api, config, accepting, 'UP',
+                                          poll_interval, health_timeout)
+        for label in nodes:
+            if label in polled:
+                nodes[label] = polled[label]
+        if waiting:
+            give_up("FATAL: {nms} not UP after {timeout}s at {pc}%".format(
+                nms=', '.join(waiting), timeout=health_timeout,
+                pc=percent))
+
+    if snapshot is not None and not module.check_mode:
+        for node in nodes.values():
+            snapshot.add('node', node)
+
+    exit_with_plan(module, plan, changed=changed, instances=config,
+                   nodes=[nodes[label] for label in sorted(nodes)],
+                   steps=[dict(percent=percent, weights=dict(
+                       (label, spec.get('weight') if spec['mode'] == 'accept'
+                        else 0) for label, spec in vector.items()))
+                          for percent, vector in vectors])
+
+
+# ===========================================
+def main():
+    TRACER.begin('linode_nodebalancer_canary', STARTED)
+    started = time.time()
+    module = AnsibleModule(
+        argument_spec=dict(
+            linode_nodebalancer_argument_spec('fingerprint', 'verify'),
+            name=dict(required=False,
+                      type='str'),
+            node_balancer_id=dict(required=False,
+                                  type='int'),
+            config_id=dict(required=False,
+                           type='int'),
+            port=dict(required=False,
+                      default=80,
+                      type='int'),
+            protocol=dict(required=False,
+                          default='http',
+                          choices=['http', 'tcp'],
+                          type='str'),
+            canary=dict(required=True,
+                        type='list'),
+            baseline=dict(required=False,
+                          type='list'),
+            steps=dict(required=False,
+                       default=[10, 50, 100],
+                       type='list'),
+            weight=dict(required=False,
+                        default=100,
+                        type='int'),
+            step_time=dict(required=False,
+                           default=60,
+                           type='int'),
+            poll_interval=dict(required=False,
+                               default=2,
+                               type='float'),
+            health_timeout=dict(required=False,
+                                default=300,
+                                type='int'),
+            rollback=dict(required=False,
+                          default=True,
+                          type='bool'),
+            concurrency=dict(required=False,
+                             default=1,
+                             type='int'),
+            batch=dict(required=False,
+                       default=False,
+                       type='bool'),
+        ),
+        required_one_of=[
+            ['name', 'node_balancer_id'],
+        ],
+        supports_check_mode=True
+    )
+    TRACER.add('arguments', started)
+
+    if not HAS_LINODE:
+        module.fail_json(msg=LINODE_IMPORT_ERROR + " (pip install linode-python)")
+
+    api_key = module.params.get('api_key')
+
+    # Setup the api_key
+    if not api_key:
+        try:
+            api_key = os.environ['LINODE_API_KEY']
+        except KeyError, e:
+            module.fail_json(msg='Unable to load %s' % e.message)
+
+    weight = module.params.get('weight')
+    if not 1 <= weight <= 255:
+        module.fail_json(msg="FATAL: weight must be between 1 and 255")
+    steps = module.params.get('steps')
+    if any(not 0 <= int(step) <= 100 for step in steps):
+        module.fail_json(msg="FATAL: steps must be percentages, 0-100")
+
+    # setup the api. The key is checked by the first call made with it,
+    # unless validate_api_key asks for it to be checked up front.
+    with TRACER.span('connect'):
+        api = api_connect(module, api_key)
+
+    cache = None
+    if module.params.get('id_cache'):
+        cache = IdCache.for_api_key(api_key, module.params.get('id_cache_ttl'))
+    snapshot = Snapshot.from_module(module).report_to(module)
+
+    linodeNodeBalancerCanary(module, api,
+                             module.params.get('name'),
+                             module.params.get('node_balancer_id'),
+                             module.params.get('config_id'),
+                             module.params.get('port'),
+                             module.params.get('protocol'),
+                             module.params.get('canary'),
+                             module.params.get('baseline'),
+                             steps, weight,
+                             module.params.get('step_time'),
+                             module.params.get('poll_interval'),
+                             module.params.get('health_timeout'),
+                             module.params.get('rollback'),
+                             module.params.get('concurrency'),
+                             module.params.get('batch'),
+                             cache, snapshot)
+
+
+from ansible.module_utils.basic import *
+
+if __name__ == '__main__':
+    main()
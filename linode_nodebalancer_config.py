@@ -1,6 +1,11 @@
 #!/usr/bin/python
 # -*- coding: utf-8 -*-
 
+import time
+
+# When this module started importing, for the phase trace
+STARTED = time.time()
+
 try:
     from linode import api as linode_api
     HAS_LINODE = True
@@ -8,6 +13,29 @@ except ImportError as ie:
     HAS_LINODE = False
     LINODE_IMPORT_ERROR = str(ie)
 
+from functools import partial
+
+from ansible.module_utils.linode_nodebalancer_common import (
+    CONFIG_FIELDS,
+    Fingerprints,
+    IdCache,
+    Snapshot,
+    TRACER,
+    api_connect,
+    changed_fields,
+    error_message,
+    exit_with_plan,
+    handle_api_error,
+    linode_nodebalancer_argument_spec,
+    merge_write,
+    nodebalancer_config_find,
+    nodebalancer_find,
+    plan_entry,
+    recorded,
+    run_api_calls,
+    with_defaults,
+    write_params)
+
 
 DOCUMENTATION = '''
 ---
@@ -112,6 +140,101 @@ options:
         type: string
         description:
             - Used in conjuction with 'check_path'. This is the PCRE regular expression to match against the request's result body.                       
+    configs:
+        required: false
+        type: list
+        description:
+            - A list of configs to reconcile against the nodebalancer in a single pass, instead of targeting one config per task. Each item is a dict with the keys port (required), protocol, state, and any of algorithm, stickiness, check, check_interval, check_timeout, check_attempts, check_path and check_body. The keys that are omitted fall back to the module level values, and any other key fails the task. Configs are matched by port and protocol. Mutually exclusive with config_id.
+    purge:
+        required: false
+        type: bool
+        default: false
+        description:
+            - Only used with 'configs'. If true, any config on the nodebalancer that is not listed in 'configs' is deleted, along with its nodes.
+    concurrency:
+        required: false
+        type: integer
+        default: 1
+        description:
+            - Only used with 'configs'. The number of config writes to send to the api at once, up to a maximum of 8. Keep this low enough to stay within your account's api rate limit.
+    batch:
+        required: false
+        type: bool
+        default: false
+        description:
+            - Only used with 'configs'. Combine the config writes into api_action=batch requests (up to 25 calls per request), rather than sending one request per write.
+    id_cache:
+        required: false
+        type: bool
+        default: false
+        description:
+            - Cache the ids of looked up objects in a file on the controller, shared by every fork and keyed on the api key. Later lookups by name / port and protocol then read the single object by id, instead of listing and scanning every object. Stale entries are dropped automatically.
+    id_cache_ttl:
+        required: false
+        type: integer
+        default: 300
+        description:
+            - Seconds that an entry in the id_cache is trusted for.
+    fingerprint:
+        required: false
+        type: bool
+        default: false
+        description:
+            - Record a hash of the task's options, and of the fields of the config it leaves (with configs, of every config on the nodebalancer), in a file on the controller keyed on the api key. When the task is run again with the same options, only the config is read, by id (with configs, the nodebalancer's config list), and if nothing has drifted the task returns unchanged without any lookups. The label of its nodebalancer is not checked again. Records are kept for a day.
+    validate_api_key:
+        required: false
+        type: bool
+        default: false
+        description:
+            - Check the api key with an extra test.echo call before doing anything else. Otherwise the key is checked by the first real call. A key that passed is remembered on the controller for 10 minutes.
+    verify:
+        required: false
+        type: bool
+        default: false
+        description:
+            - After a write, read the object back from the api to build the returned instances. Otherwise they are built from the write response and the submitted values, saving a call per write.
+    retries:
+        required: false
+        type: integer
+        default: 3
+        description:
+            - How many times to retry a request that failed in a way worth retrying, with a jittered exponential backoff between attempts. Rate limited (HTTP 429) requests are always retried. Server errors and dropped connections are only retried for reads, as a write may already have been applied. Errors returned by the api are never retried.
+    rate_limit:
+        required: false
+        type: float
+        default: 0
+        description:
+            - Limit the requests made with this api key to this many per second, shared by every fork on the controller. 0 for no limit.
+    keep_alive:
+        required: false
+        type: bool
+        default: true
+        description:
+            - Send every request of the task over a pool of persistent HTTPS connections, rather than opening a new connection per call. It is not used when an https proxy is set in the environment.
+    api_stats:
+        required: false
+        type: bool
+        default: false
+        description:
+            - Return api_stats in the result, with the number of calls made and their total / p50 / max latency per api action, the retries made, and the bytes received. Useful for finding which tasks spend the api budget.
+    api_version:
+        required: false
+        type: string
+        default: v3
+        choices: ['v3', 'v4']
+        description:
+            - The linode api to use. With v4, api_key is a personal access token, and lookups by name, port and protocol, or node_name are filtered by the api (with X-Filter), rather than listing every object. The v4 api has no payment term, so paymentterm is ignored, and has no batch requests, so batch is ignored.
+    snapshot:
+        required: false
+        type: dict
+        description:
+            - The linode_nodebalancer_snapshot fact set by an earlier linode_nodebalancer* task. The nodebalancer, config and node are looked up in it before the api, which is only called for the objects missing from it. Every module sets linode_nodebalancer_snapshot, updated with what it found and wrote.
+    snapshot_ttl:
+        required: false
+        type: integer
+        default: 300
+        description:
+            - Seconds that a snapshot is trusted for. An older snapshot is ignored.
 '''
 
 EXAMPLES = '''
@@ -123,153 +246,383 @@ EXAMPLES = '''
     port: 80
     protocol: http
     algorithm: roundrobin
-'''
-
-
-def handle_api_error(func):
-    """A decorator that catches and api errors from the linode api and
-    returns ansible module fail_json.
-
-    An ansible module instance must be the first argument to the func
-    """
-    def handle(*args, **kwargs):
-        try:
-            return func(*args, **kwargs)
-        except linode_api.ApiError as e:
-            code = e.value[0]['ERRORCODE']
-            err = e.value[0]['ERRORMESSAGE']
-            msg = "FATAL: Code [{code}] - {err}".format(code=code,
-                                                        err=err)
-            return args[0].fail_json(msg=msg)
-    return handle
-
-
-def nodebalancer_find(api, node_balancer_id, name):
-    """Lookup and return a nodebalancer from the api.
-    If node_balancer_id is present, lookup based on that.
-    If not, lookup based on the name
-    """
-
-    if node_balancer_id:
-        return api.nodebalancer_list(NodeBalancerID=node_balancer_id)
-
-    if name:
-        nodebalancers = api.nodebalancer_list()
-        for nb in nodebalancers:
-            if nb['LABEL'] == name:
-                return nb
-
-    return None
-
-
-def nodebalancer_config_find(api, nodebalancer, config_id, port, protocol):
-    """Lookup and return a nodebalancer config fromt he api.
-    If config_id is present, lookup based on that.
-    If no, lookup based on the port and protocol
-    """
-
-    if config_id:
-        return api.nodebalancer_config_list(
-            NodeBalancerID=nodebalancer['NODEBALANCERID'],
-            ConfigID=config_id
-        )
 
-    all_configs = api.nodebalancer_config_list(
-        NodeBalancerID=nodebalancer['NODEBALANCERID'],
-    )
-
-    for config in all_configs:
-        if config['PORT'] == port and config['PROTOCOL'] == protocol:
-            return config
-
-    return None
+- name: ensure the web ports are the only configs on "NodeBalancer Name"
+  local_action:
+    module: linode_nodebalancer_config
+    api_key: "{{ linode_api_key }}"
+    name: "NodeBalancer Name"
+    purge: true
+    check: http
+    check_path: /health
+    configs:
+      - port: 80
+      - port: 8080
+        algorithm: leastconn
+      - port: 8443
+        protocol: tcp
+        check: connection
+'''
 
 
 @handle_api_error
 def linodeNodeBalancerConfigs(module, api, state, name, node_balancer_id,
                               config_id, port, protocol, algorithm, stickiness,
                               check, check_interval, check_timeout,
-                              check_attempts, check_path, check_body):
+                              check_attempts, check_path, check_body,
+                              verify=False, cache=None, snapshot=None,
+                              fingerprints=None):
+    """Ensure the given config is in the correct state.
 
-    changed = False
+    The config returned after a write is built from what was submitted,
+    rather than read back, unless verify is set.
 
-    nodebalancer = nodebalancer_find(api, node_balancer_id, name)
+    In check mode nothing is written, and the config returned is the one
+    that would have been.
+
+    If the task's last converge was fingerprinted, and the config hasn't
+    drifted since, it is the only object read.
+    """
+
+    changed = False
+    plan = []
+
+    if fingerprints:
+        converged = fingerprints.converged(api)
+        if converged:
+            live, result = converged
+            exit_with_plan(module, plan, changed=False,
+                           instances=recorded(snapshot, 'config', live[0]),
+                           **result)
+
+    nodebalancer = nodebalancer_find(api, node_balancer_id, name, cache,
+                                     snapshot)
     if not nodebalancer:
         msg = "FATAL: {nm}/{id} Nodebalancer not found" .format(
             nm=name, id=node_balancer_id)
         module.fail_json(msg=msg)
 
     config = nodebalancer_config_find(api, nodebalancer, config_id,
-                                      port, protocol)
+                                      port, protocol, cache, snapshot)
+
+    spec = dict(port=port,
+                protocol=protocol,
+                algorithm=algorithm,
+                stickiness=stickiness,
+                check=check,
+                check_interval=check_interval,
+                check_timeout=check_timeout,
+                check_attempts=check_attempts,
+                check_path=check_path,
+                check_body=check_body)
+    key = '{port}:{prot}'.format(port=port, prot=protocol)
 
     if config:
         if state == "present":
-            if config['PORT'] != port \
-               or config['PROTOCOL'] != protocol \
-               or config['ALGORITHM'] != algorithm \
-               or config['STICKINESS'] != stickiness \
-               or config['CHECK'] != check \
-               or config['CHECK_INTERVAL'] != check_interval \
-               or config['CHECK_TIMEOUT'] != check_timeout \
-               or config['CHECK_ATTEMPTS'] != check_attempts \
-               or config['CHECK_PATH'] != str(check_path) \
-               or config['CHECK_BODY'] != str(check_body):
-
-                new = api.nodebalancer_config_update(
-                    ConfigID=config['CONFIGID'],
-                    Port=port,
-                    Protocol=protocol,
-                    Algorithm=algorithm,
-                    Stickiness=stickiness,
-                    check=check,
-                    check_interval=check_interval,
-                    check_timeout=check_timeout,
-                    check_attempts=check_attempts,
-                    check_path=check_path,
-                    check_body=check_body,
-                )
+            params = changed_fields(config, spec, CONFIG_FIELDS)
+            if params:
+                plan.append(plan_entry('update', 'config', key, CONFIG_FIELDS,
+                                       config, params))
+                if not module.check_mode:
+                    new = api.nodebalancer_config_update(
+                        ConfigID=config['CONFIGID'], **params)
                 changed = True
-                config = nodebalancer_config_find(api, nodebalancer,
-                                                  new['ConfigID'],
-                                                  port, protocol)
+                if verify and not module.check_mode:
+                    config = nodebalancer_config_find(api, nodebalancer,
+                                                      new['ConfigID'],
+                                                      port, protocol)
+                else:
+                    config = merge_write(config, params, CONFIG_FIELDS)
         elif state == "absent":
-            api.nodebalancer_config_delete(
-                NodeBalancerID=nodebalancer['NODEBALANCERID'],
-                ConfigID=config['CONFIGID']
-            )
+            plan.append(plan_entry('delete', 'config', key, CONFIG_FIELDS,
+                                   config))
+            if not module.check_mode:
+                api.nodebalancer_config_delete(
+                    NodeBalancerID=nodebalancer['NODEBALANCERID'],
+                    ConfigID=config['CONFIGID']
+                )
+                if snapshot is not None:
+                    snapshot.remove('config', config)
             changed = True
             config = None
     else:
         if state == "present":
-            new = api.nodebalancer_config_create(
-                NodeBalancerID=nodebalancer['NODEBALANCERID'],
-                Port=port,
-                Protocol=protocol,
-                Algorithm=algorithm,
-                Stickiness=stickiness,
-                check=check,
-                check_interval=check_interval,
-                check_timeout=check_timeout,
-                check_attempts=check_attempts,
-                check_path=check_path,
-                check_body=check_body,
-            )
+            params = write_params(spec, CONFIG_FIELDS)
+            plan.append(plan_entry('create', 'config', key, CONFIG_FIELDS,
+                                   params=params))
+            new = dict(ConfigID=None)
+            if not module.check_mode:
+                new = api.nodebalancer_config_create(
+                    NodeBalancerID=nodebalancer['NODEBALANCERID'], **params)
             changed = True
-            config = nodebalancer_config_find(api, nodebalancer,
-                                              new['ConfigID'], port, protocol)
+            if verify and not module.check_mode:
+                config = nodebalancer_config_find(api, nodebalancer,
+                                                  new['ConfigID'],
+                                                  port, protocol)
+            else:
+                config = merge_write(
+                    None, params, CONFIG_FIELDS,
+                    CONFIGID=new['ConfigID'],
+                    NODEBALANCERID=nodebalancer['NODEBALANCERID'])
         elif state == "absent":
             pass
 
-    module.exit_json(changed=changed, instances=config)
+    if config and snapshot is not None and not module.check_mode:
+        snapshot.add('config', config)
+    if config and fingerprints and not module.check_mode:
+        fingerprints.record('config', [nodebalancer], [config])
+
+    exit_with_plan(module, plan, changed=changed, instances=config)
+
+
+# The options of a configs item that are limited to some values
+CONFIG_CHOICES = dict(
+    protocol=['http', 'tcp'],
+    algorithm=['roundrobin', 'leastconn', 'source'],
+    stickiness=['none', 'table', 'http_cookie'],
+    check=['connection', 'http', 'http_body'],
+    state=['present', 'absent'])
+
+
+def check_config_items(module, configs, defaults):
+    """Fail unless every item of configs is a dict with a port, and only
+    the keys and values the module's own options allow.
+    """
+    known = set(defaults) | set(['port', 'state'])
+    for i, item in enumerate(configs):
+        if not isinstance(item, dict):
+            msg = "FATAL: configs item {i} is not a dict".format(i=i)
+            module.fail_json(msg=msg)
+        if item.get('port') is None:
+            msg = "FATAL: configs item {i} needs a port".format(i=i)
+            module.fail_json(msg=msg)
+        unknown = sorted(set(item) - known)
+        if unknown:
+            msg = "FATAL: configs item {i} ({port}) has unknown keys " \
+                  "{keys}, choose from {known}".format(
+                      i=i, port=item['port'], keys=', '.join(unknown),
+                      known=', '.join(sorted(known)))
+            module.fail_json(msg=msg)
+        for option in sorted(CONFIG_CHOICES):
+            value = item.get(option)
+            if value is not None and value not in CONFIG_CHOICES[option]:
+                msg = "FATAL: configs item {i} ({port}) {option} must be " \
+                      "one of {choices}, not {value}".format(
+                          i=i, port=item['port'], option=option,
+                          choices=', '.join(CONFIG_CHOICES[option]),
+                          value=value)
+                module.fail_json(msg=msg)
+
+
+@handle_api_error
+def linodeNodeBalancerConfigsBulk(module, api, state, name, node_balancer_id,
+                                  configs, purge, defaults, concurrency=1,
+                                  batch=False, verify=False, cache=None,
+                                  snapshot=None, fingerprints=None):
+    """Reconcile a whole list of configs against a nodebalancer in one pass.
+
+    The nodebalancer and its config list are each read once. Every
+    desired config is then matched against the live configs by port and
+    protocol, with the options it omits taken from defaults, and created /
+    updated / deleted as required. If purge is set, live configs that are
+    not in the desired list are deleted.
+
+    The writes are sent like those of linodeNodeBalancerNodesBulk: up to
+    concurrency at once, or in api_action=batch requests, with every
+    failure reported together at the end.
+
+    The configs reported are built from what was submitted, unless verify
+    is set, in which case the config list is read once more at the end.
+
+    In check mode nothing is written, and the configs reported are those
+    that would have been.
+
+    If the task's last converge was fingerprinted, and none of the
+    nodebalancer's configs have drifted since, the config list is the only
+    read.
+    """
+
+    changed = False
+    results = []
+    plan = []
+
+    check_config_items(module, configs, defaults)
+
+    if fingerprints:
+        converged = fingerprints.converged(api)
+        if converged:
+            live, result = converged
+            live_configs = dict(
+                ((config['PORT'], config['PROTOCOL']),
+                 recorded(snapshot, 'config', config)) for config in live)
+            results = [dict(r, action='unchanged', config=live_configs.get(
+                (r['port'], r['protocol']))) for r in result['configs']]
+            exit_with_plan(module, plan, changed=False,
+                           instances=result['instances'], configs=results)
+
+    nodebalancer = nodebalancer_find(api, node_balancer_id, name, cache,
+                                     snapshot)
+    if not nodebalancer:
+        msg = "FATAL: {nm}/{id} Nodebalancer not found" .format(
+            nm=name, id=node_balancer_id)
+        module.fail_json(msg=msg)
+    nb_id = nodebalancer['NODEBALANCERID']
+
+    live_configs = dict(
+        ((config['PORT'], config['PROTOCOL']), config) for config in
+        api.nodebalancer_config_list(NodeBalancerID=nb_id))
+
+    def created(result, params, new):
+        result['config'] = merge_write(
+            None, params, CONFIG_FIELDS,
+            CONFIGID=new['ConfigID'], NODEBALANCERID=nb_id)
+
+    def updated(result, params, new):
+        result['config'] = merge_write(result['config'], params,
+                                       CONFIG_FIELDS)
+
+    def plan_key(port, protocol):
+        return '{port}:{prot}'.format(port=port, prot=protocol)
+
+    def delete(result, config):
+        plan.append(plan_entry('delete', 'config',
+                               plan_key(result['port'], result['protocol']),
+                               CONFIG_FIELDS, config))
+        return (result, 'nodebalancer_config_delete',
+                dict(NodeBalancerID=nb_id, ConfigID=config['CONFIGID']),
+                None)
+
+    started = time.time()
+
+    # Each write is (result, api method, kwargs, callback on success).
+    # Deletes are written before creates / updates, so that a port can
+    # change protocol in the same run.
+    deletes, writes = [], []
+    desired_keys = set()
+    for item in configs:
+        spec = with_defaults(dict(
+            defaults, **dict((option, value) for option, value in item.items()
+                             if value is not None)), CONFIG_FIELDS)
+        key = (spec['port'], spec['protocol'])
+        if key in desired_keys:
+            msg = "FATAL: {key} is listed more than once in configs".format(
+                key=plan_key(*key))
+            module.fail_json(msg=msg)
+        desired_keys.add(key)
+
+        config = live_configs.get(key)
+        if (item.get('state') or state) == 'absent':
+            if config:
+                result = dict(port=key[0], protocol=key[1], action='deleted',
+                              config=None)
+                deletes.append(delete(result, config))
+            else:
+                result = dict(port=key[0], protocol=key[1],
+                              action='unchanged', config=None)
+            results.append(result)
+            continue
+
+        if config:
+            params = changed_fields(config, spec, CONFIG_FIELDS)
+            if params:
+                result = dict(port=key[0], protocol=key[1], action='updated',
+                              config=config)
+                plan.append(plan_entry('update', 'config', plan_key(*key),
+                                       CONFIG_FIELDS, config, params))
+                writes.append((result, 'nodebalancer_config_update',
+                               dict(params, ConfigID=config['CONFIGID']),
+                               partial(updated, result, params)))
+            else:
+                result = dict(port=key[0], protocol=key[1],
+                              action='unchanged', config=config)
+        else:
+            params = write_params(spec, CONFIG_FIELDS)
+            result = dict(port=key[0], protocol=key[1], action='created',
+                          config=None)
+            plan.append(plan_entry('create', 'config', plan_key(*key),
+                                   CONFIG_FIELDS, params=params))
+            writes.append((result, 'nodebalancer_config_create',
+                           dict(params, NodeBalancerID=nb_id),
+                           partial(created, result, params)))
+        results.append(result)
+
+    if purge:
+        for key in sorted(set(live_configs) - desired_keys):
+            result = dict(port=key[0], protocol=key[1], action='purged',
+                          config=None)
+            deletes.append(delete(result, live_configs[key]))
+            results.append(result)
+    TRACER.add('diff', started)
+
+    errors = []
+    for stage in (deletes, writes):
+        if module.check_mode:
+            outcomes = [(dict(ConfigID=None), None)] * len(stage)
+        else:
+            outcomes = run_api_calls(
+                api, [(method, kwargs) for _, method, kwargs, _ in stage],
+                concurrency, batch)
+        for (result, _, _, done), (response, error) in zip(stage, outcomes):
+            if error:
+                result['error'] = error_message(error)
+                errors.append("{key}: {err}".format(
+                    key=plan_key(result['port'], result['protocol']),
+                    err=result['error']))
+            else:
+                changed = True
+                if done:
+                    done(response)
+
+    if errors:
+        msg = "FATAL: {n} of {total} config writes failed - {errs}".format(
+            n=len(errors), total=len(deletes) + len(writes),
+            errs='; '.join(errors))
+        module.fail_json(msg=msg, changed=changed, instances=nodebalancer,
+                         configs=results)
+
+    if verify and changed and not module.check_mode:
+        live_configs = dict(
+            ((config['PORT'], config['PROTOCOL']), config) for config in
+            api.nodebalancer_config_list(NodeBalancerID=nb_id))
+        for result in results:
+            if result['config'] is not None:
+                result['config'] = live_configs.get((result['port'],
+                                                     result['protocol']))
+
+    # The nodebalancer's configs as the writes left them
+    left = dict(live_configs)
+    for result in results:
+        if result['config'] is not None:
+            left[(result['port'], result['protocol'])] = result['config']
+        else:
+            left.pop((result['port'], result['protocol']), None)
+
+    # The whole config list was read, so the snapshot gets all of it
+    if snapshot is not None and not module.check_mode:
+        for config in live_configs.values():
+            snapshot.add('config', config)
+        for result in results:
+            key = (result['port'], result['protocol'])
+            if result['config'] is not None:
+                snapshot.add('config', result['config'])
+            elif key in live_configs:
+                snapshot.remove('config', live_configs[key])
+    if fingerprints and not module.check_mode:
+        fingerprints.record('config', [nodebalancer], left.values(),
+                            every=True, instances=nodebalancer,
+                            configs=results)
+
+    exit_with_plan(module, plan, changed=changed, instances=nodebalancer,
+                   configs=results)
 
 
 # ===========================================
 def main():
+    TRACER.begin('linode_nodebalancer_config', STARTED)
+    started = time.time()
     module = AnsibleModule(
         argument_spec=dict(
-            api_key=dict(required=False,
-                         aliases=['linode_api_id'],
-                         type='str'),
+            linode_nodebalancer_argument_spec(),
             name=dict(required=False,
                       type='str'),
             node_balancer_id=dict(required=False,
@@ -312,13 +665,28 @@ def main():
                             type='str'),
             check_body=dict(required=False,
                             type='str'),
+            configs=dict(required=False,
+                         type='list'),
+            purge=dict(required=False,
+                       default=False,
+                       type='bool'),
+            concurrency=dict(required=False,
+                             default=1,
+                             type='int'),
+            batch=dict(required=False,
+                       default=False,
+                       type='bool'),
         ),
         required_one_of=[
             ['name', 'node_balancer_id'],
             ['port', 'protocol', 'config_id'],
         ],
-        supports_check_mode=False
+        mutually_exclusive=[
+            ['configs', 'config_id'],
+        ],
+        supports_check_mode=True
     )
+    TRACER.add('arguments', started)
 
     if not HAS_LINODE:
         module.fail_json(msg=LINODE_IMPORT_ERROR + " (pip install linode-python)")
@@ -338,6 +706,8 @@ def main():
     check_attempts = module.params.get('check_attempts')
     check_path = module.params.get('check_path')
     check_body = module.params.get('check_body')
+    configs = module.params.get('configs')
+    purge = module.params.get('purge')
 
     # Setup the api_key
     if not api_key:
@@ -346,17 +716,44 @@ def main():
         except KeyError, e:
             module.fail_json(msg='Unable to load %s' % e.message)
 
-    # setup the auth
-    try:
-        api = linode_api.Api(api_key)
-        api.test_echo()
-    except Exception, e:
-        module.fail_json(msg='%s' % e.value[0]['ERRORMESSAGE'])
-
-    linodeNodeBalancerConfigs(module, api, state, name, node_balancer_id,
-                              config_id, port, protocol, algorithm, stickiness,
-                              check, check_interval, check_timeout,
-                              check_attempts, check_path, check_body)
+    # setup the api. The key is checked by the first call made with it,
+    # unless validate_api_key asks for it to be checked up front.
+    with TRACER.span('connect'):
+        api = api_connect(module, api_key)
+
+    cache = None
+    if module.params.get('id_cache'):
+        cache = IdCache.for_api_key(api_key, module.params.get('id_cache_ttl'))
+    fingerprints = None
+    if module.params.get('fingerprint'):
+        fingerprints = Fingerprints.for_task(module, api_key,
+                                             'linode_nodebalancer_config')
+    snapshot = Snapshot.from_module(module).report_to(module)
+
+    if configs is not None:
+        defaults = dict(protocol=protocol,
+                        algorithm=algorithm,
+                        stickiness=stickiness,
+                        check=check,
+                        check_interval=check_interval,
+                        check_timeout=check_timeout,
+                        check_attempts=check_attempts,
+                        check_path=check_path,
+                        check_body=check_body)
+        linodeNodeBalancerConfigsBulk(module, api, state, name,
+                                      node_balancer_id, configs, purge,
+                                      defaults,
+                                      module.params.get('concurrency'),
+                                      module.params.get('batch'),
+                                      module.params.get('verify'), cache,
+                                      snapshot, fingerprints)
+    else:
+        linodeNodeBalancerConfigs(module, api, state, name, node_balancer_id,
+                                  config_id, port, protocol, algorithm,
+                                  stickiness, check, check_interval,
+                                  check_timeout, check_attempts, check_path,
+                                  check_body, module.params.get('verify'),
+                                  cache, snapshot, fingerprints)
 
 
 from ansible.module_utils.basic import *
@@ -0,0 +1,312 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import time
+
+# When this module started importing, for the phase trace
+STARTED = time.time()
+
+try:
+    from linode import api as linode_api
+    HAS_LINODE = True
+except ImportError as ie:
+    HAS_LINODE = False
+    LINODE_IMPORT_ERROR = str(ie)
+
+from ansible.module_utils.linode_nodebalancer_common import (
+    CONFIG_FACTS,
+    NODEBALANCER_FACTS,
+    NODE_FACTS,
+    Snapshot,
+    TRACER,
+    api_connect,
+    config_key,
+    facts_of,
+    handle_api_error,
+    linode_nodebalancer_argument_spec,
+    results_or_raise,
+    run_api_calls,
+    traced)
+
+
+DOCUMENTATION = '''
+---
+module: linode_nodebalancer_facts
+short_description: Gather the linode nodebalancers, their configs and their nodes as facts
+description:
+    - Wrapper around the linode nodebalancer api https://www.linode.com/api/nodebalancer
+    - Sets the linode_nodebalancers fact, an index of the account's nodebalancers keyed by label. Each has its configs keyed by "port:protocol", and each config its nodes keyed by label.
+    - The nodebalancers are listed once. The config lists of every matching nodebalancer, and then the node lists of every matching config, are read in parallel.
+    - Also sets the linode_nodebalancer_snapshot fact, with every field of what was read, for the snapshot option of the other linode_nodebalancer* modules.
+author: Duncan Morris (@duncanmorris)
+requirements:
+    - This module runs locally, not on the remote server(s)
+    - It relies on the linode-python library https://github.com/tjfontaine/linode-python
+options:
+    api_key:
+        required: false
+        type: string
+        description:
+            - Your linode api key, (see https://www.linode.com/docs/platform/api/api-key). You could pass it in directly to the module, or set it as an environment variable (LINODE_API_KEY).
+    names:
+        required: false
+        type: list
+        description:
+            - Only gather the nodebalancers with these labels. By default every nodebalancer on the account is gathered.
+    ports:
+        required: false
+        type: list
+        description:
+            - Only gather the configs on these ports. By default every config is gathered.
+    fields:
+        required: false
+        type: list
+        description:
+            - Only return these fields of each object, for instance [address, weight, mode, status]. The id of each object is always returned.
+            - The nodebalancer fields are id, name, datacenter_id, client_conn_throttle, hostname, ipv4 and ipv6. The config fields are id, port, protocol, algorithm, stickiness, check, check_interval, check_timeout, check_attempts, check_path and check_body. The node fields are id, node_name, address, weight, mode and status.
+    configs:
+        required: false
+        type: bool
+        default: true
+        description:
+            - Gather the configs of each nodebalancer. If false, only the nodebalancers are listed, in a single call.
+    nodes:
+        required: false
+        type: bool
+        default: true
+        description:
+            - Gather the nodes of each config.
+    concurrency:
+        required: false
+        type: integer
+        default: 4
+        description:
+            - How many config / node lists to read at once (up to 8).
+    batch:
+        required: false
+        type: bool
+        default: false
+        description:
+            - Read the config / node lists in api_action=batch requests, of up to 25 calls each, rather than on concurrent connections.
+    validate_api_key:
+        required: false
+        type: bool
+        default: false
+        description:
+            - Check the api key with an extra test.echo call before doing anything else. Otherwise the key is checked by the first real call. A key that passed is remembered on the controller for 10 minutes.
+    retries:
+        required: false
+        type: integer
+        default: 3
+        description:
+            - How many times to retry a request that failed in a way worth retrying, with a jittered exponential backoff between attempts. Rate limited (HTTP 429) requests are always retried. Server errors and dropped connections are only retried for reads, as a write may already have been applied. Errors returned by the api are never retried.
+    rate_limit:
+        required: false
+        type: float
+        default: 0
+        description:
+            - Limit the requests made with this api key to this many per second, shared by every fork on the controller. 0 for no limit.
+    keep_alive:
+        required: false
+        type: bool
+        default: true
+        description:
+            - Send every request of the task over a pool of persistent HTTPS connections, rather than opening a new connection per call. It is not used when an https proxy is set in the environment.
+    api_stats:
+        required: false
+        type: bool
+        default: false
+        description:
+            - Return api_stats in the result, with the number of calls made and their total / p50 / max latency per api action, the retries made, and the bytes received. Useful for finding which tasks spend the api budget.
+    api_version:
+        required: false
+        type: string
+        default: v3
+        choices: ['v3', 'v4']
+        description:
+            - The linode api to use. With v4, api_key is a personal access token. The v4 api has no batch requests, so batch is ignored.
+'''
+
+EXAMPLES = '''
+- name: Gather the web nodebalancer's http nodes
+  local_action:
+    module: linode_nodebalancer_facts
+    api_key: "{{ linode_api_key }}"
+    names: ["NodeBalancer Name"]
+    ports: [80]
+    fields: [address, weight, mode, status]
+
+- debug:
+    msg: "{{ linode_nodebalancers['NodeBalancer Name'].configs['80:http'].nodes.web1.status }}"
+
+- name: Drain web1, looking the nodebalancer, config and node up in the facts gathered
+  local_action:
+    module: linode_nodebalancer_node
+    api_key: "{{ linode_api_key }}"
+    snapshot: "{{ linode_nodebalancer_snapshot }}"
+    name: "NodeBalancer Name"
+    port: 80
+    protocol: http
+    node_name: web1
+    mode: drain
+'''
+
+
+@traced('facts_fetch')
+def facts_fetch(api, names=None, ports=None, configs=True, nodes=True,
+                concurrency=4, batch=False, nodebalancers=None):
+    """Read the matching nodebalancers, their configs and their nodes.
+
+    Each level is read with one list call per parent, all of them made
+    together, so fetching takes three rounds of calls however large the
+    account is. Nodebalancers already listed can be passed in, to only
+    read their configs and nodes.
+
+    Returns a list of (nodebalancer, [(config, [node])]).
+    """
+    if nodebalancers is None:
+        nodebalancers = api.nodebalancer_list()
+    nodebalancers = [nb for nb in nodebalancers
+                     if not names or nb['LABEL'] in names]
+    if not configs:
+        return [(nb, []) for nb in nodebalancers]
+
+    config_lists = results_or_raise(run_api_calls(
+        api, [('nodebalancer_config_list',
+               dict(NodeBalancerID=nb['NODEBALANCERID']))
+              for nb in nodebalancers], concurrency, batch))
+    config_lists = [[config for config in config_list
+                     if not ports or config['PORT'] in ports]
+                    for config_list in config_lists]
+
+    matching = [config for config_list in config_lists
+                for config in config_list]
+    node_lists = [[]] * len(matching)
+    if nodes:
+        node_lists = results_or_raise(run_api_calls(
+            api, [('nodebalancer_node_list',
+                   dict(ConfigID=config['CONFIGID']))
+                  for config in matching], concurrency, batch))
+    node_lists = iter(node_lists)
+
+    return [(nb, [(config, next(node_lists)) for config in config_list])
+            for nb, config_list in zip(nodebalancers, config_lists)]
+
+
+def facts_snapshot(tree, taken):
+    """A Snapshot of a fetched tree, taken when fetching started"""
+    snapshot = Snapshot(dict(taken=taken))
+    for nb, config_list in tree:
+        snapshot.add('nodebalancer', nb)
+        for config, node_list in config_list:
+            snapshot.add('config', config)
+            for node in node_list:
+                snapshot.add('node', node)
+    return snapshot
+
+
+def facts_index(tree, fields=None, configs=True, nodes=True):
+    """The compact index of a fetched tree: nodebalancers keyed by label,
+    their configs keyed by "port:protocol", and the configs' nodes keyed by
+    label.
+    """
+    index = {}
+    for nb, config_list in tree:
+        nb_facts = facts_of(nb, NODEBALANCER_FACTS, fields)
+        if configs:
+            nb_facts['configs'] = {}
+        for config, node_list in config_list:
+            config_facts = facts_of(config, CONFIG_FACTS, fields)
+            if nodes:
+                config_facts['nodes'] = dict(
+                    (node['LABEL'], facts_of(node, NODE_FACTS, fields))
+                    for node in node_list)
+            nb_facts['configs'][config_key(config)] = config_facts
+        index[nb['LABEL']] = nb_facts
+    return index
+
+
+@handle_api_error
+def linodeNodeBalancerFacts(module, api, names, ports, fields, configs,
+                            nodes, concurrency=4, batch=False):
+    """Gather the linode_nodebalancers fact"""
+    known = set(name for facts in (NODEBALANCER_FACTS, CONFIG_FACTS,
+                                   NODE_FACTS)
+                for name, _ in facts)
+    unknown = sorted(set(fields or []) - known)
+    if unknown:
+        msg = "FATAL: unknown fields {fields}, choose from {known}".format(
+            fields=', '.join(unknown), known=', '.join(sorted(known)))
+        module.fail_json(msg=msg)
+
+    ports = ports and [int(port) for port in ports]
+    taken = time.time()
+    tree = facts_fetch(api, names, ports, configs, nodes, concurrency, batch)
+    module.exit_json(changed=False, ansible_facts=dict(
+        linode_nodebalancers=facts_index(tree, fields, configs, nodes),
+        linode_nodebalancer_snapshot=facts_snapshot(tree, taken).dump()))
+
+
+# ===========================================
+def main():
+    TRACER.begin('linode_nodebalancer_facts', STARTED)
+    started = time.time()
+    module = AnsibleModule(
+        argument_spec=dict(
+            linode_nodebalancer_argument_spec('id_cache', 'id_cache_ttl',
+                                              'fingerprint', 'verify',
+                                              'snapshot', 'snapshot_ttl'),
+            names=dict(required=False,
+                       type='list'),
+            ports=dict(required=False,
+                       type='list'),
+            fields=dict(required=False,
+                        type='list'),
+            configs=dict(required=False,
+                         default=True,
+                         type='bool'),
+            nodes=dict(required=False,
+                       default=True,
+                       type='bool'),
+            concurrency=dict(required=False,
+                             default=4,
+                             type='int'),
+            batch=dict(required=False,
+                       default=False,
+                       type='bool'),
+        ),
+        supports_check_mode=True
+    )
+    TRACER.add('arguments', started)
+
+    if not HAS_LINODE:
+        module.fail_json(msg=LINODE_IMPORT_ERROR + " (pip install linode-python)")
+
+    api_key = module.params.get('api_key')
+
+    # Setup the api_key
+    if not api_key:
+        try:
+            api_key = os.environ['LINODE_API_KEY']
+        except KeyError, e:
+            module.fail_json(msg='Unable to load %s' % e.message)
+
+    # setup the api. The key is checked by the first call made with it,
+    # unless validate_api_key asks for it to be checked up front.
+    with TRACER.span('connect'):
+        api = api_connect(module, api_key)
+
+    linodeNodeBalancerFacts(module, api,
+                            module.params.get('names'),
+                            module.params.get('ports'),
+                            module.params.get('fields'),
+                            module.params.get('configs'),
+                            module.params.get('nodes'),
+                            module.params.get('concurrency'),
+                            module.params.get('batch'))
+
+
+from ansible.module_utils.basic import *
+
+if __name__ == '__main__':
+    main()
@@ -1,6 +1,11 @@
 #!/usr/bin/python
 # -*- coding: utf-8 -*-
 
+import time
+
+# When this module started importing, for the phase trace
+STARTED = time.time()
+
 try:
     from linode import api as linode_api
     HAS_LINODE = True
@@ -8,6 +13,32 @@ except ImportError as ie:
     HAS_LINODE = False
     LINODE_IMPORT_ERROR = str(ie)
 
+import csv
+import json
+from functools import partial
+
+from ansible.module_utils.linode_nodebalancer_common import (
+    Fingerprints,
+    IdCache,
+    NODE_FIELDS,
+    Snapshot,
+    TRACER,
+    api_connect,
+    changed_fields,
+    error_message,
+    exit_with_plan,
+    handle_api_error,
+    linode_nodebalancer_argument_spec,
+    merge_write,
+    nodebalancer_config_find,
+    nodebalancer_find,
+    nodebalancer_node_find,
+    plan_entry,
+    recorded,
+    run_api_calls,
+    wait_for_status,
+    write_params)
+
 
 DOCUMENTATION = '''
 ---
@@ -89,6 +120,137 @@ options:
         choices: ['accept', 'reject', 'drain']
         description:
             - The connections mode for this node. One of 'accept', 'reject', or 'drain'
+    nodes:
+        required: false
+        type: list
+        description:
+            - A list of nodes to reconcile against the config in a single pass, instead of targeting one node per task. Each item is a dict with the keys node_name (required), address, weight, capacity, mode and state. weight, mode and state fall back to the module level values when omitted. Mutually exclusive with node_name / node_id.
+    purge:
+        required: false
+        type: bool
+        default: false
+        description:
+            - Only used with 'nodes'. If true, any node on the config that is not listed in 'nodes' is deleted.
+    concurrency:
+        required: false
+        type: integer
+        default: 1
+        description:
+            - Only used with 'nodes'. The number of node writes to send to the api at once, up to a maximum of 8. Keep this low enough to stay within your account's api rate limit.
+    batch:
+        required: false
+        type: bool
+        default: false
+        description:
+            - Only used with 'nodes'. Combine the node writes into api_action=batch requests (up to 25 calls per request), rather than sending one request per write.
+    rolling:
+        required: false
+        type: integer
+        default: 0
+        description:
+            - Only used with 'nodes'. Roll the listed nodes through drain and back to their mode, this many at a time, for instance around a deploy. Each batch is set to drain (nodes that don't exist yet are created drained), held for drain_time seconds, then set to its mode. The next batch only starts once the accepting nodes of this one report a status of UP, polled with one node list read per poll_interval. Every listed node is rolled, even if it is already in its mode. Deletes and purges are made before the roll. 0 for no roll.
+    drain_time:
+        required: false
+        type: integer
+        default: 0
+        description:
+            - Only used with 'rolling'. Seconds to hold each batch in drain, letting its connections finish, before setting it back to its mode.
+    poll_interval:
+        required: false
+        type: float
+        default: 2
+        description:
+            - Only used with 'rolling'. Seconds between reads of the config's node list while waiting for a batch to come UP.
+    rolling_timeout:
+        required: false
+        type: integer
+        default: 300
+        description:
+            - Only used with 'rolling'. Seconds to wait for a batch to come UP. If it doesn't, the task fails and the later batches are left as they were.
+    capacity_file:
+        required: false
+        type: path
+        description:
+            - Only used with 'nodes', and fails the task without it. A file of each node's capacity, such as its vCPUs or measured requests per second. A .json file holds {node_name: capacity}, {node_name: {metric: capacity}} or a list of {node_name: ..., metric: capacity}; any other file is read as CSV with a header row naming a node_name column and the metric column.
+            - Once capacities are given, here or with the capacity key of the items in 'nodes', every present node without a weight of its own is weighted in proportion to its capacity. The largest gets no more than the module's weight: every top weight from weight down to half of it is tried, and the one whose rounded weights (no less than 1) best keep the ratios of the capacities is used, so the largest may get less than weight. Only the nodes whose weight changes are written. A capacity in 'nodes' overrides the file's.
+    capacity_metric:
+        required: false
+        type: string
+        default: capacity
+        description:
+            - Only used with 'capacity_file'. The key / column of the capacity in the file, for instance vcpus or rps.
+    id_cache:
+        required: false
+        type: bool
+        default: false
+        description:
+            - Cache the ids of looked up objects in a file on the controller, shared by every fork and keyed on the api key. Later lookups by name / port and protocol then read the single object by id, instead of listing and scanning every object. Stale entries are dropped automatically.
+    id_cache_ttl:
+        required: false
+        type: integer
+        default: 300
+        description:
+            - Seconds that an entry in the id_cache is trusted for.
+    fingerprint:
+        required: false
+        type: bool
+        default: false
+        description:
+            - Record a hash of the task's options, and of the fields of the node it leaves (with nodes, of every node on the config), in a file on the controller keyed on the api key. When the task is run again with the same options, only the node is read, by id (with nodes, the config's node list), and if nothing has drifted the task returns unchanged without any lookups. The labels of the nodebalancer and config are not checked again. Records are kept for a day.
+    validate_api_key:
+        required: false
+        type: bool
+        default: false
+        description:
+            - Check the api key with an extra test.echo call before doing anything else. Otherwise the key is checked by the first real call. A key that passed is remembered on the controller for 10 minutes.
+    verify:
+        required: false
+        type: bool
+        default: false
+        description:
+            - After a write, read the object back from the api to build the returned instances. Otherwise they are built from the write response and the submitted values, saving a call per write.
+    retries:
+        required: false
+        type: integer
+        default: 3
+        description:
+            - How many times to retry a request that failed in a way worth retrying, with a jittered exponential backoff between attempts. Rate limited (HTTP 429) requests are always retried. Server errors and dropped connections are only retried for reads, as a write may already have been applied. Errors returned by the api are never retried.
+    rate_limit:
+        required: false
+        type: float
+        default: 0
+        description:
+            - Limit the requests made with this api key to this many per second, shared by every fork on the controller. 0 for no limit.
+    keep_alive:
+        required: false
+        type: bool
+        default: true
+        description:
+            - Send every request of the task over a pool of persistent HTTPS connections, rather than opening a new connection per call. It is not used when an https proxy is set in the environment.
+    api_stats:
+        required: false
+        type: bool
+        default: false
+        description:
+            - Return api_stats in the result, with the number of calls made and their total / p50 / max latency per api action, the retries made, and the bytes received. Useful for finding which tasks spend the api budget.
+    api_version:
+        required: false
+        type: string
+        default: v3
+        choices: ['v3', 'v4']
+        description:
+            - The linode api to use. With v4, api_key is a personal access token, and lookups by name, port and protocol, or node_name are filtered by the api (with X-Filter), rather than listing every object. The v4 api has no payment term, so paymentterm is ignored, and has no batch requests, so batch is ignored.
+    snapshot:
+        required: false
+        type: dict
+        description:
+            - The linode_nodebalancer_snapshot fact set by an earlier linode_nodebalancer* task. The nodebalancer, config and node are looked up in it before the api, which is only called for the objects missing from it. Every module sets linode_nodebalancer_snapshot, updated with what it found and wrote.
+    snapshot_ttl:
+        required: false
+        type: integer
+        default: 300
+        description:
+            - Seconds that a snapshot is trusted for. An older snapshot is ignored.
 '''
 
 EXAMPLES = '''
@@ -106,103 +268,166 @@ NB: This module could be used as a pre / post task as part of a rolling upgrade
     address: "{{hostvars[inventory_hostname]['ansible_eth0_1']['ipv4']['address']}}:80"
     mode: accept
     weight: 100
-'''
-
-
-def handle_api_error(func):
-    """A decorator that catches and api errors from the linode api and
-    returns ansible module fail_json.
 
-    An ansible module instance must be the first argument to the func
-    """
-    def handle(*args, **kwargs):
-        try:
-            return func(*args, **kwargs)
-        except linode_api.ApiError as e:
-            code = e.value[0]['ERRORCODE']
-            err = e.value[0]['ERRORMESSAGE']
-            msg = "FATAL: Code [{code}] - {err}".format(code=code,
-                                                        err=err)
-            return args[0].fail_json(msg=msg)
-    return handle
-
-
-def nodebalancer_find(api, node_balancer_id, name):
-    """Lookup and return a nodebalancer from the api.
-    If node_balancer_id is present, lookup based on that.
-    If not, lookup based on the name
-    """
+- name: Ensure every web server is a node, and remove any that are not
+  run_once: true
+  local_action:
+    module: linode_nodebalancer_node
+    api_key: "{{ linode_api_key }}"
+    name: "NodeBalancer Name"
+    port: 80
+    protocol: http
+    purge: true
+    nodes: "{{ groups['web'] | map('extract', hostvars) | map(attribute='nb_node') | list }}"
 
-    if node_balancer_id:
-        return api.nodebalancer_list(NodeBalancerID=node_balancer_id)
+- name: Weight the web servers by their measured requests per second
+  run_once: true
+  local_action:
+    module: linode_nodebalancer_node
+    api_key: "{{ linode_api_key }}"
+    name: "NodeBalancer Name"
+    port: 80
+    protocol: http
+    capacity_file: metrics/web.csv
+    capacity_metric: rps
+    nodes: "{{ groups['web'] | map('extract', hostvars) | map(attribute='nb_node') | list }}"
+'''
 
-    if name:
-        nodebalancers = api.nodebalancer_list()
-        for nb in nodebalancers:
-            if nb['LABEL'] == name:
-                return nb
 
-    return None
+def load_capacities(path, metric='capacity'):
+    """Read the capacity of each node from a metrics file.
 
+    A .json file holds either {label: capacity}, {label: {metric:
+    capacity}} or a list of {'node_name': label, metric: capacity}. Any
+    other file is read as CSV, with a header row naming a node_name column
+    and a metric column.
 
-def nodebalancer_config_find(api, nodebalancer, config_id, port, protocol):
-    """Lookup and return a nodebalancer config from the api.
-    If config_id is present, lookup based on that.
-    If not, lookup based on the port and protocol
+    Returns {label: capacity}, leaving out the nodes with no metric.
     """
-
-    if config_id:
-        return api.nodebalancer_config_list(
-            NodeBalancerID=nodebalancer['NODEBALANCERID'],
-            ConfigID=config_id
-        )
-
-    all_configs = api.nodebalancer_config_list(
-        NodeBalancerID=nodebalancer['NODEBALANCERID'],
-    )
-
-    for config in all_configs:
-        if config['PORT'] == port and config['PROTOCOL'] == protocol:
-            return config
-
-    return None
-
-
-def nodebalancer_node_find(api, nodebalancer, config, node_id, node_name):
-    """Lookup and return a node from the given nodebalancer / config
-    If node_id is present lookup based on that.
-    If not, lookup based on the node_name
+    with open(path) as f:
+        if path.lower().endswith('.json'):
+            rows = json.load(f)
+            if isinstance(rows, dict):
+                rows = [dict(value, node_name=label)
+                        if isinstance(value, dict)
+                        else {'node_name': label, metric: value}
+                        for label, value in rows.items()]
+        else:
+            reader = csv.DictReader(f)
+            for column in ('node_name', metric):
+                if column not in (reader.fieldnames or []):
+                    raise ValueError("no {col} column".format(col=column))
+            rows = list(reader)
+
+    capacities = {}
+    for row in rows:
+        if not isinstance(row, dict) or not row.get('node_name'):
+            raise ValueError("every entry needs a node_name")
+        if row.get(metric) not in (None, ''):
+            capacities[row['node_name']] = row[metric]
+    return capacities
+
+
+def capacity_weights(capacities, weight):
+    """Return the weight of each node, {label: weight}, in proportion to
+    its capacity, with the largest no more than weight.
+
+    Rounding to whole weights, and clamping them to linode's 1-255, skews
+    the ratios between the nodes. Every top weight from weight down to half
+    of it is tried, and the one whose weights stray least from the ratios
+    of the capacities is kept (the highest, of those that tie).
     """
+    if not capacities:
+        return {}
+    weight = min(max(weight, 1), 255)
+    top = max(capacities.values())
+    best = None
+    for scale in range(weight, weight // 2, -1):
+        weights = dict((label,
+                        min(max(int(round(scale * capacity / top)), 1), 255))
+                       for label, capacity in capacities.items())
+        # The worst relative error of a node's share against the top node's
+        error = max(abs(weights[label] * top / (capacity * scale) - 1)
+                    for label, capacity in capacities.items())
+        if best is None or error < best[0]:
+            best = (error, weights)
+    return best[1]
+
+
+def nodes_capacity_weights(module, nodes, state, capacities, weight):
+    """The weights of the listed nodes that are sized by their capacity.
+
+    A node's capacity item overrides its entry in capacities (read from
+    the capacity_file), and a node with a weight item isn't sized at all.
+    Every other present node must have a capacity, once any are given.
+    """
+    sized = dict(capacities or {})
+    sized.update((spec['node_name'], spec['capacity']) for spec in nodes
+                 if spec.get('node_name') and
+                 spec.get('capacity') is not None)
+    if capacities is None and not sized:
+        return {}
+
+    labels = [spec['node_name'] for spec in nodes
+              if spec.get('node_name') and spec.get('weight') is None and
+              (spec.get('state') or state) == 'present']
+    missing = sorted(set(labels) - set(sized))
+    if missing:
+        msg = "FATAL: no weight or capacity for {nms}".format(
+            nms=', '.join(missing))
+        module.fail_json(msg=msg)
 
-    if node_id:
-        return api.nodebalancer_node_list(ConfigID=config['CONFIGID'],
-                                          NodeID=node_id)
-
-    all_nodes = api.nodebalancer_node_list(ConfigID=config['CONFIGID'])
-
-    for node in all_nodes:
-        if node['LABEL'] == node_name:
-            return node
+    try:
+        sized = dict((label, float(sized[label])) for label in labels)
+    except (TypeError, ValueError):
+        module.fail_json(msg="FATAL: capacities must be numbers")
+    bad = sorted(label for label, capacity in sized.items() if capacity <= 0)
+    if bad:
+        msg = "FATAL: capacities must be above 0, not for {nms}".format(
+            nms=', '.join(bad))
+        module.fail_json(msg=msg)
 
-    return None
+    return capacity_weights(sized, weight)
 
 
 @handle_api_error
 def linodeNodeBalancerNodes(module, api, state, name, node_balancer_id,
                             config_id, port, protocol, node_id, node_name,
-                            address, weight, mode):
+                            address, weight, mode, verify=False, cache=None,
+                            snapshot=None, fingerprints=None):
+    """Ensure the given node is in the correct state.
+
+    The node returned after a write is built from what was submitted,
+    rather than read back, unless verify is set.
+
+    In check mode nothing is written, and the node returned is the one
+    that would have been.
+
+    If the task's last converge was fingerprinted, and the node hasn't
+    drifted since, it is the only object read.
+    """
 
     debug = {}
     changed = False
-
-    nodebalancer = nodebalancer_find(api, node_balancer_id, name)
+    plan = []
+
+    if fingerprints:
+        converged = fingerprints.converged(api)
+        if converged:
+            live, result = converged
+            exit_with_plan(module, plan, changed=False,
+                           instances=recorded(snapshot, 'node', live[0]),
+                           **result)
+
+    nodebalancer = nodebalancer_find(api, node_balancer_id, name, cache,
+                                     snapshot)
     if not nodebalancer:
         msg = "FATAL: {nm}/{id} Nodebalancer not found" .format(
             nm=name, id=node_balancer_id)
         module.fail_json(msg=msg)
 
     config = nodebalancer_config_find(api, nodebalancer, config_id,
-                                      port, protocol)
+                                      port, protocol, cache, snapshot)
     if not config:
         msg = "FATAL: {prot}:{port}/{id} Config not found" .format(
             prot=protocol, port=port, id=config_id)
@@ -212,56 +437,405 @@ def linodeNodeBalancerNodes(module, api, state, name, node_balancer_id,
     debug['config'] = config
 
     node = nodebalancer_node_find(api, nodebalancer, config, node_id,
-                                  node_name)
+                                  node_name, cache, snapshot)
 
     debug['node'] = node
+    key = '{port}:{prot}:{nm}'.format(port=config['PORT'],
+                                      prot=config['PROTOCOL'],
+                                      nm=node_name or (node and node['LABEL']))
+
+    # A node found by id keeps its label and address unless they are given
+    spec = dict(weight=weight, mode=mode)
+    if node_name:
+        spec['node_name'] = node_name
+    if address:
+        spec['address'] = address
 
     if node:
         if state == "present":
-            if node['LABEL'] != node_name or node['ADDRESS'] != address or \
-               node['WEIGHT'] != weight or node['MODE'] != mode:
-
-                new = api.nodebalancer_node_update(NodeID=node['NODEID'],
-                                                   Label=node_name,
-                                                   Address=address,
-                                                   Weight=weight,
-                                                   Mode=mode)
+            params = changed_fields(node, spec, NODE_FIELDS)
+            if params:
+                plan.append(plan_entry('update', 'node', key, NODE_FIELDS,
+                                       node, params))
+                if not module.check_mode:
+                    new = api.nodebalancer_node_update(NodeID=node['NODEID'],
+                                                       **params)
                 changed = True
-                node = nodebalancer_node_find(api, nodebalancer, config,
-                                              new['NodeID'], node_name)
+                if verify and not module.check_mode:
+                    node = nodebalancer_node_find(api, nodebalancer, config,
+                                                  new['NodeID'], node_name)
+                else:
+                    node = merge_write(node, params, NODE_FIELDS)
         elif state == "absent":
-            api.nodebalancer_node_delete(
-                ConfigID=config['CONFIGID'],
-                NodeID=node['NODEID']
-            )
+            plan.append(plan_entry('delete', 'node', key, NODE_FIELDS, node))
+            if not module.check_mode:
+                api.nodebalancer_node_delete(
+                    ConfigID=config['CONFIGID'],
+                    NodeID=node['NODEID']
+                )
+                if snapshot is not None:
+                    snapshot.remove('node', node)
             changed = True
-            config = None
+            node = None
     else:
         if state == "present":
-            new = api.nodebalancer_node_create(
-                ConfigID=config['CONFIGID'],
-                Label=node_name,
-                Address=address,
-                Weight=weight,
-                Mode=mode
-            )
+            if not node_name:
+                msg = "FATAL: {id} Node not found, a node_name is needed " \
+                      "to create it".format(id=node_id)
+                module.fail_json(msg=msg)
+            if not address:
+                msg = "FATAL: {nm} needs an address to be created".format(
+                    nm=node_name)
+                module.fail_json(msg=msg)
+            params = write_params(spec, NODE_FIELDS)
+            plan.append(plan_entry('create', 'node', key, NODE_FIELDS,
+                                   params=params))
+            new = dict(NodeID=None)
+            if not module.check_mode:
+                new = api.nodebalancer_node_create(
+                    ConfigID=config['CONFIGID'], **params)
             changed = True
-            node = nodebalancer_node_find(api, nodebalancer, config,
-                                          new['NodeID'], node_name)
+            if verify and not module.check_mode:
+                node = nodebalancer_node_find(api, nodebalancer, config,
+                                              new['NodeID'], node_name)
+            else:
+                node = merge_write(
+                    None, params, NODE_FIELDS,
+                    NODEID=new['NodeID'],
+                    CONFIGID=config['CONFIGID'],
+                    NODEBALANCERID=nodebalancer['NODEBALANCERID'])
 
         elif state == "absent":
             pass
 
-    module.exit_json(changed=changed, instances=config, debug=debug)
+    if node and snapshot is not None and not module.check_mode:
+        snapshot.add('node', node)
+    if node and fingerprints and not module.check_mode:
+        fingerprints.record('node', [nodebalancer, config], [node],
+                            debug=debug)
+
+    exit_with_plan(module, plan, changed=changed, instances=node,
+                   debug=debug)
+
+
+@handle_api_error
+def linodeNodeBalancerNodesBulk(module, api, state, name, node_balancer_id,
+                                config_id, port, protocol, nodes, purge,
+                                weight, mode, concurrency=1, batch=False,
+                                verify=False, cache=None, snapshot=None,
+                                fingerprints=None, rolling=0, drain_time=0,
+                                poll_interval=2, rolling_timeout=300,
+                                capacities=None):
+    """Reconcile a whole list of nodes against a config in one pass.
+
+    The nodebalancer, config and the config's node list are each read
+    once. Every desired node is then matched against the live nodes by
+    label and created / updated / deleted as required. If purge is set,
+    live nodes that are not in the desired list are deleted.
+
+    The writes are independent of each other, so up to concurrency of
+    them are sent at once, or if batch is set they are combined into
+    api_action=batch requests. A failed write doesn't stop the others; every
+    failure is reported together at the end.
+
+    The nodes reported are built from what was submitted, unless verify
+    is set, in which case the node list is read once more at the end.
+
+    In check mode nothing is written, and the nodes reported are those
+    that would have been.
+
+    If rolling is set, the desired nodes are instead cycled through drain
+    and back, rolling of them at a time, once any deletes are done. Each
+    batch is held in drain for drain_time seconds, then set to its mode,
+    and the config's node list is polled every poll_interval seconds until
+    the batch's accepting nodes report UP. A batch that isn't UP within
+    rolling_timeout seconds fails the task, leaving the rest untouched.
+
+    If capacities ({label: capacity}) are given, or the items have a
+    capacity, the nodes without a weight of their own are weighted in
+    proportion to their capacities (see capacity_weights). Only the nodes
+    whose weight changes are written.
+
+    If the task's last converge was fingerprinted, and none of the
+    config's nodes have drifted since, the node list is the only read.
+    """
+
+    changed = False
+    results = []
+    plan = []
+
+    if fingerprints:
+        converged = fingerprints.converged(api)
+        if converged:
+            live, result = converged
+            live_nodes = dict((node['LABEL'], recorded(snapshot, 'node', node))
+                              for node in live)
+            results = [dict(node_name=r['node_name'], action='unchanged',
+                            node=live_nodes.get(r['node_name']))
+                       for r in result['nodes']]
+            exit_with_plan(module, plan, changed=False,
+                           instances=result['instances'], nodes=results)
+
+    nodebalancer = nodebalancer_find(api, node_balancer_id, name, cache,
+                                     snapshot)
+    if not nodebalancer:
+        msg = "FATAL: {nm}/{id} Nodebalancer not found" .format(
+            nm=name, id=node_balancer_id)
+        module.fail_json(msg=msg)
+
+    config = nodebalancer_config_find(api, nodebalancer, config_id,
+                                      port, protocol, cache, snapshot)
+    if not config:
+        msg = "FATAL: {prot}:{port}/{id} Config not found" .format(
+            prot=protocol, port=port, id=config_id)
+        module.fail_json(msg=msg)
+
+    live_nodes = dict((node['LABEL'], node) for node in
+                      api.nodebalancer_node_list(ConfigID=config['CONFIGID']))
+
+    def created(result, params, new):
+        result['node'] = merge_write(
+            None, params, NODE_FIELDS,
+            NODEID=new['NodeID'],
+            CONFIGID=config['CONFIGID'],
+            NODEBALANCERID=nodebalancer['NODEBALANCERID'])
+
+    def updated(result, params, new):
+        result['node'] = merge_write(result['node'], params, NODE_FIELDS)
+
+    def node_key(node_name):
+        return '{port}:{prot}:{nm}'.format(port=config['PORT'],
+                                           prot=config['PROTOCOL'],
+                                           nm=node_name)
+
+    def delete(result, node):
+        plan.append(plan_entry('delete', 'node', node_key(node['LABEL']),
+                               NODE_FIELDS, node))
+        return (result, 'nodebalancer_node_delete',
+                dict(ConfigID=config['CONFIGID'], NodeID=node['NODEID']),
+                None)
+
+    sized = nodes_capacity_weights(module, nodes, state, capacities, weight)
+
+    started = time.time()
+
+    # Each write is (result, api method, kwargs, callback on success).
+    # Deletes are written before creates / updates, so that a node can be
+    # replaced by one with the same address in the same run.
+    deletes, writes, rolls = [], [], []
+    desired_names = set()
+    for spec in nodes:
+        node_name = spec.get('node_name')
+        if not node_name:
+            module.fail_json(msg="FATAL: every item in nodes needs a node_name")
+        if node_name in desired_names:
+            msg = "FATAL: {nm} is listed more than once in nodes".format(
+                nm=node_name)
+            module.fail_json(msg=msg)
+        desired_names.add(node_name)
+
+        node_state = spec.get('state') or state
+        node_weight = int(spec.get('weight') or sized.get(node_name) or
+                          weight)
+        node_mode = spec.get('mode') or mode
+        node = live_nodes.get(node_name)
+        address = spec.get('address') or (node and node['ADDRESS'])
+
+        if node_state == 'absent':
+            if node:
+                result = dict(node_name=node_name, action='deleted',
+                              node=None)
+                deletes.append(delete(result, node))
+            else:
+                result = dict(node_name=node_name, action='unchanged',
+                              node=None)
+            results.append(result)
+            continue
+
+        if not address:
+            msg = "FATAL: {nm} needs an address to be created".format(
+                nm=node_name)
+            module.fail_json(msg=msg)
+
+        desired = dict(node_name=node_name, address=address,
+                       weight=node_weight, mode=node_mode)
+        if rolling:
+            # Set to rolled / created once its batch starts
+            result = dict(node_name=node_name, action='unchanged', node=node)
+            rolls.append((result, desired))
+        elif node:
+            params = changed_fields(node, desired, NODE_FIELDS)
+            if params:
+                result = dict(node_name=node_name, action='updated',
+                              node=node)
+                plan.append(plan_entry('update', 'node', node_key(node_name),
+                                       NODE_FIELDS, node, params))
+                writes.append((result, 'nodebalancer_node_update',
+                               dict(params, NodeID=node['NODEID']),
+                               partial(updated, result, params)))
+            else:
+                result = dict(node_name=node_name, action='unchanged',
+                              node=node)
+        else:
+            params = write_params(desired, NODE_FIELDS)
+            result = dict(node_name=node_name, action='created', node=None)
+            plan.append(plan_entry('create', 'node', node_key(node_name),
+                                   NODE_FIELDS, params=params))
+            writes.append((result, 'nodebalancer_node_create',
+                           dict(params, ConfigID=config['CONFIGID']),
+                           partial(created, result, params)))
+        results.append(result)
+
+    if purge:
+        for node_name in sorted(set(live_nodes) - desired_names):
+            result = dict(node_name=node_name, action='purged', node=None)
+            deletes.append(delete(result, live_nodes[node_name]))
+            results.append(result)
+    TRACER.add('diff', started)
+
+    def send(stage):
+        """Send a stage of writes, returning the failures"""
+        if module.check_mode:
+            outcomes = [(dict(NodeID=None), None)] * len(stage)
+        else:
+            outcomes = run_api_calls(
+                api, [(method, kwargs) for _, method, kwargs, _ in stage],
+                concurrency, batch)
+        failures = []
+        for (result, _, _, done), (response, error) in zip(stage, outcomes):
+            if error:
+                result['error'] = error_message(error)
+                failures.append("{nm}: {err}".format(nm=result['node_name'],
+                                                     err=result['error']))
+            elif done:
+                done(response)
+        return failures
+
+    errors, sent = [], 0
+    for stage in (deletes, writes):
+        failures = send(stage)
+        changed = changed or len(failures) < len(stage)
+        errors.extend(failures)
+        sent += len(stage)
+
+    # Each batch of rolled nodes is drained (new ones are created drained),
+    # held there, then set to its mode, and the next batch waits until the
+    # accepting nodes report UP.
+    for start in range(0, len(rolls), rolling or 1):
+        if errors:
+            break
+        batch_rolls = rolls[start:start + rolling]
+        drain, restore = [], []
+        for result, desired in batch_rolls:
+            drained = dict(desired, mode='drain')
+            key = node_key(result['node_name'])
+            result['action'] = 'rolled' if result['node'] else 'created'
+            if result['node']:
+                params = changed_fields(result['node'], drained, NODE_FIELDS)
+                if params:
+                    plan.append(plan_entry('update', 'node', key,
+                                           NODE_FIELDS, result['node'],
+                                           params))
+                    drain.append((result, 'nodebalancer_node_update',
+                                  dict(params,
+                                       NodeID=result['node']['NODEID']),
+                                  partial(updated, result, params)))
+            else:
+                params = write_params(drained, NODE_FIELDS)
+                plan.append(plan_entry('create', 'node', key, NODE_FIELDS,
+                                       params=params))
+                drain.append((result, 'nodebalancer_node_create',
+                              dict(params, ConfigID=config['CONFIGID']),
+                              partial(created, result, params)))
+
+        failures = send(drain)
+        changed = changed or len(failures) < len(drain)
+        errors.extend(failures)
+        sent += len(drain)
+        if errors:
+            break
+        if drain_time and not module.check_mode:
+            with TRACER.span('drain_hold', seconds=drain_time):
+                time.sleep(drain_time)
+
+        for result, desired in batch_rolls:
+            if desired['mode'] != 'drain':
+                params = dict(Mode=desired['mode'])
+                plan.append(plan_entry('update', 'node',
+                                       node_key(result['node_name']),
+                                       NODE_FIELDS, result['node'], params))
+                restore.append((result, 'nodebalancer_node_update',
+                                dict(params, NodeID=result['node']['NODEID']),
+                                partial(updated, result, params)))
+        failures = send(restore)
+        changed = changed or len(failures) < len(restore)
+        errors.extend(failures)
+        sent += len(restore)
+        if errors or module.check_mode:
+            continue
+
+        accepting = [result['node_name'] for result, desired in batch_rolls
+                     if desired['mode'] == 'accept']
+        if accepting:
+            polled, waiting = wait_for_status(api, config, accepting, 'UP',
+                                              poll_interval, rolling_timeout)
+            for result, _ in batch_rolls:
+                result['node'] = polled.get(result['node_name'],
+                                            result['node'])
+            if waiting:
+                msg = "FATAL: {nms} not UP after {timeout}s, stopping " \
+                      "the roll with {n} of {total} nodes rolled".format(
+                          nms=', '.join(waiting), timeout=rolling_timeout,
+                          n=start + len(batch_rolls), total=len(rolls))
+                module.fail_json(msg=msg, changed=changed, instances=config,
+                                 nodes=results)
+
+    if errors:
+        msg = "FATAL: {n} of {total} node writes failed - {errs}".format(
+            n=len(errors), total=sent, errs='; '.join(errors))
+        module.fail_json(msg=msg, changed=changed, instances=config,
+                         nodes=results)
+
+    if verify and changed and not module.check_mode:
+        live_nodes = dict(
+            (node['LABEL'], node) for node in
+            api.nodebalancer_node_list(ConfigID=config['CONFIGID']))
+        for result in results:
+            if result['node'] is not None:
+                result['node'] = live_nodes.get(result['node_name'])
+
+    # The config's nodes as the writes left them
+    left = dict(live_nodes)
+    for result in results:
+        if result['node'] is not None:
+            left[result['node_name']] = result['node']
+        else:
+            left.pop(result['node_name'], None)
+
+    # The whole node list was read, so the snapshot gets all of it
+    if snapshot is not None and not module.check_mode:
+        for node in live_nodes.values():
+            snapshot.add('node', node)
+        for result in results:
+            if result['node'] is not None:
+                snapshot.add('node', result['node'])
+            elif result['node_name'] in live_nodes:
+                snapshot.remove('node', live_nodes[result['node_name']])
+    if fingerprints and not module.check_mode:
+        fingerprints.record('node', [nodebalancer, config], left.values(),
+                            every=True, instances=config, nodes=results)
+
+    exit_with_plan(module, plan, changed=changed, instances=config,
+                   nodes=results)
 
 
 # ===========================================
 def main():
+    TRACER.begin('linode_nodebalancer_node', STARTED)
+    started = time.time()
     module = AnsibleModule(
         argument_spec=dict(
-            api_key=dict(required=False,
-                         aliases=['linode_api_id'],
-                         type='str'),
+            linode_nodebalancer_argument_spec(),
             name=dict(required=False,
                       type='str'),
             node_balancer_id=dict(required=False,
@@ -292,14 +866,47 @@ def main():
                       default='accept',
                       choices=['accept', 'reject', 'drain'],
                       type='str'),
+            nodes=dict(required=False,
+                       type='list'),
+            purge=dict(required=False,
+                       default=False,
+                       type='bool'),
+            concurrency=dict(required=False,
+                             default=1,
+                             type='int'),
+            batch=dict(required=False,
+                       default=False,
+                       type='bool'),
+            rolling=dict(required=False,
+                         default=0,
+                         type='int'),
+            drain_time=dict(required=False,
+                            default=0,
+                            type='int'),
+            poll_interval=dict(required=False,
+                               default=2,
+                               type='float'),
+            rolling_timeout=dict(required=False,
+                                 default=300,
+                                 type='int'),
+            capacity_file=dict(required=False,
+                               type='path'),
+            capacity_metric=dict(required=False,
+                                 default='capacity',
+                                 type='str'),
         ),
         required_one_of=[
             ['name', 'node_balancer_id'],
             ['port', 'protocol', 'config_id'],
-            ['node_name', 'node_id']
+            ['node_name', 'node_id', 'nodes']
+        ],
+        mutually_exclusive=[
+            ['nodes', 'node_name'],
+            ['nodes', 'node_id'],
         ],
-        supports_check_mode=False
+        supports_check_mode=True
     )
+    TRACER.add('arguments', started)
 
     if not HAS_LINODE:
         module.fail_json(msg=LINODE_IMPORT_ERROR + " (pip install linode-python)")
@@ -316,6 +923,13 @@ def main():
     address = module.params.get('address')
     weight = module.params.get('weight')
     mode = module.params.get('mode')
+    nodes = module.params.get('nodes')
+    purge = module.params.get('purge')
+
+    if not 1 <= weight <= 255:
+        module.fail_json(msg="FATAL: weight must be between 1 and 255")
+    if module.params.get('capacity_file') and nodes is None:
+        module.fail_json(msg="FATAL: capacity_file is only used with nodes")
 
     # Setup the api_key
     if not api_key:
@@ -324,16 +938,51 @@ def main():
         except KeyError, e:
             module.fail_json(msg='Unable to load %s' % e.message)
 
-    # setup the auth
-    try:
-        api = linode_api.Api(api_key)
-        api.test_echo()
-    except Exception, e:
-        module.fail_json(msg='%s' % e.value[0]['ERRORMESSAGE'])
+    # setup the api. The key is checked by the first call made with it,
+    # unless validate_api_key asks for it to be checked up front.
+    with TRACER.span('connect'):
+        api = api_connect(module, api_key)
 
-    linodeNodeBalancerNodes(module, api, state, name, node_balancer_id,
-                            config_id, port, protocol, node_id, node_name,
-                            address, weight, mode)
+    capacities = None
+    capacity_file = module.params.get('capacity_file')
+    if capacity_file:
+        try:
+            capacities = load_capacities(capacity_file,
+                                         module.params.get('capacity_metric'))
+        except (IOError, ValueError), e:
+            msg = "FATAL: Unable to read capacities from {path} - {err}"
+            module.fail_json(msg=msg.format(path=capacity_file, err=e))
+
+    cache = None
+    if module.params.get('id_cache'):
+        cache = IdCache.for_api_key(api_key, module.params.get('id_cache_ttl'))
+    # A roll cycles the nodes every time, so is never skipped
+    fingerprints = None
+    if module.params.get('fingerprint') and not module.params.get('rolling'):
+        fingerprints = Fingerprints.for_task(module, api_key,
+                                             'linode_nodebalancer_node',
+                                             capacities=capacities)
+    snapshot = Snapshot.from_module(module).report_to(module)
+
+    if nodes is not None:
+        linodeNodeBalancerNodesBulk(module, api, state, name,
+                                    node_balancer_id, config_id, port,
+                                    protocol, nodes, purge, weight, mode,
+                                    module.params.get('concurrency'),
+                                    module.params.get('batch'),
+                                    module.params.get('verify'), cache,
+                                    snapshot, fingerprints,
+                                    module.params.get('rolling'),
+                                    module.params.get('drain_time'),
+                                    module.params.get('poll_interval'),
+                                    module.params.get('rolling_timeout'),
+                                    capacities)
+    else:
+        linodeNodeBalancerNodes(module, api, state, name, node_balancer_id,
+                                config_id, port, protocol, node_id,
+                                node_name, address, weight, mode,
+                                module.params.get('verify'), cache,
+                                snapshot, fingerprints)
 
 from ansible.module_utils.basic import *
 
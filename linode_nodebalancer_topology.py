@@ -0,0 +1,659 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import time
+
+# When this module started importing, for the phase trace
+STARTED = time.time()
+
+try:
+    from linode import api as linode_api
+    HAS_LINODE = True
+except ImportError as ie:
+    HAS_LINODE = False
+    LINODE_IMPORT_ERROR = str(ie)
+
+from itertools import groupby
+
+from ansible.module_utils.linode_nodebalancer_common import (
+    CONFIG_FIELDS,
+    IdCache,
+    NODEBALANCER_FIELDS,
+    NODE_FIELDS,
+    Snapshot,
+    TRACER,
+    api_connect,
+    changed_fields,
+    error_message,
+    exit_with_plan,
+    handle_api_error,
+    linode_nodebalancer_argument_spec,
+    merge_write,
+    nodebalancer_find,
+    plan_entry,
+    results_or_raise,
+    run_api_calls,
+    traced,
+    with_defaults,
+    write_params)
+
+
+DOCUMENTATION = '''
+---
+module: linode_nodebalancer_topology
+short_description: Ensure a linode nodebalancer, its configs and their nodes match a desired state in a single task
+description:
+    - Wrapper around the linode nodebalancer api https://www.linode.com/api/nodebalancer
+    - The nodebalancer, all of its configs and all of their nodes are read once. The desired state is diffed against them in memory, and only the operations needed to converge are sent to the api.
+author: Duncan Morris (@duncanmorris)
+requirements:
+    - This module runs locally, not on the remote server(s)
+    - It relies on the linode-python library https://github.com/tjfontaine/linode-python
+options:
+    api_key:
+        required: false
+        type: string
+        description:
+            - Your linode api key, (see https://www.linode.com/docs/platform/api/api-key). You could pass it in directly to the module, or set it as an environment variable (LINODE_API_KEY).
+    name:
+        required: false
+        type: string
+        description:
+            - The name of the NodeBalancer being targeted.
+    node_balancer_id:
+        required: false
+        type: integer
+        description:
+            - The id of the NodeBalancer being targeted. One of name, or node_balancer_id is required. If present, this takes precedence over the name when looking up the nodebalancer.
+    state:
+        required: false
+        choices: ['present', 'absent']
+        default: present
+        type: string
+        description:
+            - The desired state of the nodebalancer. If absent, the nodebalancer (and with it every config and node) is deleted.
+    datacenter_id:
+        required: false
+        default: 7 (London)
+        type: integer
+        description:
+            - The id of the linode datacenter the nodebalancer should be in. Only used when the nodebalancer is created.
+    paymentterm:
+        required: false
+        type: integer
+        default: 1
+        choices: [1, 12, 24]
+        description: The payment term for the nodebalancer. One of 1, 12, or 24 months
+    client_conn_throttle:
+        required: false
+        default: 0
+        type: integer
+        description:
+            - Allowed connections per second, per client IP. 0 to disable.
+    configs:
+        required: false
+        type: list
+        default: []
+        description:
+            - The desired configs of the nodebalancer. Each item is a dict taking the same options as the linode_nodebalancer_config module (port, protocol, algorithm, stickiness, check, check_interval, check_timeout, check_attempts, check_path, check_body), plus a 'nodes' list.
+            - Each item in 'nodes' is a dict taking the same options as the linode_nodebalancer_node module (node_name, address, weight, mode).
+            - Configs are matched on port and protocol, nodes on node_name.
+    purge:
+        required: false
+        type: bool
+        default: false
+        description:
+            - If true, configs and nodes that exist on the nodebalancer but are not listed in 'configs' are deleted.
+    batch:
+        required: false
+        type: bool
+        default: false
+        description:
+            - Combine independent calls (the node lists of every config, and each run of config / node writes) into api_action=batch requests, of up to 25 calls each.
+    id_cache:
+        required: false
+        type: bool
+        default: false
+        description:
+            - Cache the ids of looked up objects in a file on the controller, shared by every fork and keyed on the api key. Later lookups by name / port and protocol then read the single object by id, instead of listing and scanning every object. Stale entries are dropped automatically.
+    id_cache_ttl:
+        required: false
+        type: integer
+        default: 300
+        description:
+            - Seconds that an entry in the id_cache is trusted for.
+    validate_api_key:
+        required: false
+        type: bool
+        default: false
+        description:
+            - Check the api key with an extra test.echo call before doing anything else. Otherwise the key is checked by the first real call. A key that passed is remembered on the controller for 10 minutes.
+    verify:
+        required: false
+        type: bool
+        default: false
+        description:
+            - After a write, read the object back from the api to build the returned instances. Otherwise they are built from the write response and the submitted values, saving a call per write.
+    retries:
+        required: false
+        type: integer
+        default: 3
+        description:
+            - How many times to retry a request that failed in a way worth retrying, with a jittered exponential backoff between attempts. Rate limited (HTTP 429) requests are always retried. Server errors and dropped connections are only retried for reads, as a write may already have been applied. Errors returned by the api are never retried.
+    rate_limit:
+        required: false
+        type: float
+        default: 0
+        description:
+            - Limit the requests made with this api key to this many per second, shared by every fork on the controller. 0 for no limit.
+    keep_alive:
+        required: false
+        type: bool
+        default: true
+        description:
+            - Send every request of the task over a pool of persistent HTTPS connections, rather than opening a new connection per call. It is not used when an https proxy is set in the environment.
+    api_stats:
+        required: false
+        type: bool
+        default: false
+        description:
+            - Return api_stats in the result, with the number of calls made and their total / p50 / max latency per api action, the retries made, and the bytes received. Useful for finding which tasks spend the api budget.
+    api_version:
+        required: false
+        type: string
+        default: v3
+        choices: ['v3', 'v4']
+        description:
+            - The linode api to use. With v4, api_key is a personal access token, and lookups by name, port and protocol, or node_name are filtered by the api (with X-Filter), rather than listing every object. The v4 api has no payment term, so paymentterm is ignored, and has no batch requests, so batch is ignored.
+    snapshot:
+        required: false
+        type: dict
+        description:
+            - The linode_nodebalancer_snapshot fact set by an earlier linode_nodebalancer* task. The nodebalancer, config and node are looked up in it before the api, which is only called for the objects missing from it. Every module sets linode_nodebalancer_snapshot, updated with what it found and wrote.
+    snapshot_ttl:
+        required: false
+        type: integer
+        default: 300
+        description:
+            - Seconds that a snapshot is trusted for. An older snapshot is ignored.
+'''
+
+EXAMPLES = '''
+- name: Ensure the whole nodebalancer is setup
+  local_action:
+    module: linode_nodebalancer_topology
+    api_key: "{{ linode_api_key }}"
+    name: "NodeBalancer Name"
+    purge: true
+    configs:
+      - port: 80
+        protocol: http
+        check: http
+        check_path: /health
+        nodes:
+          - node_name: web1
+            address: "192.168.1.1:80"
+          - node_name: web2
+            address: "192.168.1.2:80"
+      - port: 8080
+        protocol: tcp
+        nodes:
+          - node_name: web1
+            address: "192.168.1.1:8080"
+'''
+
+
+def topology_fetch(api, nodebalancer, batch=False):
+    """Read every config and node of a nodebalancer. If batch is set, the
+    node lists of every config are read in api_action=batch requests.
+
+    Returns a dict of (port, protocol) -> (config, {label: node})
+    """
+    tree = {}
+    if not nodebalancer:
+        return tree
+
+    configs = api.nodebalancer_config_list(
+        NodeBalancerID=nodebalancer['NODEBALANCERID'])
+    node_lists = results_or_raise(run_api_calls(
+        api, [('nodebalancer_node_list', dict(ConfigID=config['CONFIGID']))
+              for config in configs], batch=batch))
+
+    for config, nodes in zip(configs, node_lists):
+        tree[(config['PORT'], config['PROTOCOL'])] = (
+            config, dict((node['LABEL'], node) for node in nodes))
+
+    return tree
+
+
+@traced('diff')
+def topology_diff(module, nodebalancer, tree, name, client_conn_throttle,
+                  configs, purge):
+    """Diff the desired configs / nodes against the live tree.
+
+    Returns the ordered list of operations needed to converge. Each
+    operation is a dict with 'action', 'type', 'key' and 'params'.
+    Configs are keyed on (port, protocol), nodes on
+    (port, protocol, node_name).
+    """
+    ops = []
+
+    nodebalancer_spec = dict(name=name,
+                             client_conn_throttle=client_conn_throttle)
+    if nodebalancer is None:
+        ops.append(dict(action='create', type='nodebalancer', key=name,
+                        params=write_params(nodebalancer_spec,
+                                            NODEBALANCER_FIELDS)))
+    else:
+        params = changed_fields(nodebalancer, nodebalancer_spec,
+                                NODEBALANCER_FIELDS)
+        if params:
+            ops.append(dict(action='update', type='nodebalancer', key=name,
+                            params=params))
+
+    config_ops, node_ops, delete_ops = [], [], []
+    desired_configs = set()
+    for config_spec in configs:
+        config_spec = with_defaults(config_spec, CONFIG_FIELDS)
+        key = (config_spec['port'], config_spec['protocol'])
+        if key in desired_configs:
+            msg = "FATAL: {prot}:{port} is listed more than once in " \
+                  "configs".format(prot=key[1], port=key[0])
+            module.fail_json(msg=msg)
+        desired_configs.add(key)
+
+        config, live_nodes = tree.get(key, (None, {}))
+        if config is None:
+            params = write_params(config_spec, CONFIG_FIELDS)
+            config_ops.append(dict(action='create', type='config', key=key,
+                                   params=params))
+        else:
+            params = changed_fields(config, config_spec, CONFIG_FIELDS)
+            if params:
+                config_ops.append(dict(action='update', type='config',
+                                       key=key, params=params))
+
+        desired_nodes = set()
+        for node_spec in config_spec.get('nodes') or []:
+            node_spec = with_defaults(node_spec, NODE_FIELDS)
+            node_name = node_spec['node_name']
+            if not node_name:
+                msg = "FATAL: every node of {prot}:{port} needs a " \
+                      "node_name".format(prot=key[1], port=key[0])
+                module.fail_json(msg=msg)
+            desired_nodes.add(node_name)
+
+            node = live_nodes.get(node_name)
+            node_key = key + (node_name,)
+            if node is None:
+                if not node_spec['address']:
+                    msg = "FATAL: {nm} needs an address to be " \
+                          "created".format(nm=node_name)
+                    module.fail_json(msg=msg)
+                params = write_params(node_spec, NODE_FIELDS)
+                node_ops.append(dict(action='create', type='node',
+                                     key=node_key, params=params))
+            else:
+                if not node_spec['address']:
+                    node_spec['address'] = node['ADDRESS']
+                params = changed_fields(node, node_spec, NODE_FIELDS)
+                if params:
+                    node_ops.append(dict(action='update', type='node',
+                                         key=node_key, params=params))
+
+        if purge:
+            for node_name in sorted(set(live_nodes) - desired_nodes):
+                delete_ops.append(dict(action='delete', type='node',
+                                       key=key + (node_name,), params={}))
+
+    if purge:
+        for key in sorted(set(tree) - desired_configs):
+            delete_ops.append(dict(action='delete', type='config', key=key,
+                                   params={}))
+
+    # Deletes go before creates, so that a node can be replaced by one
+    # with the same address, and a port can change protocol, in the same
+    # run. Deleting a config deletes its nodes with it.
+    node_deletes = [op for op in delete_ops if op['type'] == 'node']
+    config_deletes = [op for op in delete_ops if op['type'] == 'config']
+    return ops + node_deletes + config_deletes + config_ops + node_ops
+
+
+def op_call(op, nodebalancer, tree):
+    """Return the (api method name, kwargs) call for a config / node
+    operation from topology_diff.
+    """
+    if op['type'] == 'config':
+        if op['action'] == 'create':
+            return ('nodebalancer_config_create',
+                    dict(op['params'],
+                         NodeBalancerID=nodebalancer['NODEBALANCERID']))
+        config = tree[op['key']][0]
+        if op['action'] == 'update':
+            return ('nodebalancer_config_update',
+                    dict(op['params'], ConfigID=config['CONFIGID']))
+        return ('nodebalancer_config_delete',
+                dict(NodeBalancerID=nodebalancer['NODEBALANCERID'],
+                     ConfigID=config['CONFIGID']))
+
+    config, nodes = tree[op['key'][:2]]
+    if op['action'] == 'create':
+        return ('nodebalancer_node_create',
+                dict(op['params'], ConfigID=config['CONFIGID']))
+    node = nodes[op['key'][2]]
+    if op['action'] == 'update':
+        return ('nodebalancer_node_update',
+                dict(op['params'], NodeID=node['NODEID']))
+    return ('nodebalancer_node_delete',
+            dict(ConfigID=config['CONFIGID'], NodeID=node['NODEID']))
+
+
+def op_applied(op, new, nodebalancer, tree):
+    """Update the tree in place from a config / node operation that has
+    been written, given the write response.
+    """
+    if op['type'] == 'config':
+        if op['action'] == 'delete':
+            del tree[op['key']]
+        elif op['action'] == 'create':
+            tree[op['key']] = (merge_write(
+                None, op['params'], CONFIG_FIELDS,
+                CONFIGID=new['ConfigID'],
+                NODEBALANCERID=nodebalancer['NODEBALANCERID']), {})
+        else:
+            config, nodes = tree[op['key']]
+            tree[op['key']] = (merge_write(config, op['params'],
+                                           CONFIG_FIELDS), nodes)
+        return
+
+    config, nodes = tree[op['key'][:2]]
+    node_name = op['key'][2]
+    if op['action'] == 'delete':
+        del nodes[node_name]
+    elif op['action'] == 'create':
+        nodes[node_name] = merge_write(
+            None, op['params'], NODE_FIELDS,
+            NODEID=new['NodeID'],
+            CONFIGID=config['CONFIGID'],
+            NODEBALANCERID=nodebalancer['NODEBALANCERID'])
+    else:
+        nodes[node_name] = merge_write(nodes[node_name], op['params'],
+                                       NODE_FIELDS)
+
+
+def op_plan(op, nodebalancer, tree, datacenter_id):
+    """The plan entry of an operation from topology_diff, given the live
+    tree it was diffed against.
+    """
+    key = describe(op)['key']
+    if op['type'] == 'nodebalancer':
+        params = op['params']
+        if op['action'] == 'create':
+            params = dict(params, DatacenterID=datacenter_id)
+        return plan_entry(op['action'], 'nodebalancer', key,
+                          NODEBALANCER_FIELDS, nodebalancer, params)
+
+    if op['type'] == 'config':
+        config = tree.get(op['key'], (None, {}))[0]
+        return plan_entry(op['action'], 'config', key, CONFIG_FIELDS,
+                          config, op['params'])
+
+    node = tree.get(op['key'][:2], (None, {}))[1].get(op['key'][2])
+    return plan_entry(op['action'], 'node', key, NODE_FIELDS, node,
+                      op['params'])
+
+
+def topology_apply(api, nodebalancer, tree, ops, datacenter_id, paymentterm,
+                   batch=False, check_mode=False):
+    """Apply the operations from topology_diff, in order.
+
+    Consecutive config / node operations of the same kind don't depend on
+    each other, so each run of them is sent together, in api_action=batch
+    requests if batch is set.
+
+    The live tree is updated in place from the submitted parameters, so
+    that it describes the converged state without being re-read. In check
+    mode nothing is written, but the tree is still updated, to describe
+    the state that would have been.
+
+    A failed write doesn't stop the rest of its run, but the later runs
+    may depend on it, so they aren't sent.
+
+    Returns (nodebalancer, the operations applied, the failures).
+    """
+    applied = []
+    for op in ops:
+        if op['type'] != 'nodebalancer':
+            continue
+        if op['action'] == 'create':
+            new = dict(NodeBalancerID=None)
+            if not check_mode:
+                new = api.nodebalancer_create(DatacenterID=datacenter_id,
+                                              PaymentTerm=paymentterm,
+                                              **op['params'])
+            nodebalancer = merge_write(
+                None, dict(op['params'], DatacenterID=datacenter_id),
+                NODEBALANCER_FIELDS,
+                NODEBALANCERID=new['NodeBalancerID'])
+            applied.append(op)
+        else:
+            if not check_mode:
+                api.nodebalancer_update(
+                    NodeBalancerID=nodebalancer['NODEBALANCERID'],
+                    **op['params'])
+            nodebalancer = merge_write(nodebalancer, op['params'],
+                                       NODEBALANCER_FIELDS)
+            applied.append(op)
+
+    failures = []
+    stages = groupby([op for op in ops if op['type'] != 'nodebalancer'],
+                     key=lambda op: (op['type'], op['action'] == 'delete'))
+    for _, stage in stages:
+        stage = list(stage)
+        if check_mode:
+            outcomes = [(dict(ConfigID=None, NodeID=None), None)] * len(stage)
+        else:
+            outcomes = run_api_calls(api, [op_call(op, nodebalancer, tree)
+                                           for op in stage], batch=batch)
+        for op, (new, error) in zip(stage, outcomes):
+            if error:
+                failures.append("{key}: {err}".format(
+                    key=describe(op)['key'], err=error_message(error)))
+            else:
+                op_applied(op, new, nodebalancer, tree)
+                applied.append(op)
+        if failures:
+            break
+
+    return nodebalancer, applied, failures
+
+
+def topology_instances(nodebalancer, tree):
+    """Flatten the nodebalancer and its tree into a nested result"""
+    if nodebalancer is None:
+        return None
+
+    instances = dict(nodebalancer)
+    instances['CONFIGS'] = []
+    for key in sorted(tree):
+        config, nodes = tree[key]
+        config = dict(config)
+        config['NODES'] = [nodes[label] for label in sorted(nodes)]
+        instances['CONFIGS'].append(config)
+    return instances
+
+
+def describe(op):
+    """A short, readable description of an operation for the results"""
+    return dict(action=op['action'], type=op['type'],
+                key=':'.join(str(k) for k in op['key'])
+                if isinstance(op['key'], tuple) else op['key'],
+                params=op['params'])
+
+
+@handle_api_error
+def linodeNodeBalancerTopology(module, api, state, name, node_balancer_id,
+                               datacenter_id, paymentterm,
+                               client_conn_throttle, configs, purge,
+                               batch=False, verify=False, cache=None,
+                               snapshot=None):
+    """Ensure the nodebalancer, its configs and their nodes match the
+    desired state.
+
+    The live tree is fetched once, diffed against the desired state, and
+    then only the resulting operations are applied. The tree returned is
+    built from what was submitted, unless verify is set, in which case it
+    is fetched again after the writes.
+
+    In check mode only the reads are made, and the tree returned is the
+    one that would have been.
+
+    The whole tree is always read from the api, so as to know what to
+    purge, and replaces the nodebalancer's entry in the snapshot.
+    """
+
+    nodebalancer = nodebalancer_find(api, node_balancer_id, name, cache,
+                                     snapshot)
+
+    if state == "absent":
+        if nodebalancer:
+            if not module.check_mode:
+                api.nodebalancer_delete(
+                    NodeBalancerID=nodebalancer['NODEBALANCERID'])
+                if snapshot is not None:
+                    snapshot.remove('nodebalancer', nodebalancer)
+            exit_with_plan(module,
+                           [plan_entry('delete', 'nodebalancer',
+                                       nodebalancer['LABEL'],
+                                       NODEBALANCER_FIELDS, nodebalancer)],
+                           changed=True, instances=None,
+                           operations=[dict(action='delete',
+                                            type='nodebalancer',
+                                            key=nodebalancer['LABEL'],
+                                            params={})])
+        exit_with_plan(module, [], changed=False, instances=None,
+                       operations=[])
+
+    if not name:
+        name = nodebalancer and nodebalancer['LABEL']
+    if not name:
+        msg = "FATAL: {id} Nodebalancer not found, and a name is needed " \
+              "to create it".format(id=node_balancer_id)
+        module.fail_json(msg=msg)
+
+    tree = topology_fetch(api, nodebalancer, batch)
+    ops = topology_diff(module, nodebalancer, tree, name,
+                        client_conn_throttle, configs, purge)
+    plan = [op_plan(op, nodebalancer, tree, datacenter_id) for op in ops]
+    nodebalancer, applied, failures = topology_apply(
+        api, nodebalancer, tree, ops, datacenter_id, paymentterm, batch,
+        module.check_mode)
+    if failures:
+        msg = "FATAL: {n} of {total} writes failed, the rest not sent - " \
+              "{errs}".format(n=len(failures), total=len(ops),
+                              errs='; '.join(failures))
+        module.fail_json(msg=msg, changed=bool(applied),
+                         instances=topology_instances(nodebalancer, tree),
+                         operations=[describe(op) for op in applied])
+    if verify and ops and not module.check_mode:
+        nodebalancer = nodebalancer_find(api, nodebalancer['NODEBALANCERID'],
+                                         None)
+        tree = topology_fetch(api, nodebalancer, batch)
+
+    if snapshot is not None and not module.check_mode:
+        snapshot.remove('nodebalancer', nodebalancer)
+        snapshot.add('nodebalancer', nodebalancer)
+        for key in sorted(tree):
+            config, nodes = tree[key]
+            snapshot.add('config', config)
+            for node in nodes.values():
+                snapshot.add('node', node)
+
+    exit_with_plan(module, plan, changed=bool(ops),
+                   instances=topology_instances(nodebalancer, tree),
+                   operations=[describe(op) for op in ops])
+
+
+# ===========================================
+def main():
+    TRACER.begin('linode_nodebalancer_topology', STARTED)
+    started = time.time()
+    module = AnsibleModule(
+        argument_spec=dict(
+            linode_nodebalancer_argument_spec('fingerprint'),
+            name=dict(required=False,
+                      type='str'),
+            node_balancer_id=dict(required=False,
+                                  type='int'),
+            state=dict(required=False,
+                       default='present',
+                       choices=['present', 'absent'],
+                       type='str'),
+            datacenter_id=dict(required=False,
+                               default=7,
+                               type='int'),
+            paymentterm=dict(required=False,
+                             default=1,
+                             choices=[1, 12, 24],
+                             type='int'),
+            client_conn_throttle=dict(required=False,
+                                      default=0,
+                                      type='int'),
+            configs=dict(required=False,
+                         default=[],
+                         type='list'),
+            purge=dict(required=False,
+                       default=False,
+                       type='bool'),
+            batch=dict(required=False,
+                       default=False,
+                       type='bool'),
+        ),
+        required_one_of=[
+            ['name', 'node_balancer_id']
+        ],
+        supports_check_mode=True
+    )
+    TRACER.add('arguments', started)
+
+    if not HAS_LINODE:
+        module.fail_json(msg=LINODE_IMPORT_ERROR + " (pip install linode-python)")
+
+    api_key = module.params.get('api_key')
+    name = module.params.get('name')
+    node_balancer_id = module.params.get('node_balancer_id')
+    state = module.params.get('state')
+    datacenter_id = module.params.get('datacenter_id')
+    paymentterm = module.params.get('paymentterm')
+    client_conn_throttle = module.params.get('client_conn_throttle')
+    configs = module.params.get('configs')
+    purge = module.params.get('purge')
+
+    # Setup the api_key
+    if not api_key:
+        try:
+            api_key = os.environ['LINODE_API_KEY']
+        except KeyError, e:
+            module.fail_json(msg='Unable to load %s' % e.message)
+
+    # setup the api. The key is checked by the first call made with it,
+    # unless validate_api_key asks for it to be checked up front.
+    with TRACER.span('connect'):
+        api = api_connect(module, api_key)
+
+    cache = None
+    if module.params.get('id_cache'):
+        cache = IdCache.for_api_key(api_key, module.params.get('id_cache_ttl'))
+    snapshot = Snapshot.from_module(module).report_to(module)
+
+    linodeNodeBalancerTopology(module, api, state, name, node_balancer_id,
+                               datacenter_id, paymentterm,
+                               client_conn_throttle, configs, purge,
+                               module.params.get('batch'),
+                               module.params.get('verify'), cache, snapshot)
+
+
+from ansible.module_utils.basic import *
+
+if __name__ == '__main__':
+    main()
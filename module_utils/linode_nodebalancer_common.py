@@ -0,0 +1,1816 @@
+# -*- coding: utf-8 -*-
+"""Helpers shared by the linode_nodebalancer* modules.
+
+To make these importable, point the module_utils setting of your
+ansible.cfg at this directory (see the README).
+"""
+
+from __future__ import absolute_import
+
+import atexit
+import errno
+import fcntl
+import hashlib
+import io
+import json
+import os
+import random
+import socket
+import tempfile
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from functools import partial, wraps
+
+try:
+    from linode import api as linode_api
+except ImportError:
+    # Each module reports the missing library itself
+    linode_api = None
+
+try:
+    import httplib
+    from urllib import getproxies, urlencode
+    from urllib2 import HTTPError, Request, urlopen
+    from urlparse import urlparse
+except ImportError:
+    import http.client as httplib
+    from urllib.error import HTTPError
+    from urllib.parse import urlencode, urlparse
+    from urllib.request import Request, getproxies, urlopen
+
+try:
+    string_types = basestring
+except NameError:
+    string_types = str
+
+
+# linode api error codes
+BAD_REQUEST = 1
+AUTHENTICATION_FAILED = 4
+NOT_FOUND = 5
+
+# Seconds that a successful validate_api_key is remembered for
+API_KEY_VALID_FOR = 600
+
+# Upper bound on the number of api calls made at once by run_concurrently
+MAX_CONCURRENCY = 8
+
+# Most api calls sent in a single api_action=batch request
+BATCH_SIZE = 25
+
+# HTTP statuses worth retrying. A 429 means the request was rejected
+# before it was acted on, so it is the only one retried for writes.
+TOO_MANY_REQUESTS = 429
+RETRYABLE_STATUSES = (TOO_MANY_REQUESTS, 500, 502, 503, 504)
+
+# api actions that only read, and so are always safe to retry
+READ_ACTIONS = ('nodebalancer.list', 'nodebalancer.config.list',
+                'nodebalancer.node.list', 'test.echo')
+
+# Set to a directory to have each module run write a JSON lines trace of
+# its phases there
+TRACE_ENV = 'LINODE_NODEBALANCER_TRACE'
+
+# Backoff between retries is a random wait of up to
+# BACKOFF_BASE * 2 ** attempt seconds, capped at BACKOFF_MAX
+BACKOFF_BASE = 1.0
+BACKOFF_MAX = 30.0
+
+# Seconds to wait on the api before giving up on a request
+HTTP_TIMEOUT = 60
+
+# The api v4 backend (see V4Api), its largest page, and the v3 error codes
+# its HTTP error statuses are reported as. Any other status is reported as
+# its own code, which are all above the v3 codes.
+V4_API_URL = 'https://api.linode.com/v4'
+V4_PAGE_SIZE = 500
+V4_ERROR_CODES = {400: BAD_REQUEST, 401: AUTHENTICATION_FAILED,
+                  403: AUTHENTICATION_FAILED, 404: NOT_FOUND}
+HTTP_STATUS_CODES = 100
+
+# api v3 datacenter ids, and the api v4 regions they are
+V4_REGIONS = {2: 'us-central', 3: 'us-west', 4: 'us-southeast',
+              6: 'us-east', 7: 'eu-west', 8: 'ap-northeast-1a',
+              9: 'ap-south', 10: 'eu-central', 11: 'ap-northeast',
+              14: 'ap-west', 15: 'ca-central', 16: 'ap-southeast'}
+
+# The api v4 fields of the options, where their names differ
+V4_FIELD_NAMES = {'name': 'label', 'node_name': 'label',
+                  'datacenter_id': 'region'}
+
+# (option name, api list field, api write parameter, default)
+NODEBALANCER_FIELDS = [
+    ('name', 'LABEL', 'Label', None),
+    ('datacenter_id', 'DATACENTERID', 'DatacenterID', 7),
+    ('client_conn_throttle', 'CLIENTCONNTHROTTLE', 'ClientConnThrottle', 0),
+]
+
+CONFIG_FIELDS = [
+    ('port', 'PORT', 'Port', 80),
+    ('protocol', 'PROTOCOL', 'Protocol', 'http'),
+    ('algorithm', 'ALGORITHM', 'Algorithm', 'roundrobin'),
+    ('stickiness', 'STICKINESS', 'Stickiness', 'none'),
+    ('check', 'CHECK', 'check', 'connection'),
+    ('check_interval', 'CHECK_INTERVAL', 'check_interval', 5),
+    ('check_timeout', 'CHECK_TIMEOUT', 'check_timeout', 3),
+    ('check_attempts', 'CHECK_ATTEMPTS', 'check_attempts', 2),
+    ('check_path', 'CHECK_PATH', 'check_path', None),
+    ('check_body', 'CHECK_BODY', 'check_body', None),
+]
+
+NODE_FIELDS = [
+    ('node_name', 'LABEL', 'Label', None),
+    ('address', 'ADDRESS', 'Address', None),
+    ('weight', 'WEIGHT', 'Weight', 100),
+    ('mode', 'MODE', 'Mode', 'accept'),
+]
+
+# (fact name, api list field) of each kind of object, in the index of the
+# linode_nodebalancers fact, and of a Snapshot
+NODEBALANCER_FACTS = [('id', 'NODEBALANCERID')] + \
+    [(option, field) for option, field, _, _ in NODEBALANCER_FIELDS] + \
+    [('hostname', 'HOSTNAME'), ('ipv4', 'ADDRESS4'), ('ipv6', 'ADDRESS6')]
+
+CONFIG_FACTS = [('id', 'CONFIGID')] + \
+    [(option, field) for option, field, _, _ in CONFIG_FIELDS]
+
+NODE_FACTS = [('id', 'NODEID')] + \
+    [(option, field) for option, field, _, _ in NODE_FIELDS] + \
+    [('status', 'STATUS')]
+
+# Seconds that a snapshot passed from an earlier task is trusted for
+SNAPSHOT_TTL = 300
+
+# Seconds that the fingerprint of a task's last converge is kept for
+FINGERPRINT_TTL = 86400
+
+# The options that change how a task reaches its desired state, rather than
+# what it is, left out of the task's fingerprint
+CONNECTION_OPTIONS = ('api_key', 'id_cache', 'id_cache_ttl', 'fingerprint',
+                      'validate_api_key', 'verify', 'retries', 'rate_limit',
+                      'keep_alive', 'api_stats', 'snapshot', 'snapshot_ttl',
+                      'concurrency', 'batch')
+
+
+def linode_nodebalancer_argument_spec(*unsupported):
+    """The options shared by every linode_nodebalancer* module, less those
+    a module has no use for, so that ansible rejects them rather than they
+    are silently ignored.
+    """
+    spec = dict(
+        api_key=dict(required=False,
+                     aliases=['linode_api_id'],
+                     type='str'),
+        id_cache=dict(required=False,
+                      default=False,
+                      type='bool'),
+        id_cache_ttl=dict(required=False,
+                          default=300,
+                          type='int'),
+        fingerprint=dict(required=False,
+                         default=False,
+                         type='bool'),
+        validate_api_key=dict(required=False,
+                              default=False,
+                              type='bool'),
+        verify=dict(required=False,
+                    default=False,
+                    type='bool'),
+        retries=dict(required=False,
+                     default=3,
+                     type='int'),
+        rate_limit=dict(required=False,
+                        default=0,
+                        type='float'),
+        keep_alive=dict(required=False,
+                        default=True,
+                        type='bool'),
+        api_stats=dict(required=False,
+                       default=False,
+                       type='bool'),
+        api_version=dict(required=False,
+                         default='v3',
+                         choices=['v3', 'v4'],
+                         type='str'),
+        snapshot=dict(required=False,
+                      type='dict'),
+        snapshot_ttl=dict(required=False,
+                          default=SNAPSHOT_TTL,
+                          type='int'),
+    )
+    for option in unsupported:
+        del spec[option]
+    return spec
+
+
+def state_dir():
+    """The controller local directory used to keep state between runs.
+    Defaults to ~/.ansible/linode_nodebalancer, and can be changed with
+    the LINODE_NODEBALANCER_STATE_DIR environment variable.
+    """
+    path = os.environ.get('LINODE_NODEBALANCER_STATE_DIR') or \
+        os.path.join(os.path.expanduser('~'), '.ansible', 'linode_nodebalancer')
+    try:
+        os.makedirs(path, 0o700)
+    except OSError:
+        if not os.path.isdir(path):
+            raise
+    return path
+
+
+def api_key_hash(api_key):
+    """A short, stable fingerprint of an api key, safe to use in file names"""
+    return hashlib.sha256(api_key.encode('utf-8')).hexdigest()[:16]
+
+
+def api_connect(module, api_key):
+    """Return a linode api client for the api key, set up from the shared
+    module options.
+    """
+    # Another endpoint, such as the offline stand in under bench/, can be
+    # used by setting LINODE_API_URL
+    if module.params.get('api_version') == 'v4':
+        api = V4Api(api_key, os.environ.get('LINODE_API_URL') or V4_API_URL)
+        url = api.url
+    else:
+        api = linode_api.Api(api_key)
+        if os.environ.get('LINODE_API_URL'):
+            linode_api.LINODE_API_URL = os.environ['LINODE_API_URL']
+        url = linode_api.LINODE_API_URL
+
+    # linode-python has no hooks, so its transport and sender are swapped
+    # on the instance. V4Api is built the same way.
+    if module.params.get('keep_alive') and \
+            not getproxies().get(urlparse(url).scheme):
+        pool = ConnectionPool(url)
+        api._Api__request = pool.request
+        api._Api__urlopen = pool.urlopen
+
+    limiter = None
+    if module.params.get('rate_limit'):
+        limiter = RateLimiter.for_api_key(api_key,
+                                          module.params.get('rate_limit'))
+    api._Api__send_request = RetryingSender(api._Api__send_request,
+                                            module.params.get('retries'),
+                                            limiter)
+
+    if module.params.get('api_stats'):
+        ApiStats(api).report_to(module)
+    if TRACER.enabled:
+        api._Api__send_request = TRACER.sender(api._Api__send_request)
+
+    if module.params.get('validate_api_key'):
+        with TRACER.span('auth'):
+            validate_api_key(module, api, api_key)
+    return api
+
+
+def handle_api_error(func):
+    """A decorator that catches and api errors from the linode api and
+    returns ansible module fail_json.
+
+    An ansible module instance must be the first argument to the func
+
+    The api key isn't checked up front, so an authentication failure is
+    reported by whichever call is made first.
+    """
+    def handle(*args, **kwargs):
+        try:
+            return func(*args, **kwargs)
+        except linode_api.ApiError as e:
+            if e.value[0]['ERRORCODE'] == AUTHENTICATION_FAILED:
+                return args[0].fail_json(msg=e.value[0]['ERRORMESSAGE'])
+            msg = "FATAL: {err}".format(err=error_message(e))
+            return args[0].fail_json(msg=msg)
+        except (IOError, socket.error) as e:
+            # The request itself failed, even after any retries
+            msg = "FATAL: {err}".format(err=error_message(e))
+            return args[0].fail_json(msg=msg)
+    return handle
+
+
+def error_message(e):
+    """Format an error from an api call. ApiErrors are formatted as
+    'Code [code] - message', or 'HTTP status - message' for the api v4
+    statuses with no api v3 code.
+    """
+    if isinstance(e, linode_api.ApiError):
+        code = e.value[0]['ERRORCODE']
+        if code >= HTTP_STATUS_CODES:
+            return "HTTP {code} - {err}".format(
+                code=code, err=e.value[0]['ERRORMESSAGE'])
+        return "Code [{code}] - {err}".format(code=code,
+                                              err=e.value[0]['ERRORMESSAGE'])
+    return str(e)
+
+
+def run_concurrently(calls, concurrency):
+    """Run a list of no argument callables on up to concurrency threads.
+
+    Returns a (result, error) pair for each call, in the same order as
+    the calls. A call that raises doesn't stop the others, the exception
+    is returned as its error instead.
+    """
+    outcomes = [None] * len(calls)
+    pending = iter(range(len(calls)))
+    lock = threading.Lock()
+
+    def worker():
+        while True:
+            with lock:
+                i = next(pending, None)
+            if i is None:
+                return
+            try:
+                outcomes[i] = (calls[i](), None)
+            except Exception as e:
+                outcomes[i] = (None, e)
+
+    concurrency = max(1, min(concurrency, MAX_CONCURRENCY, len(calls)))
+    if concurrency == 1:
+        worker()
+        return outcomes
+
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return outcomes
+
+
+def run_batched(api, calls):
+    """Send a list of (api method name, kwargs) calls as api_action=batch
+    requests, of up to BATCH_SIZE calls each.
+
+    Returns a (result, error) pair for each call, in the same order as
+    the calls, where error is the ApiError for that call. A batch request
+    that fails as a whole doesn't stop the others, its exception is
+    returned as the error of each of its calls instead.
+    """
+    outcomes = []
+    for i in range(0, len(calls), BATCH_SIZE):
+        chunk = calls[i:i + BATCH_SIZE]
+        api.batching = True
+        try:
+            for method, kwargs in chunk:
+                getattr(api, method)(**kwargs)
+            responses = api.batchFlush()
+        except Exception as e:
+            outcomes.extend((None, e) for _ in chunk)
+            continue
+        finally:
+            api.batching = False
+
+        for response in responses:
+            errors = response.get('ERRORARRAY')
+            if errors and errors[0]['ERRORCODE'] != 0:
+                outcomes.append((None, linode_api.ApiError(errors)))
+            else:
+                outcomes.append((response.get('DATA'), None))
+    return outcomes
+
+
+def run_api_calls(api, calls, concurrency=1, batch=False):
+    """Make a list of independent (api method name, kwargs) calls, either
+    in batch requests or on up to concurrency threads.
+
+    Returns a (result, error) pair for each call, in order. The v4 api
+    has no batch requests, so there batch is ignored.
+    """
+    if batch and not isinstance(api, V4Api):
+        return run_batched(api, calls)
+    return run_concurrently([partial(getattr(api, method), **kwargs)
+                             for method, kwargs in calls], concurrency)
+
+
+def results_or_raise(outcomes):
+    """Return the results of run_api_calls, raising the first error"""
+    for _, error in outcomes:
+        if error:
+            raise error
+    return [result for result, _ in outcomes]
+
+
+class Response(object):
+    """A fully read HTTP response, as returned by ConnectionPool.urlopen"""
+
+    def __init__(self, status, headers, body):
+        self.status = status
+        self.headers = headers
+        self.body = body
+
+    def read(self):
+        return self.body
+
+
+def closed_while_idle(e):
+    """Whether an error on a reused connection shows the server had closed
+    it before reading the request: it hung up without a byte of response,
+    or reset the connection. Anything else, a timeout above all, may come
+    after the request was processed, so it isn't safe to send again.
+    """
+    if isinstance(e, socket.timeout):
+        return False
+    if isinstance(e, httplib.BadStatusLine):
+        return True
+    return isinstance(e, socket.error) and \
+        e.errno in (errno.ECONNRESET, errno.EPIPE, errno.ECONNABORTED)
+
+
+class ConnectionPool(object):
+    """Sends linode-python's requests over persistent keep-alive HTTPS
+    connections, so the TLS handshake is paid once per connection rather
+    than once per call.
+
+    A request is a (url, body, headers) tuple, POSTed, or a (url, body,
+    headers, method) tuple, as V4Api makes.
+
+    Idle connections are kept for reuse by later calls, including those
+    made from run_concurrently's threads, up to MAX_CONCURRENCY of them.
+    """
+
+    def __init__(self, url, timeout=HTTP_TIMEOUT):
+        parsed = urlparse(url)
+        self.scheme = parsed.scheme
+        self.host = parsed.netloc
+        self.timeout = timeout
+        self.idle = []
+        self.lock = threading.Lock()
+
+    def request(self, url, fields, headers):
+        """Stands in for linode-python's URLREQUEST"""
+        headers = dict(headers)
+        headers['Content-Type'] = 'application/x-www-form-urlencoded'
+        return url, urlencode(fields), headers
+
+    def urlopen(self, request):
+        """Stands in for linode-python's URLOPEN. Raises HTTPError for an
+        error status, as urllib2 does.
+        """
+        url, body, headers = request[:3]
+        method = request[3] if len(request) > 3 else 'POST'
+        parsed = urlparse(url)
+        path = parsed.path or '/'
+        if parsed.query:
+            path += '?' + parsed.query
+
+        connection, reused = self._acquire()
+        try:
+            connection.request(method, path, body, headers)
+            response = connection.getresponse()
+            result = Response(response.status, dict(response.getheaders()),
+                              response.read())
+        except (httplib.HTTPException, socket.error) as e:
+            connection.close()
+            if not reused or not closed_while_idle(e):
+                raise
+            # The server closed the idle connection before the request
+            # reached it, so it is safe to send again on a fresh one.
+            connection, _ = self._acquire(fresh=True)
+            connection.request(method, path, body, headers)
+            response = connection.getresponse()
+            result = Response(response.status, dict(response.getheaders()),
+                              response.read())
+
+        if response.will_close:
+            connection.close()
+        else:
+            self._release(connection)
+
+        if result.status >= 400:
+            raise HTTPError(url, result.status, response.reason,
+                            result.headers, io.BytesIO(result.body))
+        return result
+
+    def _acquire(self, fresh=False):
+        """Return an idle connection, or a new one, and whether it was
+        reused.
+        """
+        if not fresh:
+            with self.lock:
+                if self.idle:
+                    return self.idle.pop(), True
+
+        if self.scheme == 'https':
+            connection = httplib.HTTPSConnection(self.host,
+                                                 timeout=self.timeout)
+        else:
+            connection = httplib.HTTPConnection(self.host,
+                                                timeout=self.timeout)
+        return connection, False
+
+    def _release(self, connection):
+        with self.lock:
+            if len(self.idle) < MAX_CONCURRENCY:
+                self.idle.append(connection)
+                return
+        connection.close()
+
+
+class V4Api(object):
+    """A linode api v4 client, with the methods and results of the
+    linode-python (api v3) client that the modules use.
+
+    Objects are returned with their api v3 fields, and errors are raised
+    as ApiErrors with the api v3 error code nearest their HTTP status.
+    Like linode-python, every request goes through _Api__send_request and
+    _Api__urlopen, so api_connect wraps both backends the same way.
+
+    Lists take a Filter of api v4 fields, sent as an X-Filter header, so
+    that a lookup by label or port and protocol is a single filtered page
+    rather than the whole collection. Each list method has an _iter
+    counterpart, a generator that only requests the next page once the
+    objects of the last have been used.
+
+    api v4 urls for configs and nodes include their nodebalancer (and
+    config), so the parents of every config and node read are remembered.
+    The modules always read an object before they write to it.
+    """
+
+    def __init__(self, api_key, url=V4_API_URL):
+        self.api_key = api_key
+        self.url = url.rstrip('/')
+        self.parents = {}
+        self._Api__send_request = self.send_request
+        self._Api__urlopen = self.urlopen
+
+    @staticmethod
+    def urlopen(request):
+        url, body, headers, method = request
+        if body is not None:
+            body = body.encode('utf-8')
+        request = Request(url, body, headers)
+        request.get_method = lambda: method
+        return urlopen(request, timeout=HTTP_TIMEOUT)
+
+    def send_request(self, request):
+        """Send a request dict of api_action, method, path, and optionally
+        body, filter and page, returning the decoded response.
+
+        Retryable HTTP errors (see RETRYABLE_STATUSES) are raised as they
+        are, for RetryingSender. Others are raised as ApiErrors.
+        """
+        url = self.url + request['path']
+        if request.get('page'):
+            url += '?' + urlencode(dict(page=request['page'],
+                                        page_size=V4_PAGE_SIZE))
+        headers = {'Authorization': 'Bearer ' + self.api_key,
+                   'Content-Type': 'application/json',
+                   'User-Agent': 'ansible-linode-nodebalancer'}
+        if request.get('filter'):
+            headers['X-Filter'] = json.dumps(request['filter'])
+        body = None
+        if request.get('body') is not None:
+            body = json.dumps(request['body'])
+
+        try:
+            response = self._Api__urlopen((url, body, headers,
+                                           request['method']))
+        except HTTPError as e:
+            if e.code in RETRYABLE_STATUSES:
+                raise
+            raise linode_api.ApiError([dict(
+                ERRORCODE=V4_ERROR_CODES.get(e.code, e.code),
+                ERRORMESSAGE=self.error_reason(e))])
+        return json.loads(response.read() or '{}')
+
+    @staticmethod
+    def error_reason(e):
+        try:
+            errors = json.loads(e.read())['errors']
+            return '; '.join(
+                ': '.join(str(error[k]) for k in ('field', 'reason')
+                          if error.get(k))
+                for error in errors)
+        except (AttributeError, KeyError, TypeError, ValueError):
+            return '{code} {msg}'.format(code=e.code, msg=e.msg)
+
+    def _send(self, action, method, path, body=None, **request):
+        return self._Api__send_request(dict(request, api_action=action,
+                                            method=method, path=path,
+                                            body=body))
+
+    def _iter(self, action, path, filters=None):
+        """Generate every object of a collection, requesting a page of
+        V4_PAGE_SIZE at a time
+        """
+        page, pages = 1, 1
+        while page <= pages:
+            response = self._send(action, 'GET', path, filter=filters,
+                                  page=page)
+            for obj in response.get('data', []):
+                yield obj
+            pages = response.get('pages', 1)
+            page += 1
+
+    @staticmethod
+    def _body(kwargs, fields):
+        """The api v4 body of an api v3 write's parameters. Unset (None)
+        parameters are left out.
+        """
+        body = {}
+        for option, _, param, _ in fields:
+            if kwargs.get(param.lower()) is not None:
+                body[V4_FIELD_NAMES.get(option, option)] = \
+                    kwargs[param.lower()]
+        if 'region' in body:
+            body['region'] = V4_REGIONS.get(body['region'], body['region'])
+        return body
+
+    @staticmethod
+    def _v3(obj, fields, **ids):
+        """The api v3 fields of an api v4 object"""
+        result = dict(ids)
+        for option, field, _, _ in fields:
+            value = obj.get(V4_FIELD_NAMES.get(option, option))
+            result[field] = '' if value is None else value
+        return result
+
+    def _nodebalancer(self, nb):
+        nb = self._v3(nb, NODEBALANCER_FIELDS,
+                      NODEBALANCERID=nb['id'],
+                      HOSTNAME=nb.get('hostname'),
+                      ADDRESS4=nb.get('ipv4'),
+                      ADDRESS6=nb.get('ipv6'),
+                      UPDATED=nb.get('updated'))
+        for dc_id, region in V4_REGIONS.items():
+            if region == nb['DATACENTERID']:
+                nb['DATACENTERID'] = dc_id
+        return nb
+
+    def _config(self, config):
+        self.parents[('config', config['id'])] = config['nodebalancer_id']
+        return self._v3(config, CONFIG_FIELDS, CONFIGID=config['id'],
+                        NODEBALANCERID=config['nodebalancer_id'])
+
+    def _node(self, node):
+        self.parents[('node', node['id'])] = node['config_id']
+        status = node.get('status') or 'Unknown'
+        return self._v3(node, NODE_FIELDS, NODEID=node['id'],
+                        CONFIGID=node['config_id'],
+                        NODEBALANCERID=node['nodebalancer_id'],
+                        STATUS=status[0].upper() + status[1:])
+
+    def _config_path(self, config_id):
+        nb_id = self.parents.get(('config', config_id))
+        if nb_id is None:
+            raise linode_api.ApiError([dict(
+                ERRORCODE=NOT_FOUND,
+                ERRORMESSAGE='Config {id} has not been read'.format(
+                    id=config_id))])
+        return '/nodebalancers/{nb}/configs/{id}'.format(nb=nb_id,
+                                                          id=config_id)
+
+    def _node_path(self, node_id):
+        config_id = self.parents.get(('node', node_id))
+        if config_id is None:
+            raise linode_api.ApiError([dict(
+                ERRORCODE=NOT_FOUND,
+                ERRORMESSAGE='Node {id} has not been read'.format(
+                    id=node_id))])
+        return '{config}/nodes/{id}'.format(
+            config=self._config_path(config_id), id=node_id)
+
+    def remember(self, obj):
+        """Record the parent of a config / node that was not read through
+        this client, such as one from a Snapshot, so that it can be
+        written.
+        """
+        if obj.get('NODEID'):
+            self.parents[('node', obj['NODEID'])] = obj['CONFIGID']
+        elif obj.get('CONFIGID'):
+            self.parents[('config', obj['CONFIGID'])] = \
+                obj['NODEBALANCERID']
+
+    @staticmethod
+    def _kwargs(kwargs):
+        # linode-python's parameters are case insensitive
+        return dict((k.lower(), v) for k, v in kwargs.items())
+
+    def test_echo(self, **kwargs):
+        self._send('test.echo', 'GET', '/profile')
+        return kwargs
+
+    def nodebalancer_list(self, **kwargs):
+        return list(self.nodebalancer_iter(**kwargs))
+
+    def nodebalancer_iter(self, **kwargs):
+        kwargs = self._kwargs(kwargs)
+        if kwargs.get('nodebalancerid'):
+            yield self._nodebalancer(self._send(
+                'nodebalancer.list', 'GET',
+                '/nodebalancers/{id}'.format(id=kwargs['nodebalancerid'])))
+            return
+        for nb in self._iter('nodebalancer.list', '/nodebalancers',
+                             kwargs.get('filter')):
+            yield self._nodebalancer(nb)
+
+    def nodebalancer_create(self, **kwargs):
+        # api v4 has no payment term
+        new = self._send('nodebalancer.create', 'POST', '/nodebalancers',
+                         self._body(self._kwargs(kwargs),
+                                    NODEBALANCER_FIELDS))
+        return dict(NodeBalancerID=new['id'])
+
+    def nodebalancer_update(self, **kwargs):
+        kwargs = self._kwargs(kwargs)
+        self._send('nodebalancer.update', 'PUT',
+                   '/nodebalancers/{id}'.format(id=kwargs['nodebalancerid']),
+                   self._body(kwargs, NODEBALANCER_FIELDS))
+        return dict(NodeBalancerID=kwargs['nodebalancerid'])
+
+    def nodebalancer_delete(self, **kwargs):
+        kwargs = self._kwargs(kwargs)
+        self._send('nodebalancer.delete', 'DELETE',
+                   '/nodebalancers/{id}'.format(id=kwargs['nodebalancerid']))
+        return dict(NodeBalancerID=kwargs['nodebalancerid'])
+
+    def nodebalancer_config_list(self, **kwargs):
+        return list(self.nodebalancer_config_iter(**kwargs))
+
+    def nodebalancer_config_iter(self, **kwargs):
+        kwargs = self._kwargs(kwargs)
+        path = '/nodebalancers/{id}/configs'.format(
+            id=kwargs['nodebalancerid'])
+        if kwargs.get('configid'):
+            yield self._config(self._send(
+                'nodebalancer.config.list', 'GET',
+                '{path}/{id}'.format(path=path, id=kwargs['configid'])))
+            return
+        for config in self._iter('nodebalancer.config.list', path,
+                                 kwargs.get('filter')):
+            yield self._config(config)
+
+    def nodebalancer_config_create(self, **kwargs):
+        kwargs = self._kwargs(kwargs)
+        new = self._send('nodebalancer.config.create', 'POST',
+                         '/nodebalancers/{id}/configs'.format(
+                             id=kwargs['nodebalancerid']),
+                         self._body(kwargs, CONFIG_FIELDS))
+        self._config(new)
+        return dict(ConfigID=new['id'])
+
+    def nodebalancer_config_update(self, **kwargs):
+        kwargs = self._kwargs(kwargs)
+        self._send('nodebalancer.config.update', 'PUT',
+                   self._config_path(kwargs['configid']),
+                   self._body(kwargs, CONFIG_FIELDS))
+        return dict(ConfigID=kwargs['configid'])
+
+    def nodebalancer_config_delete(self, **kwargs):
+        kwargs = self._kwargs(kwargs)
+        if kwargs.get('nodebalancerid'):
+            self.parents[('config', kwargs['configid'])] = \
+                kwargs['nodebalancerid']
+        self._send('nodebalancer.config.delete', 'DELETE',
+                   self._config_path(kwargs['configid']))
+        return dict(ConfigID=kwargs['configid'])
+
+    def nodebalancer_node_list(self, **kwargs):
+        return list(self.nodebalancer_node_iter(**kwargs))
+
+    def nodebalancer_node_iter(self, **kwargs):
+        kwargs = self._kwargs(kwargs)
+        path = self._config_path(kwargs['configid']) + '/nodes'
+        if kwargs.get('nodeid'):
+            yield self._node(self._send(
+                'nodebalancer.node.list', 'GET',
+                '{path}/{id}'.format(path=path, id=kwargs['nodeid'])))
+            return
+        for node in self._iter('nodebalancer.node.list', path,
+                               kwargs.get('filter')):
+            yield self._node(node)
+
+    def nodebalancer_node_create(self, **kwargs):
+        kwargs = self._kwargs(kwargs)
+        new = self._send('nodebalancer.node.create', 'POST',
+                         self._config_path(kwargs['configid']) + '/nodes',
+                         self._body(kwargs, NODE_FIELDS))
+        self._node(new)
+        return dict(NodeID=new['id'])
+
+    def nodebalancer_node_update(self, **kwargs):
+        kwargs = self._kwargs(kwargs)
+        self._send('nodebalancer.node.update', 'PUT',
+                   self._node_path(kwargs['nodeid']),
+                   self._body(kwargs, NODE_FIELDS))
+        return dict(NodeID=kwargs['nodeid'])
+
+    def nodebalancer_node_delete(self, **kwargs):
+        kwargs = self._kwargs(kwargs)
+        self._send('nodebalancer.node.delete', 'DELETE',
+                   self._node_path(kwargs['nodeid']))
+        return dict(NodeID=kwargs['nodeid'])
+
+
+def http_status(e):
+    """Return the HTTP status of an error raised by a request, if any"""
+    status = getattr(e, 'code', None)
+    if status is None and getattr(e, 'response', None) is not None:
+        status = getattr(e.response, 'status_code', None)
+    return status
+
+
+def request_actions(request):
+    """The api actions a request makes: those inside an api_action=batch
+    request, or its own.
+    """
+    action = request.get('api_action')
+    if action == 'batch':
+        return [r.get('api_action') for r in
+                json.loads(request.get('api_requestArray', '[]'))]
+    return [action]
+
+
+def is_retryable(e, actions):
+    """Decide whether a request making actions that raised e is worth
+    sending again.
+
+    Errors returned by the api itself (ApiError) never are. Rate limit
+    rejections always are. Server errors, dropped connections and
+    responses that couldn't be parsed (e.g. a proxy error page) are only
+    retried for reads (a batch of nothing but reads among them), as a
+    write may have been applied.
+    """
+    if linode_api and isinstance(e, linode_api.ApiError):
+        return False
+
+    status = http_status(e)
+    if status == TOO_MANY_REQUESTS:
+        return True
+    if any(action not in READ_ACTIONS for action in actions):
+        return False
+    if status is not None:
+        return status in RETRYABLE_STATUSES
+    return isinstance(e, (IOError, socket.error, ValueError))
+
+
+class RetryingSender(object):
+    """Wraps linode-python's request sender, retrying requests that fail
+    with a retryable error (see is_retryable) with jittered exponential
+    backoff, and pacing every request through an optional RateLimiter.
+    """
+
+    def __init__(self, send, retries, limiter=None):
+        self.send = send
+        self.retries = retries
+        self.limiter = limiter
+        self.retried = 0
+
+    def __call__(self, request):
+        actions = request_actions(request)
+        attempt = 0
+        while True:
+            if self.limiter:
+                self.limiter.acquire()
+            try:
+                return self.send(request)
+            except Exception as e:
+                if attempt >= self.retries or not is_retryable(e, actions):
+                    raise
+                time.sleep(self.backoff(e, attempt))
+                attempt += 1
+                self.retried += 1
+
+    @staticmethod
+    def backoff(e, attempt):
+        """Seconds to wait before the next attempt. A Retry-After header
+        on a rate limit response is respected.
+        """
+        headers = getattr(e, 'headers', None) or \
+            getattr(getattr(e, 'response', None), 'headers', None) or {}
+        try:
+            return min(float(headers.get('Retry-After')), BACKOFF_MAX)
+        except (TypeError, ValueError):
+            pass
+        return random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt))
+
+
+class ApiStats(object):
+    """Instruments a linode api client, recording the calls made per api
+    action, their latency, the retries made, and the bytes received.
+
+    Latency is timed around the whole call, including any retries. The
+    actions sent inside an api_action=batch request are counted as
+    batched, the request itself being timed as the batch action.
+    """
+
+    def __init__(self, api):
+        self.lock = threading.Lock()
+        self.latencies = {}
+        self.batched = {}
+        self.bytes_received = 0
+        self.sender = api._Api__send_request
+        self.urlopen = api._Api__urlopen
+        api._Api__send_request = self.send_request
+        api._Api__urlopen = self.read_response
+
+    def send_request(self, request):
+        action = request.get('api_action')
+        batched = []
+        if action == 'batch':
+            batched = request_actions(request)
+        start = time.time()
+        try:
+            return self.sender(request)
+        finally:
+            elapsed = time.time() - start
+            with self.lock:
+                self.latencies.setdefault(action, []).append(elapsed)
+                for name in batched:
+                    self.batched[name] = self.batched.get(name, 0) + 1
+
+    def read_response(self, request):
+        body = self.urlopen(request).read()
+        with self.lock:
+            self.bytes_received += len(body)
+        return Response(200, {}, body)
+
+    def report(self):
+        """The stats so far, for a module result"""
+        with self.lock:
+            actions = {}
+            for action in set(self.latencies) | set(self.batched):
+                latencies = sorted(self.latencies.get(action, []))
+                ms = [round(l * 1000, 1) for l in latencies]
+                actions[action] = dict(
+                    calls=len(latencies),
+                    batched=self.batched.get(action, 0),
+                    total_ms=round(sum(latencies) * 1000, 1),
+                    p50_ms=ms[(len(ms) - 1) // 2] if ms else 0,
+                    max_ms=ms[-1] if ms else 0)
+            return dict(
+                requests=sum(len(l) for l in self.latencies.values()),
+                retries=getattr(self.sender, 'retried', 0),
+                bytes_received=self.bytes_received,
+                actions=actions)
+
+    def report_to(self, module):
+        """Add the stats to the module's result, whether it exits or
+        fails.
+        """
+        exit_json, fail_json = module.exit_json, module.fail_json
+        module.exit_json = lambda **kwargs: exit_json(
+            api_stats=self.report(), **kwargs)
+        module.fail_json = lambda **kwargs: fail_json(
+            api_stats=self.report(), **kwargs)
+
+
+class Tracer(object):
+    """Records timed spans of a module run, and writes them as JSON lines
+    to a file of their own in directory when the process exits.
+
+    Every span has the trace id of the run, its own id, the id of the span
+    it was started inside (on the same thread, else the root 'module'
+    span), a name, a start time, and a duration in milliseconds. Nothing
+    is recorded if directory is None.
+    """
+
+    def __init__(self, directory=None):
+        self.directory = directory
+        self.trace_id = uuid.uuid4().hex
+        self.root = self.trace_id[:16]
+        self.module = None
+        self.started = None
+        self.spans = []
+        self.lock = threading.Lock()
+        self.local = threading.local()
+
+    @classmethod
+    def from_environment(cls):
+        return cls(os.environ.get(TRACE_ENV) or None)
+
+    @property
+    def enabled(self):
+        return self.directory is not None
+
+    def begin(self, module, started):
+        """Start tracing a run of module, which started importing at
+        started. The import is recorded as a span, ending now.
+        """
+        if not self.enabled:
+            return
+        self.module = module
+        self.started = started
+        self.add('import', started)
+        atexit.register(self.write)
+
+    def add(self, name, start, end=None, **attributes):
+        """Record a span that has already finished"""
+        if not self.enabled:
+            return
+        stack = getattr(self.local, 'stack', None) or [self.root]
+        span = dict(trace=self.trace_id,
+                    span=uuid.uuid4().hex[:16],
+                    parent=stack[-1],
+                    module=self.module,
+                    name=name,
+                    start=start,
+                    duration_ms=round(((end or time.time()) - start) * 1000,
+                                      3))
+        span.update(attributes)
+        with self.lock:
+            self.spans.append(span)
+        return span
+
+    @contextmanager
+    def span(self, name, **attributes):
+        """Record the time spent in the with block as a span, the parent
+        of any started within it.
+        """
+        if not self.enabled:
+            yield
+            return
+        span_id = uuid.uuid4().hex[:16]
+        stack = getattr(self.local, 'stack', None) or [self.root]
+        self.local.stack = stack + [span_id]
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.local.stack = stack
+            self.add(name, start, **attributes)['span'] = span_id
+
+    def sender(self, send):
+        """Wrap linode-python's request sender, recording every request
+        as a read or write span.
+        """
+        def traced_send(request):
+            action = request.get('api_action')
+            actions = request_actions(request)
+            kind = 'read'
+            if any(a not in READ_ACTIONS for a in actions):
+                kind = 'write'
+            with self.span(kind, action=action, calls=len(actions)):
+                return send(request)
+        return traced_send
+
+    def write(self):
+        """Write out the spans, with the whole run as the root span"""
+        if not self.spans:
+            return
+        root = dict(trace=self.trace_id, span=self.root, parent=None,
+                    module=self.module, name='module', start=self.started,
+                    duration_ms=round((time.time() - self.started) * 1000, 3),
+                    pid=os.getpid())
+        path = os.path.join(self.directory, '{module}-{trace}.jsonl'.format(
+            module=self.module, trace=self.trace_id))
+        try:
+            if not os.path.isdir(self.directory):
+                os.makedirs(self.directory)
+            with open(path, 'w') as f:
+                for span in [root] + self.spans:
+                    f.write(json.dumps(span, sort_keys=True) + '\n')
+        except (IOError, OSError):
+            # Tracing must never fail the module
+            pass
+
+
+TRACER = Tracer.from_environment()
+
+
+def traced(name):
+    """Decorate a function, recording each call as a span called name"""
+    def decorate(func):
+        @wraps(func)
+        def call(*args, **kwargs):
+            with TRACER.span(name):
+                return func(*args, **kwargs)
+        return call
+    return decorate
+
+
+class RateLimiter(object):
+    """A token bucket allowing rate requests per second, with bursts of up
+    to rate requests.
+
+    The bucket is kept in a file, locked while it is used, so that every
+    fork using the same api key draws from the same bucket.
+    """
+
+    def __init__(self, path, rate):
+        self.path = path
+        self.rate = float(rate)
+        self.burst = max(1.0, self.rate)
+
+    @classmethod
+    def for_api_key(cls, api_key, rate):
+        path = os.path.join(state_dir(),
+                            'rate-{key}.json'.format(key=api_key_hash(api_key)))
+        return cls(path, rate)
+
+    def acquire(self):
+        """Block until a token is available, and take it"""
+        while True:
+            wait = self._take()
+            if not wait:
+                return
+            time.sleep(wait)
+
+    def _take(self):
+        """Take a token if there is one. If not, return the seconds until
+        there will be.
+        """
+        with open(self.path + '.lock', 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                now = time.time()
+                try:
+                    with open(self.path) as f:
+                        tokens, updated = json.load(f)
+                except (IOError, OSError, ValueError):
+                    tokens, updated = self.burst, now
+
+                tokens = min(self.burst,
+                             tokens + (now - updated) * self.rate)
+                if tokens < 1:
+                    return (1 - tokens) / self.rate
+
+                with open(self.path, 'w') as f:
+                    json.dump([tokens - 1, now], f)
+                return 0
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+def validate_api_key(module, api, api_key):
+    """Check the api key with a test.echo round trip, failing the module
+    if it isn't valid.
+
+    A marker file is touched on success, and the check is skipped while
+    that is younger than API_KEY_VALID_FOR seconds.
+    """
+    marker = os.path.join(state_dir(),
+                          'auth-{key}'.format(key=api_key_hash(api_key)))
+    try:
+        if time.time() - os.path.getmtime(marker) < API_KEY_VALID_FOR:
+            return
+    except OSError:
+        pass
+
+    try:
+        api.test_echo()
+    except linode_api.ApiError as e:
+        module.fail_json(msg='%s' % e.value[0]['ERRORMESSAGE'])
+
+    with open(marker, 'a'):
+        os.utime(marker, None)
+
+
+class IdCache(object):
+    """A file backed cache of label -> id lookups.
+
+    There is one cache file per api key. Entries expire after ttl
+    seconds. The file is locked while it is read or written, so the
+    forks of a play can share it safely.
+
+    Only ids are cached. The object itself is always re-read by id, and
+    the entry is dropped if that read says it no longer exists or it no
+    longer matches the label.
+    """
+
+    def __init__(self, path, ttl):
+        self.path = path
+        self.ttl = ttl
+        self.entries = self._locked(fcntl.LOCK_SH, lambda entries: None)
+
+    @classmethod
+    def for_api_key(cls, api_key, ttl):
+        path = os.path.join(state_dir(),
+                            'ids-{key}.json'.format(key=api_key_hash(api_key)))
+        return cls(path, ttl)
+
+    @staticmethod
+    def key(kind, *parts):
+        return '|'.join([kind] + [str(part) for part in parts])
+
+    def get(self, kind, *parts):
+        """Return the cached id, or None if it is missing or expired"""
+        entry = self.entries.get(self.key(kind, *parts))
+        if entry and time.time() - entry[1] < self.ttl:
+            return entry[0]
+        return None
+
+    def set(self, kind, *parts):
+        """Cache an id. The id is the last of the parts"""
+        key, value = self.key(kind, *parts[:-1]), parts[-1]
+
+        def update(entries):
+            entries[key] = [value, time.time()]
+        self.entries = self._locked(fcntl.LOCK_EX, update)
+
+    def invalidate(self, kind, *parts):
+        key = self.key(kind, *parts)
+
+        def update(entries):
+            entries.pop(key, None)
+        self.entries = self._locked(fcntl.LOCK_EX, update)
+
+    def _locked(self, operation, update):
+        """Read the cache file under a lock. If the lock is exclusive, apply
+        update to the entries and write them back before unlocking.
+        Expired entries are dropped on every write.
+        """
+        with open(self.path + '.lock', 'a') as lock:
+            fcntl.flock(lock, operation)
+            try:
+                try:
+                    with open(self.path) as f:
+                        entries = json.load(f)
+                except (IOError, OSError, ValueError):
+                    entries = {}
+
+                if operation == fcntl.LOCK_EX:
+                    now = time.time()
+                    entries = dict((k, v) for k, v in entries.items()
+                                   if now - v[1] < self.ttl)
+                    update(entries)
+                    fd, tmp = tempfile.mkstemp(
+                        dir=os.path.dirname(self.path))
+                    with os.fdopen(fd, 'w') as f:
+                        json.dump(entries, f)
+                    os.rename(tmp, self.path)
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+        return entries
+
+
+class Fingerprints(IdCache):
+    """A file backed record of the last converge of each task: a hash of
+    the task's desired state, and of the fields of the objects it left.
+
+    There is one file per api key, shared by every fork like the IdCache.
+    A task run again with the same options re-reads its objects in a
+    single call scoped by their ids, and if their fields still hash the
+    same nothing has drifted, so it can exit unchanged without looking up
+    its parents or diffing. The parents' labels are not checked again.
+
+    Anything else (other options, an object changed or gone) drops the
+    record and falls through to a full run, which records its own.
+    """
+
+    # kind -> (api list method, [(read parameter, id field)] ending with
+    # the object's own, fields)
+    READS = {
+        'nodebalancer': ('nodebalancer_list',
+                         [('NodeBalancerID', 'NODEBALANCERID')],
+                         NODEBALANCER_FIELDS),
+        'config': ('nodebalancer_config_list',
+                   [('NodeBalancerID', 'NODEBALANCERID'),
+                    ('ConfigID', 'CONFIGID')],
+                   CONFIG_FIELDS),
+        'node': ('nodebalancer_node_list',
+                 [('ConfigID', 'CONFIGID'), ('NodeID', 'NODEID')],
+                 NODE_FIELDS),
+    }
+
+    def __init__(self, path, ttl, task, desired):
+        super(Fingerprints, self).__init__(path, ttl)
+        self.task = task
+        self.desired = desired
+
+    @classmethod
+    def for_task(cls, module, api_key, task, **inputs):
+        path = os.path.join(state_dir(), 'fingerprints-{key}.json'.format(
+            key=api_key_hash(api_key)))
+        return cls(path, FINGERPRINT_TTL, task,
+                   desired_state(module, **inputs))
+
+    @classmethod
+    def fingerprint(cls, kind, objects):
+        """A hash of the ids and normalized fields of a list of objects"""
+        _, ids, fields = cls.READS[kind]
+        rows = sorted([normalize(obj.get(field)) for _, field in ids] +
+                      [normalize(obj.get(field)) for _, field, _, _ in fields]
+                      for obj in objects)
+        return hashlib.sha256(
+            json.dumps(rows).encode('utf-8')).hexdigest()
+
+    def converged(self, api):
+        """Return (objects, result) recorded by the task's last converge,
+        if the objects read now are unchanged, otherwise None.
+        """
+        entry = self.get(self.task, self.desired)
+        if not entry:
+            return None
+
+        # api v4 paths need the parents of configs and nodes
+        for ids in entry['parents']:
+            from_snapshot(api, ids)
+        try:
+            live = getattr(api, entry['method'])(**entry['read'])
+        except linode_api.ApiError as e:
+            if e.value[0]['ERRORCODE'] != NOT_FOUND:
+                raise
+            live = None
+
+        if live is not None and \
+                self.fingerprint(entry['kind'], live) == entry['fingerprint']:
+            return live, entry['result']
+
+        self.invalidate(self.task, self.desired)
+        return None
+
+    def record(self, kind, parents, objects, every=False, **result):
+        """Record the objects of a kind a task converged, and the result to
+        return for them, along with those of their parents that api
+        v4 needs.
+
+        If every is set, objects are all those of the kind under the last
+        parent, and are re-read with one list call. Otherwise there is a
+        single object, re-read by its ids.
+        """
+        method, ids, _ = self.READS[kind]
+        if every:
+            source, ids = parents[-1], ids[:-1]
+        else:
+            source = objects[0]
+            parents = parents + objects
+        self.set(self.task, self.desired, dict(
+            kind=kind, method=method,
+            read=dict((param, source[field]) for param, field in ids),
+            parents=[dict((field, obj[field])
+                          for field in ('NODEBALANCERID', 'CONFIGID',
+                                        'NODEID') if obj.get(field))
+                     for obj in parents if obj.get('CONFIGID')],
+            fingerprint=self.fingerprint(kind, objects),
+            result=result))
+
+
+def desired_state(module, **inputs):
+    """A hash of the options that set a task's desired state, and of any
+    inputs the task read from elsewhere (such as a file named by an option)
+    """
+    options = dict((option, value)
+                   for option, value in module.params.items()
+                   if option not in CONNECTION_OPTIONS)
+    if inputs:
+        options['inputs'] = inputs
+    return hashlib.sha256(
+        json.dumps(options, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+class Snapshot(object):
+    """The nodebalancers, configs and nodes seen by the tasks of a play, so
+    that later tasks can look them up without listing them again.
+
+    A snapshot is the index of the linode_nodebalancers fact (see the
+    linode_nodebalancer_facts module), with the time it was taken:
+
+        {'taken': 1500000000.0,
+         'nodebalancers': {label: {..., 'configs': {'port:protocol':
+                                   {..., 'nodes': {label: {...}}}}}}}
+
+    Every module returns its snapshot, updated with what it found and
+    wrote, as the linode_nodebalancer_snapshot fact. A snapshot older than
+    ttl seconds is dropped. Objects missing from it, or missing fields
+    (from a facts run with fields set), are looked up in the api.
+    """
+
+    # kind -> (facts, id field, parent kind, parent id field, children)
+    KINDS = {
+        'nodebalancer': (NODEBALANCER_FACTS, 'NODEBALANCERID', None, None,
+                         'configs'),
+        'config': (CONFIG_FACTS, 'CONFIGID', 'nodebalancer',
+                   'NODEBALANCERID', 'nodes'),
+        'node': (NODE_FACTS, 'NODEID', 'config', 'CONFIGID', None),
+    }
+
+    def __init__(self, snapshot=None, ttl=SNAPSHOT_TTL):
+        snapshot = snapshot or {}
+        self.taken = snapshot.get('taken') or 0
+        self.nodebalancers = snapshot.get('nodebalancers') or {}
+        if time.time() - self.taken >= ttl:
+            self.taken, self.nodebalancers = time.time(), {}
+
+    @classmethod
+    def from_module(cls, module):
+        return cls(module.params.get('snapshot'),
+                   module.params.get('snapshot_ttl'))
+
+    def dump(self):
+        return dict(taken=self.taken, nodebalancers=self.nodebalancers)
+
+    def report_to(self, module):
+        """Add the snapshot to the module's facts when it exits"""
+        exit_json = module.exit_json
+
+        def exit_with_snapshot(**result):
+            facts = result.setdefault('ansible_facts', {})
+            facts['linode_nodebalancer_snapshot'] = self.dump()
+            exit_json(**result)
+        module.exit_json = exit_with_snapshot
+        return self
+
+    def nodebalancer(self, node_balancer_id, name):
+        return self._lookup(self.nodebalancers, 'nodebalancer',
+                            node_balancer_id, name)
+
+    def config(self, nodebalancer, config_id, port, protocol):
+        nb_id = nodebalancer['NODEBALANCERID']
+        entry = self._entry('nodebalancer', nb_id)
+        return self._lookup(entry and entry.get('configs'), 'config',
+                            config_id, '{port}:{prot}'.format(port=port,
+                                                              prot=protocol),
+                            NODEBALANCERID=nb_id)
+
+    def node(self, nodebalancer, config, node_id, node_name):
+        entry = self._entry('config', config['CONFIGID'])
+        return self._lookup(entry and entry.get('nodes'), 'node', node_id,
+                            node_name, CONFIGID=config['CONFIGID'],
+                            NODEBALANCERID=nodebalancer['NODEBALANCERID'])
+
+    def add(self, kind, obj):
+        """Add or replace an object read from, or written to, the api.
+        Objects that were not created (in check mode), or whose parent is
+        not in the snapshot, are left out.
+        """
+        facts, id_field, parent_kind, parent_field, children = \
+            self.KINDS[kind]
+        if obj.get(id_field) is None:
+            return
+
+        container = self.nodebalancers
+        if parent_kind:
+            parent = self._entry(parent_kind, obj.get(parent_field))
+            if parent is None:
+                return
+            container = parent.setdefault(self.KINDS[parent_kind][4], {})
+
+        entry = facts_of(obj, facts)
+        old = self.remove(kind, obj)
+        if old and children in old:
+            entry[children] = old[children]
+        if kind == 'config':
+            container[config_key(obj)] = entry
+        else:
+            container[obj['LABEL']] = entry
+
+    def remove(self, kind, obj):
+        """Remove an object, returning its entry, or None"""
+        container, key = self._locate(kind, obj.get(self.KINDS[kind][1]))
+        return container.pop(key) if container else None
+
+    def _containers(self, kind):
+        """Yield the dicts of label / port:protocol -> entry holding the
+        objects of a kind.
+        """
+        if kind == 'nodebalancer':
+            yield self.nodebalancers
+            return
+        for nb in self.nodebalancers.values():
+            configs = nb.get('configs') or {}
+            if kind == 'config':
+                yield configs
+                continue
+            for config in configs.values():
+                yield config.get('nodes') or {}
+
+    def _locate(self, kind, obj_id):
+        """Return the (container, key) of an object by id, or (None, None)"""
+        for container in self._containers(kind):
+            for key, entry in container.items():
+                if entry.get('id') == obj_id:
+                    return container, key
+        return None, None
+
+    def _entry(self, kind, obj_id):
+        container, key = self._locate(kind, obj_id)
+        return container[key] if container else None
+
+    def _lookup(self, container, kind, obj_id, key, **ids):
+        """Return the api object of an entry in container, by id if given,
+        otherwise by key. None if it is missing, or lacks any fields.
+        """
+        if not container:
+            return None
+        if obj_id:
+            key = next((k for k, e in container.items()
+                        if e.get('id') == obj_id), None)
+        entry = container.get(key)
+        facts = self.KINDS[kind][0]
+        if entry is None or any(name not in entry for name, _ in facts):
+            return None
+        obj = dict((field, entry[name]) for name, field in facts)
+        obj.update(ids)
+        return obj
+
+
+def facts_of(obj, facts, fields=None):
+    """The facts of an api object. If fields is set, only those are
+    returned, along with the id.
+    """
+    return dict((name, obj.get(field)) for name, field in facts
+                if not fields or name == 'id' or name in fields)
+
+
+def config_key(config):
+    """The key of a config in the linode_nodebalancers fact"""
+    return '{port}:{prot}'.format(port=config['PORT'],
+                                  prot=config['PROTOCOL'])
+
+
+def normalize(value):
+    """Normalize a value for comparison, so that None and '' match, as do
+    a number and its string.
+    """
+    if value is None:
+        return ''
+    if isinstance(value, string_types) and value.strip().isdigit():
+        return int(value)
+    return value
+
+
+def with_defaults(spec, fields):
+    """Return a copy of the given desired spec, with defaults filled in"""
+    spec = dict(spec)
+    for option, _, _, default in fields:
+        if spec.get(option) is None:
+            spec[option] = default
+        elif isinstance(default, int):
+            spec[option] = int(spec[option])
+    return spec
+
+
+def changed_fields(live, spec, fields):
+    """Return the write parameters of the fields that differ between the
+    live object and the desired spec, once normalized.
+
+    Options missing from spec are left as they are. An option set to None
+    is written as '', as linode-python would send None as 'None'.
+    """
+    params = {}
+    for option, field, param, _ in fields:
+        if option in spec and \
+                normalize(live.get(field)) != normalize(spec[option]):
+            params[param] = '' if spec[option] is None else spec[option]
+    return params
+
+
+def write_params(spec, fields):
+    """Return the write parameters of a create from the desired spec,
+    leaving out the options that are not set.
+    """
+    return dict((param, spec[option]) for option, _, param, _ in fields
+                if spec.get(option) is not None)
+
+
+def merge_write(obj, params, fields, **ids):
+    """Return the object as it is after a write, without re-reading it.
+
+    obj is the object as it was last read (None for a create). The
+    submitted write params are applied over it, along with any ids
+    taken from the write response (e.g. NODEID=new['NodeID']).
+    """
+    obj = dict(obj or {}, **ids)
+    for _, field, param, _ in fields:
+        if param in params:
+            obj[field] = params[param]
+    return obj
+
+
+def plan_entry(action, kind, key, fields, live=None, params=None):
+    """Describe a create / update / delete of an object, for the plan a
+    module returns.
+
+    live is the object as read (None for a create), and params the write
+    parameters. before and after are the option values of the object
+    either side of the write, or for an update just those that change.
+    """
+    before = after = None
+    if live is not None:
+        before = dict((option, live.get(field))
+                      for option, field, _, _ in fields)
+    if action != 'delete':
+        after = dict(before or {})
+        for option, _, param, _ in fields:
+            if param in (params or {}):
+                after[option] = params[param]
+    if action == 'update':
+        changes = [option for option in after
+                   if normalize(after[option]) != normalize(before[option])]
+        before = dict((option, before[option]) for option in changes)
+        after = dict((option, after[option]) for option in changes)
+    return dict(action=action, type=kind, key=key, before=before,
+                after=after)
+
+
+def plan_diff(plan):
+    """The plan as ansible diff mode output"""
+    return [dict(before_header='{type} {key}'.format(**entry),
+                 after_header='{type} {key}'.format(**entry),
+                 before=entry['before'] or {},
+                 after=entry['after'] or {})
+            for entry in plan]
+
+
+def exit_with_plan(module, plan, **result):
+    """exit_json, with the plan of the writes made (or in check mode, that
+    would have been made), and in diff mode their diff.
+    """
+    if getattr(module, '_diff', False):
+        result['diff'] = plan_diff(plan)
+    module.exit_json(plan=plan, **result)
+
+
+def first(objects):
+    """Return the first of a list of objects from the api, or None"""
+    return objects[0] if objects else None
+
+
+def iter_matching(api, method, kwargs, filters):
+    """Iterate over the objects of an api list method.
+
+    Where the backend can (see V4Api), only those matching the filters of
+    api v4 fields are returned, a page at a time, so a caller that stops
+    at the first match reads no further pages. api v3 returns every object
+    in a single response, so callers still check each object.
+    """
+    if isinstance(api, V4Api):
+        return getattr(api, method.replace('_list', '_iter'))(
+            Filter=filters, **kwargs)
+    return iter(getattr(api, method)(**kwargs))
+
+
+def from_snapshot(api, obj):
+    """Return an object found in a Snapshot, readying the api client to
+    write it.
+    """
+    if obj and isinstance(api, V4Api):
+        api.remember(obj)
+    return obj
+
+
+def recorded(snapshot, kind, obj):
+    """Return an object found in the api, adding it to the snapshot"""
+    if snapshot is not None and obj:
+        snapshot.add(kind, obj)
+    return obj
+
+
+def cached_find(cache, kind, parts, fetch, matches):
+    """Lookup an object via an id held in the cache.
+
+    fetch is called with the cached id and returns a list of objects.
+    Returns None (having invalidated the cache entry) if the object has
+    gone, or no longer matches.
+    """
+    if not cache:
+        return None
+
+    cached_id = cache.get(kind, *parts)
+    if not cached_id:
+        return None
+
+    try:
+        found = first(fetch(cached_id))
+    except linode_api.ApiError as e:
+        if e.value[0]['ERRORCODE'] != NOT_FOUND:
+            raise
+        found = None
+
+    if found and matches(found):
+        return found
+
+    cache.invalidate(kind, *parts)
+    return None
+
+
+@traced('nodebalancer_find')
+def nodebalancer_find(api, node_balancer_id, name, cache=None,
+                      snapshot=None):
+    """Lookup and return a nodebalancer from the snapshot, or the api.
+    If node_balancer_id is present, lookup based on that.
+    If not, lookup based on the name
+    """
+
+    if snapshot is not None:
+        nb = snapshot.nodebalancer(node_balancer_id, name)
+        if nb:
+            return from_snapshot(api, nb)
+
+    if node_balancer_id:
+        return recorded(snapshot, 'nodebalancer', first(
+            api.nodebalancer_list(NodeBalancerID=node_balancer_id)))
+
+    if name:
+        nb = cached_find(
+            cache, 'nodebalancer', (name,),
+            lambda nb_id: api.nodebalancer_list(NodeBalancerID=nb_id),
+            lambda nb: nb['LABEL'] == name)
+        if nb:
+            return recorded(snapshot, 'nodebalancer', nb)
+
+        for nb in iter_matching(api, 'nodebalancer_list', {},
+                                dict(label=name)):
+            if nb['LABEL'] == name:
+                if cache:
+                    cache.set('nodebalancer', name, nb['NODEBALANCERID'])
+                return recorded(snapshot, 'nodebalancer', nb)
+
+    return None
+
+
+@traced('nodebalancer_config_find')
+def nodebalancer_config_find(api, nodebalancer, config_id, port, protocol,
+                             cache=None, snapshot=None):
+    """Lookup and return a nodebalancer config from the snapshot, or the
+    api.
+    If config_id is present, lookup based on that.
+    If not, lookup based on the port and protocol
+    """
+
+    nb_id = nodebalancer['NODEBALANCERID']
+
+    if snapshot is not None:
+        config = snapshot.config(nodebalancer, config_id, port, protocol)
+        if config:
+            return from_snapshot(api, config)
+
+    if config_id:
+        return recorded(snapshot, 'config', first(
+            api.nodebalancer_config_list(NodeBalancerID=nb_id,
+                                         ConfigID=config_id)))
+
+    config = cached_find(
+        cache, 'config', (nb_id, port, protocol),
+        lambda cid: api.nodebalancer_config_list(NodeBalancerID=nb_id,
+                                                 ConfigID=cid),
+        lambda c: c['PORT'] == port and c['PROTOCOL'] == protocol)
+    if config:
+        return recorded(snapshot, 'config', config)
+
+    for config in iter_matching(api, 'nodebalancer_config_list',
+                                dict(NodeBalancerID=nb_id),
+                                dict(port=port, protocol=protocol)):
+        if config['PORT'] == port and config['PROTOCOL'] == protocol:
+            if cache:
+                cache.set('config', nb_id, port, protocol,
+                          config['CONFIGID'])
+            return recorded(snapshot, 'config', config)
+
+    return None
+
+
+@traced('nodebalancer_node_find')
+def nodebalancer_node_find(api, nodebalancer, config, node_id, node_name,
+                           cache=None, snapshot=None):
+    """Lookup and return a node from the given nodebalancer / config, from
+    the snapshot, or the api.
+    If node_id is present lookup based on that.
+    If not, lookup based on the node_name
+    """
+
+    config_id = config['CONFIGID']
+
+    if snapshot is not None:
+        node = snapshot.node(nodebalancer, config, node_id, node_name)
+        if node:
+            return from_snapshot(api, node)
+
+    if node_id:
+        return recorded(snapshot, 'node', first(
+            api.nodebalancer_node_list(ConfigID=config_id, NodeID=node_id)))
+
+    node = cached_find(
+        cache, 'node', (config_id, node_name),
+        lambda nid: api.nodebalancer_node_list(ConfigID=config_id,
+                                               NodeID=nid),
+        lambda n: n['LABEL'] == node_name)
+    if node:
+        return recorded(snapshot, 'node', node)
+
+    for node in iter_matching(api, 'nodebalancer_node_list',
+                              dict(ConfigID=config_id),
+                              dict(label=node_name)):
+        if node['LABEL'] == node_name:
+            if cache:
+                cache.set('node', config_id, node_name, node['NODEID'])
+            return recorded(snapshot, 'node', node)
+
+    return None
+
+
+@traced('wait_for_status')
+def wait_for_status(api, config, labels, status='UP', interval=2,
+                    timeout=300):
+    """Poll a config's nodes until every one of labels reports the status,
+    reading the config's whole node list once per poll.
+
+    Returns the nodes by label as last read, and the labels still short
+    of the status when the timeout ran out (empty once they all reached
+    it).
+    """
+    deadline = time.time() + timeout
+    while True:
+        nodes = dict((node['LABEL'], node) for node in
+                     api.nodebalancer_node_list(ConfigID=config['CONFIGID']))
+        waiting = sorted(label for label in labels
+                         if label not in nodes or
+                         (nodes[label].get('STATUS') or '').upper() != status)
+        if not waiting or time.time() + interval > deadline:
+            return nodes, waiting
+        time.sleep(interval)
@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+"""Fixtures running the module functions against the offline fake api
+under bench/, over both the v3 and v4 apis.
+"""
+
+import os
+import sys
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(HERE)
+sys.path[:0] = [os.path.join(ROOT, 'bench'),
+                os.path.join(ROOT, 'action_plugins'), ROOT]
+
+import pytest
+
+# benchmark also makes the repo's module_utils importable, as ansible would
+from benchmark import API_KEY, BenchModule, ModuleExit
+from fake_linode_api import FakeLinode, FakeLinodeServer
+
+from ansible.module_utils.linode_nodebalancer_common import api_connect
+
+
+@pytest.fixture(scope='session')
+def server():
+    server = FakeLinodeServer(FakeLinode(API_KEY)).start()
+    yield server
+    server.stop()
+
+
+@pytest.fixture
+def linode(server):
+    """An empty account, served by the fake api"""
+    server.linode = FakeLinode(API_KEY)
+    return server.linode
+
+
+@pytest.fixture(params=['v3', 'v4'])
+def module(request, server, tmpdir, monkeypatch):
+    monkeypatch.setenv('LINODE_API_URL',
+                       server.url + ('v4' if request.param == 'v4' else ''))
+    monkeypatch.setenv('LINODE_NODEBALANCER_STATE_DIR', str(tmpdir))
+    return BenchModule(api_version=request.param)
+
+
+@pytest.fixture
+def api(module, linode):
+    return api_connect(module, API_KEY)
+
+
+def run(func, *args, **kwargs):
+    """Call a module function, returning (failed, result) of its exit"""
+    with pytest.raises(ModuleExit) as exit:
+        func(*args, **kwargs)
+    return exit.value.failed, exit.value.result
@@ -0,0 +1,44 @@
+# -*- coding: utf-8 -*-
+
+import pytest
+
+from conftest import run
+from fake_linode_api import FakeError
+
+import linode_nodebalancer_node as node_module
+
+
+def fail_batch(linode, monkeypatch, n, code=10):
+    """Fail the nth batch request as a whole"""
+    handle = linode.handle
+    batches = []
+
+    def failing_handle(fields):
+        if fields.get('api_action') == 'batch':
+            batches.append(fields)
+            if len(batches) == n:
+                return linode._response('batch', None, FakeError(
+                    code, 'Action limit exceeded'))
+        return handle(fields)
+
+    monkeypatch.setattr(linode, 'handle', failing_handle)
+
+
+def test_a_failed_batch_reports_the_writes_of_the_others(module, api, linode,
+                                                         monkeypatch):
+    if module.params['api_version'] == 'v4':
+        pytest.skip('the v4 api has no batch requests')
+    linode.add_config(linode.add_nodebalancer('nb'))
+    nodes = [dict(node_name='web%02d' % i, address='10.0.0.%d:80' % i)
+             for i in range(30)]
+    fail_batch(linode, monkeypatch, 2)
+
+    failed, result = run(node_module.linodeNodeBalancerNodesBulk, module,
+                         api, 'present', 'nb', None, None, 80, 'http', nodes,
+                         False, 100, 'accept', batch=True)
+
+    assert failed and result['changed']
+    assert 'FATAL: 5 of 30' in result['msg']
+    assert [r['action'] for r in result['nodes']
+            if 'error' not in r] == ['created'] * 25
+    assert len(linode.nodes) == 25
@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+
+from conftest import run
+
+import linode_nodebalancer_canary as canary_module
+from linode_nodebalancer_canary import canary_steps, canary_weights
+
+
+def test_canary_weights():
+    # 1 canary node against 4 baseline nodes at 10%: 44 / (4 * 100 + 44)
+    assert canary_weights(4, 1, 10, 100) == (100, 44)
+    assert canary_weights(1, 1, 50, 100) == (100, 100)
+    assert canary_weights(1, 4, 90, 100) == (44, 100)
+    assert canary_weights(2, 2, 0, 100) == (100, None)
+    assert canary_weights(2, 2, 100, 100) == (None, 100)
+    # The smaller group never goes below a weight of 1
+    assert canary_weights(1, 1, 1, 10) == (10, 1)
+
+
+def test_canary_steps():
+    steps = canary_steps(['old1', 'old2'], ['new'], [0, 50, 100], 100)
+
+    assert [percent for percent, _ in steps] == [0, 50, 100]
+    assert steps[0][1] == dict(old1=dict(weight=100, mode='accept'),
+                               old2=dict(weight=100, mode='accept'),
+                               new=dict(mode='drain'))
+    # Half of the traffic, on one node against two
+    assert steps[1][1] == dict(old1=dict(weight=50, mode='accept'),
+                               old2=dict(weight=50, mode='accept'),
+                               new=dict(weight=100, mode='accept'))
+    assert steps[2][1] == dict(old1=dict(mode='drain'),
+                               old2=dict(mode='drain'),
+                               new=dict(weight=100, mode='accept'))
+
+
+def seed(linode, **canary_fields):
+    config_id = linode.add_config(linode.add_nodebalancer('nb'))
+    for label in ('old1', 'old2'):
+        linode.add_node(config_id, label, '10.0.0.1:80', STATUS='UP')
+    linode.add_node(config_id, 'new', '10.0.0.9:80',
+                    **dict(dict(MODE='drain', STATUS='UP'), **canary_fields))
+
+
+def shift(module, api, steps):
+    return run(canary_module.linodeNodeBalancerCanary, module, api, 'nb',
+               None, None, 80, 'http', ['new'], None, steps, 100, 0, 0.05,
+               0.5)
+
+
+def modes(linode):
+    return dict((node['LABEL'], (node['MODE'], node['WEIGHT']))
+                for node in linode.nodes.values())
+
+
+def test_shift_and_rerun(module, api, linode):
+    seed(linode)
+
+    failed, result = shift(module, api, [50, 100])
+    assert not failed and result['changed']
+    # A drained node keeps its last weight
+    assert modes(linode) == dict(old1=('drain', 50), old2=('drain', 50),
+                                 new=('accept', 100))
+
+    linode.reset_counts()
+    failed, result = shift(module, api, [50, 100])
+    assert not failed and not result['changed']
+    assert 'nodebalancer.node.update' not in linode.actions
+
+
+def test_rolls_back_when_the_canary_is_not_up(module, api, linode):
+    seed(linode, STATUS='DOWN')
+    before = modes(linode)
+
+    failed, result = shift(module, api, [50, 100])
+
+    assert failed and result['rolled_back']
+    assert 'new not UP' in result['msg']
+    assert modes(linode) == before
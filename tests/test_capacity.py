@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+
+from conftest import run
+
+import linode_nodebalancer_node as node_module
+from linode_nodebalancer_node import capacity_weights, load_capacities
+
+
+def test_weights_are_proportional():
+    assert capacity_weights({'a': 4.0, 'b': 2.0, 'c': 1.0}, 100) == \
+        {'a': 100, 'b': 50, 'c': 25}
+
+
+def test_top_weight_is_lowered_to_keep_the_ratios():
+    # 100:33 is further from 3:1 than 99:33
+    assert capacity_weights({'a': 3.0, 'b': 1.0}, 100) == {'a': 99, 'b': 33}
+
+
+def test_small_capacities_are_clamped_to_one():
+    weights = capacity_weights({'a': 1000.0, 'b': 333.0, 'c': 0.001}, 100)
+    assert weights == {'a': 100, 'b': 33, 'c': 1}
+
+
+def test_weights_are_clamped_to_linode_range():
+    assert capacity_weights({'a': 2.0, 'b': 1.0}, 1000) == \
+        {'a': 254, 'b': 127}
+    assert capacity_weights({'a': 2.0, 'b': 1.0}, 0) == {'a': 1, 'b': 1}
+    assert capacity_weights({}, 100) == {}
+
+
+def test_load_capacities(tmpdir):
+    csv = tmpdir.join('m.csv')
+    csv.write('node_name,vcpus,rps\nweb0,4,800\nweb1,2,\n')
+    assert load_capacities(str(csv), 'vcpus') == {'web0': '4', 'web1': '2'}
+    assert load_capacities(str(csv), 'rps') == {'web0': '800'}
+
+    json = tmpdir.join('m.json')
+    json.write('{"web0": {"rps": 900}, "web1": 3}')
+    # A bare capacity is the node's, whatever the metric
+    assert load_capacities(str(json), 'rps') == {'web0': 900, 'web1': 3}
+    assert load_capacities(str(json)) == {'web1': 3}
+
+
+def test_only_changed_weights_are_written(module, api, linode):
+    config_id = linode.add_config(linode.add_nodebalancer('nb'))
+    for i in range(3):
+        linode.add_node(config_id, 'web%d' % i, '10.0.0.%d:80' % i)
+    nodes = [dict(node_name='web%d' % i) for i in range(3)]
+
+    linode.reset_counts()
+    failed, result = run(node_module.linodeNodeBalancerNodesBulk, module,
+                         api, 'present', 'nb', None, None, 80, 'http', nodes,
+                         False, 100, 'accept',
+                         capacities={'web0': 4, 'web1': 4, 'web2': 2})
+
+    assert not failed and result['changed']
+    assert linode.actions['nodebalancer.node.update'] == 1
+    assert [(r['node_name'], r['action'], r['node']['WEIGHT'])
+            for r in result['nodes']] == [('web0', 'unchanged', 100),
+                                          ('web1', 'unchanged', 100),
+                                          ('web2', 'updated', 50)]
+
+
+def test_nodes_need_a_weight_or_capacity(module, api, linode):
+    linode.add_config(linode.add_nodebalancer('nb'))
+
+    failed, result = run(node_module.linodeNodeBalancerNodesBulk, module,
+                         api, 'present', 'nb', None, None, 80, 'http',
+                         [dict(node_name='web0', address='10.0.0.1:80'),
+                          dict(node_name='web1', address='10.0.0.2:80',
+                               capacity=0)],
+                         False, 100, 'accept', capacities={})
+
+    assert failed and 'no weight or capacity for web0' in result['msg']
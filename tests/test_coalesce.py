@@ -0,0 +1,33 @@
+# -*- coding: utf-8 -*-
+
+from conftest import run
+
+import linode_nodebalancer_node as node_module
+from linode_nodebalancer_node_coalesce import split_result
+
+
+def test_split_result_gives_each_host_its_own_node(module, api, linode):
+    linode.add_config(linode.add_nodebalancer('nb'))
+    specs = {'web1': dict(node_name='web1', address='10.0.0.1:80'),
+             'other': dict(node_name='x:web1', address='10.0.0.2:80')}
+
+    failed, result = run(node_module.linodeNodeBalancerNodesBulk, module,
+                         api, 'present', 'nb', None, None, 80, 'http',
+                         [specs[host] for host in sorted(specs)], False, 100,
+                         'accept')
+    assert not failed
+
+    results = split_result(result, specs)
+    for host, spec in specs.items():
+        assert results[host]['changed']
+        assert results[host]['instances']['LABEL'] == spec['node_name']
+        assert [entry['key'] for entry in results[host]['plan']] == [
+            '80:http:' + spec['node_name']]
+        assert results[host]['coalesced'] == ['other', 'web1']
+
+
+def test_split_result_fails_a_host_without_a_result():
+    results = split_result(dict(nodes=[], msg='FATAL: it broke'),
+                           {'web1': dict(node_name='web1')})
+
+    assert results['web1'] == dict(failed=True, msg='FATAL: it broke')
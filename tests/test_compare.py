@@ -0,0 +1,51 @@
+# -*- coding: utf-8 -*-
+
+import pytest
+
+from ansible.module_utils.linode_nodebalancer_common import (
+    CONFIG_FIELDS,
+    NODE_FIELDS,
+    changed_fields,
+    normalize)
+
+
+@pytest.mark.parametrize('a, b', [
+    (None, ''),
+    (80, '80'),
+    (80, ' 80 '),
+    ('accept', 'accept'),
+])
+def test_normalize_matches(a, b):
+    assert normalize(a) == normalize(b)
+
+
+@pytest.mark.parametrize('a, b', [
+    ('accept', 'drain'),
+    (80, '8080'),
+    ('0', ''),
+])
+def test_normalize_differs(a, b):
+    assert normalize(a) != normalize(b)
+
+
+def test_only_changed_fields_are_written():
+    live = dict(LABEL='web1', ADDRESS='10.0.0.1:80', WEIGHT=100,
+                MODE='accept')
+
+    assert changed_fields(live, dict(node_name='web1', weight='100',
+                                     mode='accept'), NODE_FIELDS) == {}
+    assert changed_fields(live, dict(weight=50, mode='drain'),
+                          NODE_FIELDS) == dict(Weight=50, Mode='drain')
+
+
+def test_options_left_out_are_left_alone():
+    live = dict(PORT=80, PROTOCOL='http', CHECK_PATH='/health')
+
+    assert changed_fields(live, dict(port=80), CONFIG_FIELDS) == {}
+
+
+def test_none_is_written_as_empty():
+    live = dict(PORT=80, CHECK_PATH='/health', CHECK_BODY='')
+
+    assert changed_fields(live, dict(check_path=None, check_body=None),
+                          CONFIG_FIELDS) == dict(check_path='')
@@ -0,0 +1,51 @@
+# -*- coding: utf-8 -*-
+
+import pytest
+
+from conftest import run
+
+import linode_nodebalancer_config as config_module
+
+DEFAULTS = dict(protocol='http', algorithm='roundrobin', stickiness='none',
+                check='connection', check_interval=5, check_timeout=3,
+                check_attempts=2, check_path=None, check_body=None)
+
+
+def converge(module, api, configs, purge=False):
+    return run(config_module.linodeNodeBalancerConfigsBulk, module, api,
+               'present', 'nb', None, configs, purge, DEFAULTS)
+
+
+@pytest.mark.parametrize('item, msg', [
+    (dict(protocol='tcp'), 'FATAL: configs item 1 needs a port'),
+    (dict(port=81, algoritm='source'),
+     'FATAL: configs item 1 (81) has unknown keys algoritm, choose from '),
+    (dict(port=81, algorithm='random'),
+     'FATAL: configs item 1 (81) algorithm must be one of roundrobin, '
+     'leastconn, source, not random'),
+    (dict(port=81, protocol='https'),
+     'FATAL: configs item 1 (81) protocol must be one of http, tcp, '
+     'not https'),
+])
+def test_bad_items_fail_before_any_write(module, api, linode, item, msg):
+    linode.add_nodebalancer('nb')
+
+    failed, result = converge(module, api, [dict(port=80), item])
+
+    assert failed and result['msg'].startswith(msg)
+    assert not linode.configs
+
+
+def test_configs_are_created_then_left_alone(module, api, linode):
+    linode.add_nodebalancer('nb')
+    configs = [dict(port=80), dict(port=8443, protocol='tcp',
+                                   algorithm='leastconn')]
+
+    failed, result = converge(module, api, configs)
+    assert not failed and result['changed']
+    assert sorted((c['PORT'], c['PROTOCOL'], c['ALGORITHM'])
+                  for c in linode.configs.values()) == [
+        (80, 'http', 'roundrobin'), (8443, 'tcp', 'leastconn')]
+
+    failed, result = converge(module, api, configs)
+    assert not failed and not result['changed']
@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+
+import socket
+import threading
+import time
+
+import pytest
+
+from ansible.module_utils.linode_nodebalancer_common import ConnectionPool
+
+RESPONSE = b'HTTP/1.1 200 OK\r\nContent-Length: 2\r\n\r\nok'
+
+
+class Server(object):
+    """Serves each connection with respond(connection, request number)"""
+
+    def __init__(self, respond):
+        self.respond = respond
+        self.requests = 0
+        self.listener = socket.socket()
+        self.listener.bind(('127.0.0.1', 0))
+        self.listener.listen(5)
+        thread = threading.Thread(target=self.serve)
+        thread.daemon = True
+        thread.start()
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:{port}/'.format(
+            port=self.listener.getsockname()[1])
+
+    def serve(self):
+        while True:
+            connection, _ = self.listener.accept()
+            thread = threading.Thread(target=self.serve_connection,
+                                      args=(connection,))
+            thread.daemon = True
+            thread.start()
+
+    def serve_connection(self, connection):
+        while connection.recv(65536):
+            self.requests += 1
+            if not self.respond(connection, self.requests):
+                break
+        connection.close()
+
+
+def send(pool, url):
+    return pool.urlopen(pool.request(url, dict(api_action='x'), {})).body
+
+
+def test_resends_when_the_idle_connection_was_closed():
+    def respond(connection, n):
+        connection.sendall(RESPONSE)
+        return False  # close it, though the client will keep it
+
+    server = Server(respond)
+    pool = ConnectionPool(server.url, timeout=2)
+    assert send(pool, server.url) == b'ok'
+    time.sleep(0.1)
+    assert send(pool, server.url) == b'ok'
+    assert server.requests == 2
+
+
+def test_never_resends_after_a_timeout():
+    def respond(connection, n):
+        if n == 1:
+            connection.sendall(RESPONSE)
+        else:
+            time.sleep(1)  # the request may well have been processed
+        return True
+
+    server = Server(respond)
+    pool = ConnectionPool(server.url, timeout=0.3)
+    assert send(pool, server.url) == b'ok'
+    with pytest.raises(socket.timeout):
+        send(pool, server.url)
+    time.sleep(0.1)
+    assert server.requests == 2
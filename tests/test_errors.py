@@ -0,0 +1,37 @@
+# -*- coding: utf-8 -*-
+
+import io
+
+import pytest
+from linode import api as linode_api
+
+from ansible.module_utils.linode_nodebalancer_common import (
+    HTTPError,
+    V4Api,
+    error_message)
+
+
+def failing_v4_api(status, body):
+    def urlopen(request):
+        raise HTTPError(request[0], status, 'Error', {}, io.BytesIO(body))
+
+    api = V4Api('token', 'http://127.0.0.1:1/v4')
+    api._Api__urlopen = urlopen
+    return api
+
+
+@pytest.mark.parametrize('status, code, message', [
+    (400, 1, 'Code [1] - port: Port already in use'),
+    (404, 5, 'Code [5] - port: Port already in use'),
+    (409, 409, 'HTTP 409 - port: Port already in use'),
+])
+def test_v4_statuses_are_reported_as_v3_codes_or_themselves(status, code,
+                                                            message):
+    api = failing_v4_api(status, b'{"errors": [{"field": "port", '
+                                 b'"reason": "Port already in use"}]}')
+
+    with pytest.raises(linode_api.ApiError) as e:
+        api.nodebalancer_list()
+
+    assert e.value.value[0]['ERRORCODE'] == code
+    assert error_message(e.value) == message
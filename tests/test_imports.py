@@ -0,0 +1,23 @@
+# -*- coding: utf-8 -*-
+
+import subprocess
+import sys
+
+from conftest import ROOT
+
+# As packaged by ansible, next to an ansible/module_utils/linode.py of its own
+IMPORT = '''
+import os, sys
+import ansible.module_utils
+ansible.module_utils.__path__[:0] = [sys.argv[1], os.path.join(sys.argv[2],
+                                                                'module_utils')]
+from ansible.module_utils import linode_nodebalancer_common
+from linode import api
+assert linode_nodebalancer_common.linode_api is api, \\
+    linode_nodebalancer_common.linode_api
+'''
+
+
+def test_linode_api_is_imported_absolutely_from_module_utils(tmpdir):
+    tmpdir.join('linode.py').write('def get_user_agent():\n    pass\n')
+    subprocess.check_call([sys.executable, '-c', IMPORT, str(tmpdir), ROOT])
@@ -0,0 +1,44 @@
+# -*- coding: utf-8 -*-
+
+from conftest import run
+
+import linode_nodebalancer_node as node_module
+
+
+def converge(module, api, node_id=None, node_name=None, address=None):
+    return run(node_module.linodeNodeBalancerNodes, module, api, 'present',
+               'nb', None, None, 80, 'http', node_id, node_name, address,
+               100, 'accept')
+
+
+def test_a_node_needs_an_address_to_be_created(module, api, linode):
+    linode.add_config(linode.add_nodebalancer('nb'))
+
+    failed, result = converge(module, api, node_name='web0')
+
+    assert failed
+    assert result['msg'] == 'FATAL: web0 needs an address to be created'
+    assert not linode.nodes
+
+
+def test_a_node_id_that_is_not_found_fails(module, api, linode):
+    linode.add_config(linode.add_nodebalancer('nb'))
+
+    failed, result = converge(module, api, node_id=1234,
+                              address='10.0.0.1:80')
+
+    assert failed and result['msg'].startswith('FATAL: ')
+    assert not linode.nodes
+
+
+def test_a_node_is_created_then_left_alone(module, api, linode):
+    linode.add_config(linode.add_nodebalancer('nb'))
+
+    failed, result = converge(module, api, node_name='web0',
+                              address='10.0.0.1:80')
+    assert not failed and result['changed']
+
+    # Found by its label, the address needn't be given again
+    failed, result = converge(module, api, node_name='web0')
+    assert not failed and not result['changed']
+    assert result['instances']['ADDRESS'] == '10.0.0.1:80'
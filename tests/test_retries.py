@@ -0,0 +1,52 @@
+# -*- coding: utf-8 -*-
+
+import io
+import json
+
+import pytest
+
+from ansible.module_utils import linode_nodebalancer_common as common
+from ansible.module_utils.linode_nodebalancer_common import (
+    HTTPError,
+    RetryingSender)
+
+
+class FlakySend(object):
+    """Fails the first request with a 502, and answers the rest"""
+
+    def __init__(self):
+        self.requests = 0
+
+    def __call__(self, request):
+        self.requests += 1
+        if self.requests == 1:
+            raise HTTPError('url', 502, 'Bad Gateway', {}, io.BytesIO(b''))
+        return 'ok'
+
+
+def batch(*actions):
+    return dict(api_action='batch', api_requestArray=json.dumps(
+        [dict(api_action=action) for action in actions]))
+
+
+@pytest.fixture(autouse=True)
+def no_backoff(monkeypatch):
+    monkeypatch.setattr(common.time, 'sleep', lambda seconds: None)
+
+
+@pytest.mark.parametrize('request_, retried', [
+    (dict(api_action='nodebalancer.node.list'), True),
+    (dict(api_action='nodebalancer.node.create'), False),
+    (batch('nodebalancer.node.list', 'nodebalancer.node.list'), True),
+    (batch('nodebalancer.node.list', 'nodebalancer.node.update'), False),
+])
+def test_only_reads_are_retried_after_a_server_error(request_, retried):
+    send = FlakySend()
+    sender = RetryingSender(send, retries=3)
+
+    if retried:
+        assert sender(request_) == 'ok'
+    else:
+        with pytest.raises(HTTPError):
+            sender(request_)
+    assert send.requests == (2 if retried else 1)
@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+
+import threading
+
+import pytest
+
+from conftest import run
+
+import linode_nodebalancer_node as node_module
+
+
+def seed(linode, down=()):
+    config_id = linode.add_config(linode.add_nodebalancer('nb'))
+    for i in range(4):
+        label = 'web%d' % i
+        linode.add_node(config_id, label, '10.0.0.%d:80' % i,
+                        STATUS='DOWN' if label in down else 'UP')
+
+
+def roll(module, api, nodes, **kwargs):
+    return run(node_module.linodeNodeBalancerNodesBulk, module, api,
+               'present', 'nb', None, None, 80, 'http', nodes, False, 100,
+               'accept', rolling=2, poll_interval=0.05, **kwargs)
+
+
+@pytest.fixture
+def health_check(linode):
+    """Report the accepting nodes UP, and the rest DOWN, as linode's
+    health checks would
+    """
+    stop = threading.Event()
+
+    def check():
+        while not stop.wait(0.02):
+            for node in list(linode.nodes.values()):
+                node['STATUS'] = 'UP' if node['MODE'] == 'accept' else 'DOWN'
+
+    thread = threading.Thread(target=check)
+    thread.start()
+    yield
+    stop.set()
+    thread.join()
+
+
+def actions(result):
+    return [(r['node_name'], r['action']) for r in result['nodes']]
+
+
+def test_every_node_is_drained_and_restored(module, api, linode,
+                                           health_check):
+    seed(linode)
+    nodes = [dict(node_name='web%d' % i) for i in range(4)] + \
+        [dict(node_name='new', address='10.0.0.9:80')]
+
+    failed, result = roll(module, api, nodes, rolling_timeout=5)
+
+    assert not failed and result['changed']
+    assert actions(result) == [('web0', 'rolled'), ('web1', 'rolled'),
+                               ('web2', 'rolled'), ('web3', 'rolled'),
+                               ('new', 'created')]
+    # A drain and a restore of each existing node, the new one is created
+    # drained and then restored
+    assert linode.actions['nodebalancer.node.update'] == 9
+    assert linode.actions['nodebalancer.node.create'] == 1
+    assert set(node['MODE'] for node in linode.nodes.values()) == \
+        set(['accept'])
+
+
+def test_a_batch_not_up_stops_the_roll(module, api, linode):
+    seed(linode, down=['web1'])
+    nodes = [dict(node_name='web%d' % i) for i in range(4)]
+
+    failed, result = roll(module, api, nodes, rolling_timeout=0.3)
+
+    assert failed and result['changed']
+    assert 'web1 not UP' in result['msg']
+    assert '2 of 4 nodes rolled' in result['msg']
+    assert actions(result) == [('web0', 'rolled'), ('web1', 'rolled'),
+                               ('web2', 'unchanged'), ('web3', 'unchanged')]
+    assert linode.actions['nodebalancer.node.update'] == 4
+
+
+def test_check_mode_writes_nothing(module, api, linode):
+    seed(linode)
+    module.check_mode = True
+
+    failed, result = roll(module, api, [dict(node_name='web0')])
+
+    assert not failed and result['changed']
+    assert 'nodebalancer.node.update' not in linode.actions
+    assert [entry['after'] for entry in result['plan']] == [
+        dict(mode='drain'), dict(mode='accept')]
@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+
+from conftest import run
+
+import linode_nodebalancer_topology as topology
+
+
+def converge(module, api, configs, purge=True):
+    return run(topology.linodeNodeBalancerTopology, module, api, 'present',
+               'nb', None, 7, 1, 0, configs, purge)
+
+
+def test_config_deletes_go_before_config_creates(module, api, linode):
+    config_id = linode.add_config(linode.add_nodebalancer('nb'))
+    linode.add_node(config_id, 'web1', '10.0.0.1:80')
+    nodebalancer = api.nodebalancer_list()[0]
+    tree = topology.topology_fetch(api, nodebalancer)
+
+    ops = topology.topology_diff(
+        module, nodebalancer, tree, 'nb', 0,
+        [dict(port=80, protocol='tcp',
+              nodes=[dict(node_name='web1', address='10.0.0.1:80')])], True)
+
+    assert [(op['action'], op['type'], op['key']) for op in ops] == [
+        ('delete', 'config', (80, 'http')),
+        ('create', 'config', (80, 'tcp')),
+        ('create', 'node', (80, 'tcp', 'web1'))]
+
+
+def test_node_deletes_go_before_node_creates(module, api, linode):
+    config_id = linode.add_config(linode.add_nodebalancer('nb'))
+    linode.add_node(config_id, 'old', '10.0.0.1:80')
+    nodebalancer = api.nodebalancer_list()[0]
+    tree = topology.topology_fetch(api, nodebalancer)
+
+    ops = topology.topology_diff(
+        module, nodebalancer, tree, 'nb', 0,
+        [dict(port=80, nodes=[dict(node_name='new',
+                                   address='10.0.0.1:80')])], True)
+
+    assert [(op['action'], op['key']) for op in ops] == [
+        ('delete', (80, 'http', 'old')), ('create', (80, 'http', 'new'))]
+
+
+def test_port_changes_protocol_in_one_run(module, api, linode):
+    config_id = linode.add_config(linode.add_nodebalancer('nb'))
+    linode.add_node(config_id, 'web1', '10.0.0.1:80')
+
+    failed, result = converge(module, api, [dict(
+        port=80, protocol='tcp',
+        nodes=[dict(node_name='web1', address='10.0.0.1:80')])])
+
+    assert not failed and result['changed']
+    configs = list(linode.configs.values())
+    assert [(c['PORT'], c['PROTOCOL']) for c in configs] == [(80, 'tcp')]
+    assert [n['LABEL'] for n in linode.nodes.values()] == ['web1']
+
+
+def test_failed_write_reports_what_was_applied(module, api, linode):
+    linode.add_nodebalancer('nb')
+
+    # The second config of port 80 is refused, and so its node isn't sent
+    failed, result = converge(module, api, [
+        dict(port=80, protocol='http'),
+        dict(port=80, protocol='tcp',
+             nodes=[dict(node_name='web1', address='10.0.0.1:80')])])
+
+    assert failed and result['changed']
+    assert '80:tcp' in result['msg']
+    assert [(op['action'], op['key']) for op in result['operations']] == [
+        ('create', '80:http')]
+    assert [c['PORT'] for c in result['instances']['CONFIGS']] == [80]
+    assert not linode.nodes
+
+
+def test_unchanged_after_converging(module, api, linode):
+    linode.add_nodebalancer('nb')
+    configs = [dict(port=80,
+                    nodes=[dict(node_name='web1', address='10.0.0.1:80')])]
+
+    assert converge(module, api, configs)[1]['changed']
+    linode.reset_counts()
+    failed, result = converge(module, api, configs)
+
+    assert not failed and not result['changed']
+    assert result['operations'] == []